@@ -0,0 +1,110 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmark the per-entry overhead of the correlation ID context managers.
+
+Compares the class-based context managers of `pci.context_vars` with the generator-based
+`@asynccontextmanager` implementation they replaced.
+
+Run with: python benchmarks/context_managers.py
+"""
+
+import asyncio
+import timeit
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any
+
+from pci.context_vars import (
+    CorrelationContext,
+    correlation_context_var,
+    set_context_var,
+    with_correlation_id,
+)
+
+ROUNDS = 5
+ITERATIONS = 100_000
+
+reference_var: ContextVar[Any] = ContextVar("reference", default=None)
+CONTEXT = CorrelationContext.new("0aa5ba9a-8ce7-4e1c-ac33-3c37b79e2c5c")
+
+
+@asynccontextmanager
+async def generator_set_context_var(context_var: ContextVar, value: Any):
+    """The generator-based implementation that was replaced."""
+    token = context_var.set(value)
+    yield
+    context_var.reset(token)
+
+
+async def run_generator_based():
+    """Enter and exit the generator-based context manager."""
+    for _ in range(ITERATIONS):
+        async with generator_set_context_var(correlation_context_var, CONTEXT):
+            pass
+
+
+async def run_class_based_async():
+    """Enter and exit the class-based context manager with `async with`."""
+    for _ in range(ITERATIONS):
+        async with set_context_var(correlation_context_var, CONTEXT):
+            pass
+
+
+def run_class_based_sync():
+    """Enter and exit the class-based context manager with `with`."""
+    for _ in range(ITERATIONS):
+        with set_context_var(correlation_context_var, CONTEXT):
+            pass
+
+
+async def run_decorated_coroutine():
+    """Call a coroutine function decorated with `with_correlation_id`."""
+
+    @with_correlation_id
+    async def decorated():
+        pass
+
+    with set_context_var(correlation_context_var, CONTEXT):
+        for _ in range(ITERATIONS):
+            await decorated()
+
+
+def best_of(func) -> float:
+    """Return the best time per iteration in nanoseconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=ROUNDS, number=1)) / ITERATIONS * 1e9
+
+
+def main():
+    """Run all benchmarks and print the results."""
+    results = {
+        "generator-based (async with)": best_of(
+            lambda: asyncio.run(run_generator_based())
+        ),
+        "class-based (async with)": best_of(
+            lambda: asyncio.run(run_class_based_async())
+        ),
+        "class-based (with)": best_of(run_class_based_sync),
+        "decorated coroutine": best_of(lambda: asyncio.run(run_decorated_coroutine())),
+    }
+    baseline = results["generator-based (async with)"]
+    for name, nanoseconds in results.items():
+        print(f"{name:32} {nanoseconds:8.0f} ns/entry  {baseline / nanoseconds:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmark rendering the JSON body of file responses.
+
+Compares the stdlib-based `JSONResponse` with `FastJSONResponse`, which uses orjson if
+it is installed, and with the two-part body rendered for compressed responses.
+
+Run with: python benchmarks/json_rendering.py
+"""
+
+import timeit
+
+from fastapi.responses import JSONResponse
+
+from pci.adapters.inbound.fastapi_.responses import (
+    HAS_ORJSON,
+    FastJSONResponse,
+    render_file_response,
+)
+
+ROUNDS = 5
+CORRELATION_ID = "0aa5ba9a-8ce7-4e1c-ac33-3c37b79e2c5c"
+# text with characters that need escaping or are not ASCII
+LINE = 'The "name" of this file is\ttest.txt – größe: 1\\2\n'
+SIZES = {"1 KB": 1024, "1 MB": 1024**2, "50 MB": 50 * 1024**2}
+
+
+def get_content(size: int) -> str:
+    """Get file content of roughly the given size in bytes."""
+    return (LINE * (size // len(LINE.encode()) + 1))[:size]
+
+
+def best_of(func, number: int) -> float:
+    """Return the best time per call in milliseconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=ROUNDS, number=number)) / number * 1e3
+
+
+def main():
+    """Run all benchmarks and print the results."""
+    print(f"orjson installed: {HAS_ORJSON}")
+    for label, size in SIZES.items():
+        content = {"correlation_id": CORRELATION_ID, "file_content": get_content(size)}
+        number = max(1, 10 * 1024**2 // size)
+        results = {
+            "JSONResponse (stdlib)": best_of(
+                lambda content=content: JSONResponse(content=content), number
+            ),
+            "FastJSONResponse": best_of(
+                lambda content=content: FastJSONResponse(content=content), number
+            ),
+            "render_file_response": best_of(
+                lambda content=content: render_file_response(**content), number
+            ),
+        }
+        baseline = results["JSONResponse (stdlib)"]
+        print(f"{label}:")
+        for name, milliseconds in results.items():
+            print(
+                f"  {name:24} {milliseconds:10.3f} ms  {baseline / milliseconds:5.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -18,7 +18,9 @@
 
 from fastapi import FastAPI
 
+from pci.adapters.inbound.fastapi_ import health
 from pci.adapters.inbound.fastapi_.routes import router
 
 app = FastAPI()
+app.include_router(health.router)
 app.include_router(router)
@@ -0,0 +1,210 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Structured access logging that keeps formatting and I/O off the event loop.
+
+Access log records are handed over to a bounded queue on the event loop and are
+formatted as JSON lines and written by a QueueListener running in a background thread.
+When the queue is full, records are dropped and counted instead of blocking the
+event loop.
+"""
+
+import json
+import logging
+import sys
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from time import perf_counter
+from typing import Any, Optional, Union
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.context_vars import correlation_context_var
+from pci.metrics import counter
+
+ACCESS_LOGGER_NAME = "pci.access"
+
+access_log = logging.getLogger(ACCESS_LOGGER_NAME)
+access_log.propagate = False
+
+dropped_records = counter(
+    "pci_access_log_dropped_records_total",
+    "Access log records dropped because the queue was full.",
+)
+
+
+class AccessLogConfig(BaseSettings):
+    """Config for the structured access log."""
+
+    access_log_enabled: bool = Field(
+        default=True,
+        description="Whether to write a JSON access log line per request and event.",
+    )
+    access_log_queue_size: int = Field(
+        default=10_000,
+        description=(
+            "The maximum number of access log records waiting to be written."
+            + " Further records are dropped and counted."
+        ),
+    )
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats log records as JSON lines including the access log fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the record as a single line of JSON."""
+        entry: dict[str, Any] = {
+            "timestamp": datetime.fromtimestamp(
+                record.created, tz=timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "access", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """A QueueHandler that drops records instead of blocking when the queue is full.
+
+    Records are passed on unchanged, since they are consumed in the same process.
+    """
+
+    def __init__(self, queue: "Queue[Optional[logging.LogRecord]]"):
+        super().__init__(queue)
+        self.dropped_records = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Skip the formatting done by the QueueHandler, it's done by the listener."""
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Put the record into the queue unless it is full."""
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped_records += 1
+            dropped_records.inc()
+
+
+class BlockingSentinelQueueListener(QueueListener):
+    """A QueueListener that waits for room in a full queue when stopping."""
+
+    def __init__(self, queue: "Queue[Optional[logging.LogRecord]]", *handlers):
+        super().__init__(queue, *handlers)
+        self._bounded_queue = queue
+
+    def enqueue_sentinel(self) -> None:
+        """Block until the stop sentinel (None) fits into the queue."""
+        self._bounded_queue.put(None)
+
+
+@contextmanager
+def access_log_listener(
+    *, config: AccessLogConfig, handler: Optional[logging.Handler] = None
+) -> Iterator[Optional[BoundedQueueHandler]]:
+    """Write the access log in a background thread for the life of the context.
+
+    By default, JSON lines are written to stdout. A different handler can be provided,
+    it will get a JsonFormatter if it has no formatter yet. Yields the handler attached
+    to the access logger, which counts the dropped records, or None if the access log
+    is disabled.
+    """
+    if not config.access_log_enabled:
+        access_log.disabled = True
+        try:
+            yield None
+        finally:
+            access_log.disabled = False
+        return
+
+    if handler is None:
+        handler = logging.StreamHandler(sys.stdout)
+    if handler.formatter is None:
+        handler.setFormatter(JsonFormatter())
+
+    queue: Queue[Optional[logging.LogRecord]] = Queue(
+        maxsize=config.access_log_queue_size
+    )
+    queue_handler = BoundedQueueHandler(queue)
+    listener = BlockingSentinelQueueListener(queue, handler)
+
+    access_log.addHandler(queue_handler)
+    access_log.setLevel(logging.INFO)
+    listener.start()
+    try:
+        yield queue_handler
+    finally:
+        access_log.removeHandler(queue_handler)
+        listener.stop()
+        if queue_handler.dropped_records:
+            logging.getLogger().warning(
+                "Dropped %d access log records due to a full queue.",
+                queue_handler.dropped_records,
+            )
+
+
+def log_access(  # noqa: PLR0913
+    *,
+    kind: str,
+    route: str,
+    status: Union[int, str],
+    started: float,
+    size: Optional[int] = None,
+    correlation_id: Optional[str] = None,
+    **extra: Any,
+) -> None:
+    """Log a single access to the access log.
+
+    Args:
+        kind: What was accessed, e.g. "request" or "event".
+        route: The route template or topic and type of the event.
+        status: The HTTP status code or the outcome of processing the event.
+        started: The `time.perf_counter()` value at which the processing started.
+        size: The number of bytes sent or written, if known.
+        correlation_id:
+            The correlation ID, defaults to the one of the current correlation context.
+        extra: Further fields to include in the log line.
+    """
+    if not access_log.isEnabledFor(logging.INFO):
+        return
+    if correlation_id is None:
+        correlation_id = correlation_context_var.get().correlation_id
+    access_log.info(
+        "%s %s %s",
+        kind,
+        route,
+        status,
+        extra={
+            "access": {
+                "kind": kind,
+                "correlation_id": correlation_id,
+                "route": route,
+                "status": status,
+                "latency_ms": round((perf_counter() - started) * 1000, 3),
+                "bytes": size,
+                **extra,
+            }
+        },
+    )
@@ -0,0 +1,66 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A bounded, time-windowed set used to recognize recently handled events."""
+
+from collections import OrderedDict
+from collections.abc import Hashable
+from time import monotonic
+from typing import Generic, TypeVar
+
+KeyType = TypeVar("KeyType", bound=Hashable)
+
+
+class DedupWindow(Generic[KeyType]):
+    """Remembers keys for `window` seconds after they were last added.
+
+    When more than `max_size` keys are remembered, the oldest ones are forgotten
+    early. As all keys are remembered equally long, the keys are kept in the order
+    they expire in, which makes expiring and evicting them O(1).
+    """
+
+    def __init__(self, *, max_size: int, window: float):
+        self._max_size = max_size
+        self._window = window
+        self._expiry: OrderedDict[KeyType, float] = OrderedDict()
+
+    def _expire(self, now: float):
+        """Forget all keys whose window has passed."""
+        while self._expiry:
+            key, expires_at = next(iter(self._expiry.items()))
+            if expires_at > now:
+                break
+            del self._expiry[key]
+
+    def __contains__(self, key: object) -> bool:
+        """Check whether the key was added within the window."""
+        self._expire(monotonic())
+        return key in self._expiry
+
+    def __len__(self) -> int:
+        """Get the number of remembered keys, including expired ones."""
+        return len(self._expiry)
+
+    def add(self, key: KeyType) -> None:
+        """Remember the key, restarting its window if it is already remembered."""
+        if self._max_size <= 0 or self._window <= 0:
+            return
+        now = monotonic()
+        self._expire(now)
+        self._expiry[key] = now + self._window
+        self._expiry.move_to_end(key)
+        if len(self._expiry) > self._max_size:
+            self._expiry.popitem(last=False)
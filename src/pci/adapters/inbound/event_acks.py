@@ -0,0 +1,73 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Acknowledging consumed events whose handling continues in the background."""
+
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+Ack = Callable[[], None]
+
+
+class _PendingAck:
+    """The acknowledgement of the event that is being consumed."""
+
+    def __init__(self, ack: Ack):
+        self.ack = ack
+        self.deferred = False
+
+
+_pending_ack: ContextVar[Optional[_PendingAck]] = ContextVar(
+    "pending_ack", default=None
+)
+
+
+def _no_ack() -> None:
+    """Acknowledge an event that is not tracked."""
+
+
+@contextmanager
+def acknowledge_when_done(ack: Ack) -> Iterator[None]:
+    """Track the handling of the event consumed within the block.
+
+    The event is acknowledged at the end of the block, unless the handler took over
+    the acknowledgement with `defer_ack`. If the block raises, the event is not
+    acknowledged.
+    """
+    pending = _PendingAck(ack)
+    token = _pending_ack.set(pending)
+    try:
+        yield
+    finally:
+        _pending_ack.reset(token)
+    if not pending.deferred:
+        ack()
+
+
+def defer_ack() -> Ack:
+    """Take over the acknowledgement of the event being consumed, for handling that
+    continues in the background.
+
+    Returns the function to call once the event has been handled. Outside of
+    `acknowledge_when_done`, this is a no-op.
+    """
+    pending = _pending_ack.get()
+    if pending is None:
+        return _no_ack
+    pending.deferred = True
+    return pending.ack
@@ -15,68 +15,464 @@
 #
 """Inbound adapter for the event subscriber"""
 import logging
+import random
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from functools import partial
+from itertools import count
+from time import perf_counter
+from typing import Callable, NamedTuple, Optional
 
 from ghga_event_schemas.validation import (
     EventSchemaValidationError,
     get_validated_payload,
 )
 from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventpub import EventPublisherProtocol
 from hexkit.protocols.eventsub import EventSubscriberProtocol
-from pydantic import Field
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings
 
-from pci.adapters.inbound.fastapi_.utils import get_validated_correlation_id
-from pci.context_vars import set_correlation_id
+from pci.access_log import log_access
+from pci.adapters.inbound.dedup import DedupWindow
+from pci.adapters.inbound.event_acks import defer_ack
+from pci.adapters.inbound.fastapi_.utils import (
+    InvalidCorrelationIdError,
+    get_validated_correlation_id,
+)
+from pci.adapters.inbound.staging_scheduler import (
+    SchedulerClosedError,
+    StagingScheduler,
+)
+from pci.adapters.inbound.timer_wheel import TimerWheel
+from pci.context_vars import CorrelationContext, set_correlation_context
+from pci.metrics import counter, gauge
 from pci.models import NonStagedFileRequested
 from pci.ports.inbound.data_repository import DataRepositoryPort
 
 log = logging.getLogger()
 
+skipped_events = counter(
+    "pci_skipped_events_total",
+    "Events for which no staging was performed because the work was already done.",
+    labels=("reason",),
+)
+scheduled_retries = gauge(
+    "pci_scheduled_retries", "Failed stagings waiting to be retried."
+)
+retried_events = counter("pci_retried_events_total", "Staging attempts retried.")
+dead_lettered_events = counter(
+    "pci_dead_lettered_events_total",
+    "Events published to the dead-letter topic.",
+    labels=("reason",),
+)
+
 
 class EventSubTranslatorConfig(BaseSettings):
     """Config for receiving events."""
 
     file_events_topic: str = Field(..., description="The name of the events topic.")
     nonstaged_file_requested_type: str = Field(..., description="")
+    dedup_window: float = Field(
+        default=300,
+        description=(
+            "For this many seconds after staging a file, further requests for the"
+            + " file are not staged again. Set to 0 to stage every request."
+        ),
+    )
+    dedup_max_size: int = Field(
+        default=100_000,
+        description="The maximum number of requests remembered for deduplication.",
+    )
+    dead_letter_topic: str = Field(
+        default="file-events-dlq",
+        description=(
+            "Events that are invalid or could not be handled after all retries are"
+            + " published to this topic, along with the correlation ID and the error."
+        ),
+    )
+    staging_max_retries: int = Field(
+        default=5, description="The number of times a failed staging is retried."
+    )
+    staging_retry_delay: float = Field(
+        default=1.0,
+        description=(
+            "The number of seconds before the first retry. Doubled with every retry"
+            + " and randomly shortened by up to half to spread out retries."
+        ),
+    )
+    staging_max_retry_delay: float = Field(
+        default=300.0, description="The maximum number of seconds between retries."
+    )
+    retry_timer_resolution: float = Field(
+        default=0.1,
+        description="The granularity in seconds with which retries are scheduled.",
+    )
+    staging_priorities: list[str] = Field(
+        default=["interactive", "bulk"],
+        description=(
+            "The priority classes of stagings, highest first. The priority of a"
+            + " request is taken from the 'priority' field of the event or else from"
+            + " the 'priority' baggage item, e.g. sent in the X-Correlation-Baggage"
+            + " header. Within a class, correlation IDs take turns."
+        ),
+    )
+    staging_default_priority: str = Field(
+        default="interactive",
+        description="The priority class of requests without a known priority.",
+    )
+    staging_concurrency: int = Field(
+        default=4, description="The number of files staged concurrently."
+    )
+    staging_io_threads: int = Field(
+        default=8,
+        description=(
+            "The number of threads the consumer uses for blocking file I/O, bounding"
+            + " the number of reads and writes of the file storage running at once."
+        ),
+    )
+    staging_queue_size: int = Field(
+        default=1000,
+        description=(
+            "Fetching further events is paused while this many stagings are queued,"
+            + " and only the offsets of handled events are committed."
+        ),
+    )
+
+    @model_validator(mode="after")
+    def check_default_priority(self) -> "EventSubTranslatorConfig":
+        """Make sure that the default priority is one of the priority classes."""
+        if self.staging_default_priority not in self.staging_priorities:
+            raise ValueError(
+                f"The default priority {self.staging_default_priority!r} is not one"
+                + f" of the staging priorities {self.staging_priorities}."
+            )
+        return self
+
+
+class RetryCancelledError(RuntimeError):
+    """Recorded for stagings whose retry was still pending on shutdown."""
+
+    def __init__(self):
+        super().__init__("The retry was cancelled on shutdown.")
+
+
+def _no_op() -> None:
+    """Do nothing."""
+
+
+class ReceivedEvent(NamedTuple):
+    """An event along with the number of the current attempt to handle it and the
+    function acknowledging it once it has been handled for good.
+    """
+
+    payload: JsonObject
+    type_: str
+    topic: str
+    attempt: int = 1
+    ack: Callable[[], None] = _no_op
 
 
 class EventSubTranslator(EventSubscriberProtocol):
-    """A triple hexagonal translator compatible with the EventSubscriberProtocol."""
+    """A triple hexagonal translator compatible with the EventSubscriberProtocol.
+
+    Stagings are queued by priority class and run by a scheduler in the background,
+    so that the consumer can move on to the next event. Failed stagings are retried
+    through the scheduler as well. An event is acknowledged to the consumer only once
+    it has been staged, skipped or dead-lettered, so that its offset is not committed
+    before. Events that are invalid or still fail after all retries are published to
+    the dead-letter topic if a dead-letter publisher is given, and only logged
+    otherwise.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: EventSubTranslatorConfig,
+        data_repository: DataRepositoryPort,
+        dead_letter_publisher: Optional[EventPublisherProtocol] = None,
+    ) -> AsyncGenerator["EventSubTranslator", None]:
+        """Setup an EventSubTranslator along with the scheduler for its stagings and
+        the timer wheel for its retries.
 
-    def __init__(
+        On teardown, all queued stagings are completed, including the retries that
+        become due meanwhile. Stagings with retries that are not due by then are marked
+        as failed and their events dead-lettered.
+        """
+        translator: Optional[EventSubTranslator] = None
+        try:
+            async with TimerWheel.construct(
+                tick=config.retry_timer_resolution
+            ) as timer_wheel, StagingScheduler.construct(
+                priorities=config.staging_priorities,
+                concurrency=config.staging_concurrency,
+                max_size=config.staging_queue_size,
+            ) as scheduler:
+                translator = cls(
+                    config=config,
+                    data_repository=data_repository,
+                    dead_letter_publisher=dead_letter_publisher,
+                    timer_wheel=timer_wheel,
+                    scheduler=scheduler,
+                )
+                yield translator
+        finally:
+            if translator is not None:
+                await translator._fail_pending_retries()
+
+    def __init__(  # noqa: PLR0913
         self,
         config: EventSubTranslatorConfig,
         data_repository: DataRepositoryPort,
+        dead_letter_publisher: Optional[EventPublisherProtocol] = None,
+        timer_wheel: Optional[TimerWheel] = None,
+        scheduler: Optional[StagingScheduler] = None,
     ):
-        """Initialize with config parameters and core dependencies."""
+        """Initialize with config parameters and core dependencies.
+
+        Without a timer wheel, failed stagings are not retried. Without a scheduler,
+        files are staged right away while consuming the event.
+        """
         self._config = config
         self._data_repository = data_repository
+        self._dead_letter_publisher = dead_letter_publisher
+        self._timer_wheel = timer_wheel
+        self._scheduler = scheduler
         self.topics_of_interest = [config.file_events_topic]
         self.types_of_interest = [config.nonstaged_file_requested_type]
+        # redelivered events and requests for recently staged files, respectively
+        self._handled_requests: DedupWindow[tuple[str, str]] = DedupWindow(
+            max_size=config.dedup_max_size, window=config.dedup_window
+        )
+        self._staged_files: DedupWindow[str] = DedupWindow(
+            max_size=config.dedup_max_size, window=config.dedup_window
+        )
+        # events with a scheduled retry that has not been submitted yet
+        self._pending_retries: dict[int, ReceivedEvent] = {}
+        self._retry_ids = count()
 
-    async def _stage_file(self, *, payload: JsonObject):
-        """Stage the requested file."""
+    async def _dead_letter(
+        self, event: ReceivedEvent, *, correlation_id: str, error: Exception
+    ):
+        """Publish an event that could not be handled to the dead-letter topic."""
+        reason = (
+            "invalid"
+            if isinstance(
+                error, (EventSchemaValidationError, InvalidCorrelationIdError)
+            )
+            else "failed"
+        )
+        if self._dead_letter_publisher is None:
+            log.error("Dropped %s event after %i attempts", reason, event.attempt)
+            return
+        dead_letter = {
+            "payload": event.payload,
+            "type": event.type_,
+            "topic": event.topic,
+            "correlation_id": correlation_id,
+            "error": {"type": type(error).__name__, "message": str(error)},
+            "attempts": event.attempt,
+        }
+        try:
+            await self._dead_letter_publisher.publish(
+                payload=dead_letter,
+                type_=event.type_,
+                topic=self._config.dead_letter_topic,
+                key=str(event.payload.get("file_id", "")),
+            )
+        except Exception:
+            log.exception("Failed to publish %s event to the dead-letter topic", reason)
+            return
+        dead_lettered_events.inc(reason=reason)
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Get the randomized, exponentially growing delay before the next attempt."""
+        delay = min(
+            self._config.staging_retry_delay * 2 ** (attempt - 1),
+            self._config.staging_max_retry_delay,
+        )
+        return delay * random.uniform(0.5, 1)  # noqa: S311
+
+    def _schedule_retry(self, event: ReceivedEvent):
+        """Schedule the next attempt to handle the event on the timer wheel."""
+        retry_id = next(self._retry_ids)
+
+        async def retry():
+            try:
+                await self._submit(event._replace(attempt=event.attempt + 1))
+            except SchedulerClosedError:
+                # left pending, to be failed on shutdown
+                return
+            del self._pending_retries[retry_id]
+            scheduled_retries.dec()
+            retried_events.inc()
+
+        self._pending_retries[retry_id] = event
+        scheduled_retries.inc()
+        self._timer_wheel.schedule(  # type: ignore[union-attr]
+            self._retry_delay(event.attempt), retry
+        )
+
+    async def _fail_pending_retries(self):
+        """Mark the stagings with pending retries as failed and dead-letter their
+        events, which would be lost otherwise.
+        """
+        if self._pending_retries:
+            log.warning(
+                "Giving up %i stagings with pending retries on shutdown",
+                len(self._pending_retries),
+            )
+        for event in self._pending_retries.values():
+            scheduled_retries.dec()
+            context = CorrelationContext.from_event_fields(
+                event.payload,
+                correlation_id=get_validated_correlation_id(
+                    str(event.payload.get("correlation_id", ""))
+                ),
+            )
+            async with set_correlation_context(context):
+                try:
+                    await self._data_repository.mark_failed(
+                        str(event.payload["file_id"])
+                    )
+                except Exception:
+                    log.exception("Failed to mark a staging as failed")
+                await self._dead_letter(
+                    event,
+                    correlation_id=context.correlation_id,
+                    error=RetryCancelledError(),
+                )
+            event.ack()
+        self._pending_retries.clear()
+
+    async def _stage_file(self, event: ReceivedEvent):
+        """Stage the requested file.
+
+        Failed attempts are retried until the maximum number of retries is reached.
+        """
+        started = perf_counter()
+        route = f"{event.topic}/{event.type_}"
         try:
             validated_payload = get_validated_payload(
-                payload=payload, schema=NonStagedFileRequested
+                payload=event.payload, schema=NonStagedFileRequested
+            )
+        except EventSchemaValidationError as error:
+            correlation_id = str(event.payload.get("correlation_id", ""))
+            log.error(
+                "Schema validation failed for %s", NonStagedFileRequested.__name__
+            )
+            log_access(
+                kind="event",
+                route=route,
+                status="invalid",
+                started=started,
+                correlation_id=correlation_id,
             )
+            await self._dead_letter(event, correlation_id=correlation_id, error=error)
+            event.ack()
+            return
 
-            # validate existing correlation ID or generate new one
+        # validate existing correlation ID or generate new one
+        try:
             validated_correlation_id = get_validated_correlation_id(
                 validated_payload.correlation_id
             )
+        except InvalidCorrelationIdError as error:
+            log_access(
+                kind="event",
+                route=route,
+                status="invalid",
+                started=started,
+                correlation_id=validated_payload.correlation_id,
+            )
+            await self._dead_letter(
+                event, correlation_id=validated_payload.correlation_id, error=error
+            )
+            event.ack()
+            return
 
-            async with set_correlation_id(validated_correlation_id):
-                with open(validated_payload.file_id, "w", encoding="utf-8") as file:
-                    file.write(
-                        f"The name of this file is {validated_payload.file_id}\n"
-                        + f"{validated_correlation_id}"
+        context = CorrelationContext.from_event_fields(
+            event.payload, correlation_id=validated_correlation_id
+        )
+        file_id = validated_payload.file_id
+        request_key = (file_id, context.correlation_id)
+        async with set_correlation_context(context):
+            status, size = "failed", None
+            try:
+                if request_key in self._handled_requests:
+                    status = "duplicate"
+                elif file_id in self._staged_files:
+                    await self._data_repository.mark_staged(file_id)
+                    status = "recently_staged"
+                else:
+                    size = await self._data_repository.stage_file(file_id)
+                    self._staged_files.add(file_id)
+                    status = "staged"
+                self._handled_requests.add(request_key)
+                if status != "staged":
+                    skipped_events.inc(reason=status)
+            except Exception as error:
+                log.exception("Attempt %i to stage %s failed", event.attempt, file_id)
+                if (
+                    self._timer_wheel is not None
+                    and event.attempt <= self._config.staging_max_retries
+                ):
+                    status = "retrying"
+                    self._schedule_retry(event)
+                else:
+                    await self._data_repository.mark_failed(file_id)
+                    await self._dead_letter(
+                        event, correlation_id=context.correlation_id, error=error
                     )
+            finally:
+                if status != "retrying":
+                    event.ack()
+                log_access(
+                    kind="event",
+                    route=route,
+                    status=status,
+                    started=started,
+                    size=size,
+                    file_id=file_id,
+                    attempt=event.attempt,
+                )
 
-        except EventSchemaValidationError:
-            log.error(
-                "Schema validation failed for %s", NonStagedFileRequested.__name__
-            )
+    def _get_priority(self, payload: JsonObject) -> str:
+        """Get the priority class of a request from the event or its baggage."""
+        priority = payload.get("priority")
+        if not priority:
+            baggage = payload.get("baggage")
+            priority = baggage.get("priority") if isinstance(baggage, dict) else None
+        if priority in self._config.staging_priorities:
+            return str(priority)
+        return self._config.staging_default_priority
+
+    async def _submit(self, event: ReceivedEvent):
+        """Queue the staging with the scheduler or, without one, stage right away."""
+        if self._scheduler is None:
+            await self._stage_file(event)
+            return
+        await self._scheduler.put(
+            partial(self._stage_file, event),
+            priority=self._get_priority(event.payload),
+            group=str(event.payload.get("correlation_id", "")),
+        )
+
+    async def wait_until_idle(self) -> None:
+        """Wait until all queued stagings are done."""
+        if self._scheduler is not None:
+            await self._scheduler.wait_until_idle()
+
+    def has_capacity(self) -> bool:
+        """Whether a further event can be consumed without waiting."""
+        return self._scheduler is None or not self._scheduler.full
+
+    async def wait_for_capacity(self) -> None:
+        """Wait until a further event can be consumed without waiting."""
+        if self._scheduler is not None:
+            await self._scheduler.wait_until_not_full()
 
     async def _consume_validated(
         self,
@@ -86,4 +482,8 @@ class EventSubTranslator(EventSubscriberProtocol):
         topic: Ascii,
     ) -> None:
         if type_ == self._config.nonstaged_file_requested_type:
-            await self._stage_file(payload=payload)
+            await self._submit(
+                ReceivedEvent(
+                    payload=payload, type_=type_, topic=topic, ack=defer_ack()
+                )
+            )
@@ -0,0 +1,254 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Admission control for the REST API.
+
+Requests beyond a concurrency limit wait in a priority queue for a bounded time and
+are shed with a 503 response if no capacity frees up. The limit adapts to the
+observed latency: it grows additively while requests complete within the latency
+target and shrinks multiplicatively when they don't (AIMD).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+from time import perf_counter
+from typing import Optional
+
+from fastapi import Request, Response, status
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.adapters.inbound.fastapi_.health import is_health_probe
+from pci.adapters.inbound.fastapi_.responses import FastJSONResponse
+from pci.context_vars import CORRELATION_ID_HEADER_NAME, get_correlation_id
+from pci.metrics import counter, gauge, histogram
+
+log = logging.getLogger(__name__)
+
+admission_decisions = counter(
+    "pci_admission_decisions_total",
+    "Requests admitted or shed by the admission control.",
+    labels=("outcome", "reason"),
+)
+admission_limit = gauge(
+    "pci_admission_limit", "The current concurrency limit of the REST API."
+)
+admission_in_flight = gauge(
+    "pci_admission_in_flight", "Admitted requests currently being handled."
+)
+admission_queued = gauge("pci_admission_queued", "Requests waiting to be admitted.")
+admission_queue_seconds = histogram(
+    "pci_admission_queue_seconds", "Time requests waited to be admitted."
+)
+
+
+class AdmissionConfig(BaseSettings):
+    """Config for the admission control of the REST API."""
+
+    admission_control_enabled: bool = Field(
+        default=True,
+        description="Whether requests beyond the concurrency limit are queued or shed.",
+    )
+    admission_initial_limit: int = Field(
+        default=100, description="The concurrency limit to start with."
+    )
+    admission_min_limit: int = Field(
+        default=10, description="The lowest the concurrency limit can drop to."
+    )
+    admission_max_limit: int = Field(
+        default=1000, description="The highest the concurrency limit can grow to."
+    )
+    admission_latency_target: float = Field(
+        default=0.5,
+        description=(
+            "Requests taking longer than this many seconds, or failing with a server"
+            + " error, lower the concurrency limit."
+        ),
+    )
+    admission_backoff_ratio: float = Field(
+        default=0.9,
+        description="The factor the concurrency limit is multiplied with when lowered.",
+    )
+    admission_queue_timeout: float = Field(
+        default=1.0,
+        description="The number of seconds a request waits to be admitted.",
+    )
+    admission_max_queue: int = Field(
+        default=1000,
+        description="Requests are shed right away when this many are waiting.",
+    )
+    admission_priority_header: Optional[str] = Field(
+        default=None,
+        examples=["X-Request-Priority"],
+        description=(
+            "A request header carrying an integer priority. Requests with higher"
+            + " priorities are admitted first. Only set this if the header is"
+            + " controlled by trusted clients or a gateway."
+        ),
+    )
+    admission_route_priorities: dict[str, int] = Field(
+        default_factory=dict,
+        examples=[{"/staging/": -1}],
+        description=(
+            "Priorities of requests by path prefix, used if the priority header is"
+            + " not set. The longest matching prefix applies; the default is 0."
+        ),
+    )
+
+
+class AdmissionController:
+    """Limits the number of requests handled concurrently."""
+
+    def __init__(self, *, config: AdmissionConfig):
+        self._config = config
+        self._limit = float(config.admission_initial_limit)
+        self._in_flight = 0
+        # waiting requests as (negated priority, arrival, future), cancelled futures
+        # are left in the heap and skipped
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._queued = 0
+        self._arrivals = itertools.count()
+        self._last_decrease = 0.0
+        self._route_priorities = sorted(
+            config.admission_route_priorities.items(),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        admission_limit.set(self._limit)
+
+    @property
+    def limit(self) -> int:
+        """The current concurrency limit."""
+        return int(self._limit)
+
+    def get_priority(self, request: Request) -> int:
+        """Determine the priority of a request from its header or its route."""
+        header = self._config.admission_priority_header
+        if header is not None:
+            try:
+                return int(request.headers[header])
+            except (KeyError, ValueError):
+                pass
+        for prefix, priority in self._route_priorities:
+            if request.url.path.startswith(prefix):
+                return priority
+        return 0
+
+    def _take_slot(self):
+        """Count a request as in flight."""
+        self._in_flight += 1
+        admission_in_flight.set(self._in_flight)
+
+    def _admit_waiters(self):
+        """Admit waiting requests by priority while there is capacity."""
+        while self._waiters and self._in_flight < self.limit:
+            *_, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._queued -= 1
+            self._take_slot()
+            future.set_result(None)
+        admission_queued.set(self._queued)
+
+    async def acquire(self, priority: int = 0) -> Optional[str]:
+        """Wait to be admitted, return None if admitted or the reason for shedding."""
+        if self._in_flight < self.limit and not self._queued:
+            self._take_slot()
+            return None
+        if self._queued >= self._config.admission_max_queue:
+            return "queue_full"
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._arrivals), future))
+        self._queued += 1
+        admission_queued.set(self._queued)
+        started = perf_counter()
+        try:
+            await asyncio.wait_for(future, timeout=self._config.admission_queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if future.done() and not future.cancelled():
+                # admitted just as the wait ended
+                if isinstance(error, asyncio.TimeoutError):
+                    return None
+                self.release(latency=0.0, overloaded=False)
+            else:
+                future.cancel()
+                self._queued -= 1
+                admission_queued.set(self._queued)
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            return "queue_timeout"
+        finally:
+            admission_queue_seconds.observe(perf_counter() - started)
+        return None
+
+    def release(self, *, latency: float, overloaded: bool) -> None:
+        """Free the slot of a completed request and adapt the limit."""
+        self._in_flight -= 1
+        admission_in_flight.set(self._in_flight)
+        config = self._config
+        now = perf_counter()
+        if overloaded or latency > config.admission_latency_target:
+            # decrease at most once per latency target to not overreact to requests
+            # that were in flight together
+            if now - self._last_decrease > config.admission_latency_target:
+                self._last_decrease = now
+                self._limit = max(
+                    float(config.admission_min_limit),
+                    self._limit * config.admission_backoff_ratio,
+                )
+        elif self._in_flight + 1 >= self._limit / 2:
+            self._limit = min(
+                float(config.admission_max_limit), self._limit + 1 / self._limit
+            )
+        admission_limit.set(self._limit)
+        self._admit_waiters()
+
+    async def dispatch(self, request: Request, call_next) -> Response:
+        """Admit, queue or shed the request.
+
+        Shed requests get a 503 response carrying the correlation ID. Health probes
+        are always admitted right away.
+        """
+        if is_health_probe(request):
+            return await call_next(request)
+        reason = await self.acquire(self.get_priority(request))
+        if reason is not None:
+            admission_decisions.inc(outcome="shed", reason=reason)
+            correlation_id = get_correlation_id()
+            log.warning("Shed request %s (%s)", correlation_id, reason)
+            return FastJSONResponse(
+                content={
+                    "detail": "The service is overloaded, please retry later.",
+                    "correlation_id": correlation_id,
+                },
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={
+                    CORRELATION_ID_HEADER_NAME: correlation_id,
+                    "Retry-After": "1",
+                },
+            )
+        admission_decisions.inc(outcome="admitted", reason="")
+        started = perf_counter()
+        overloaded = True
+        try:
+            response = await call_next(request)
+            overloaded = response.status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR
+            return response
+        finally:
+            self.release(latency=perf_counter() - started, overloaded=overloaded)
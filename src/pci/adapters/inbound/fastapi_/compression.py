@@ -0,0 +1,336 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Negotiated compression of file responses.
+
+The body of a file response is rendered as a small per-request prefix holding the
+correlation ID followed by the JSON encoded file content. The content part is
+compressed once per file and cached, only the prefix is compressed per request:
+
+- gzip: the prefix is compressed into a raw deflate stream ending on a byte boundary,
+  followed by the cached deflate stream of the content. Both are wrapped into a
+  single gzip member with the combined CRC32.
+- zstd: the prefix and the cached content are separate frames, which decoders
+  concatenate.
+- br: brotli streams cannot be joined, so responses are compressed per request.
+
+zstd and brotli are only offered if the `zstandard` and `brotli` packages are
+installed, as with the `fast` extra (`pip install pci[fast]`).
+"""
+
+import asyncio
+import struct
+import zlib
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from fastapi import Request, Response, status
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.adapters.inbound.fastapi_.responses import (
+    FastJSONResponse,
+    render_file_response,
+)
+from pci.metrics import counter, histogram
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    HAS_ZSTANDARD = False
+else:
+    HAS_ZSTANDARD = True
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    HAS_BROTLI = False
+else:
+    HAS_BROTLI = True
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+CRC32_POLYNOMIAL = 0xEDB88320
+
+compressed_bytes = counter(
+    "pci_compressed_bytes_total",
+    "Bytes of file responses before and after compression.",
+    labels=("encoding", "stage"),
+)
+compression_ratio = histogram(
+    "pci_compression_ratio",
+    "The compressed size of file responses relative to their original size.",
+    labels=("encoding",),
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+precompressed_lookups = counter(
+    "pci_precompressed_lookups_total",
+    "Lookups of precompressed file content.",
+    labels=("encoding", "outcome"),
+)
+
+
+class CompressionConfig(BaseSettings):
+    """Config for the compression of file responses."""
+
+    compression_enabled: bool = Field(
+        default=True,
+        description="Whether file responses are compressed if the client accepts it.",
+    )
+    compression_min_size: int = Field(
+        default=1024,
+        description="File responses smaller than this many bytes are not compressed.",
+    )
+    compression_max_size: int = Field(
+        default=64 * 1024 * 1024,
+        description="File responses larger than this many bytes are not compressed.",
+    )
+    compression_cache_size: int = Field(
+        default=256 * 1024 * 1024,
+        description=(
+            "The number of bytes of precompressed file content kept in memory. The"
+            + " least recently used content is dropped first."
+        ),
+    )
+    gzip_level: int = Field(default=6, description="The gzip compression level.")
+    zstd_level: int = Field(default=3, description="The zstd compression level.")
+    brotli_quality: int = Field(default=4, description="The brotli quality level.")
+
+
+def _gf2_matrix_times(matrix: list[int], vector: int) -> int:
+    """Multiply a 32x32 matrix over GF(2) with a vector."""
+    result = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return result
+
+
+def _gf2_matrix_square(matrix: list[int]) -> list[int]:
+    """Square a 32x32 matrix over GF(2)."""
+    return [_gf2_matrix_times(matrix, matrix[row]) for row in range(32)]
+
+
+def crc32_combine(crc1: int, crc2: int, length2: int) -> int:
+    """Combine the CRC32 of two byte strings given the length of the second one.
+
+    A port of zlib's `crc32_combine`, which the zlib module does not expose.
+    """
+    if length2 <= 0:
+        return crc1
+    # operator for one zero bit, then for two and four zero bits
+    odd = [CRC32_POLYNOMIAL] + [1 << row for row in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    # apply length2 zero bytes to crc1
+    while True:
+        even = _gf2_matrix_square(odd)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+        odd = _gf2_matrix_square(even)
+        if length2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+    return crc1 ^ crc2
+
+
+class _Precompressed(NamedTuple):
+    """Compressed content along with the checksum and size of the original."""
+
+    data: bytes
+    crc: int
+    size: int
+
+
+class ResponseCompressor:
+    """Compresses file responses in the encoding preferred by the client."""
+
+    def __init__(self, *, config: CompressionConfig):
+        self._config = config
+        self._cache: OrderedDict[tuple[str, str], _Precompressed] = OrderedDict()
+        self._cache_bytes = 0
+        self.encodings = ["gzip"]
+        if HAS_ZSTANDARD:
+            self.encodings.insert(0, "zstd")
+        if HAS_BROTLI:
+            self.encodings.append("br")
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        """Choose the encoding with the highest quality value accepted by the client,
+        ties are broken by the order of `encodings`.
+        """
+        qualities: dict[str, float] = {}
+        for item in accept_encoding.lower().split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = 1.0
+            name, _, value = params.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+            qualities[coding.strip()] = quality
+        wildcard = qualities.get("*", 0.0)
+        ranked = sorted(
+            (
+                (-qualities.get(encoding, wildcard), rank, encoding)
+                for rank, encoding in enumerate(self.encodings)
+            ),
+        )
+        quality, _, encoding = ranked[0]
+        return encoding if quality < 0 else None
+
+    def _compress_deflate(self, data: bytes, *, final: bool) -> bytes:
+        """Compress data into a raw deflate stream, byte aligned unless final."""
+        compressor = zlib.compressobj(self._config.gzip_level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH
+        )
+
+    def _compress(self, data: bytes, encoding: str, *, final: bool = True) -> bytes:
+        """Compress data in one of the supported encodings."""
+        if encoding == "gzip":
+            return self._compress_deflate(data, final=final)
+        if encoding == "zstd":
+            return zstandard.ZstdCompressor(level=self._config.zstd_level).compress(
+                data
+            )
+        return brotli.compress(data, quality=self._config.brotli_quality)
+
+    def _cache_get(self, key: tuple[str, str], crc: int, size: int):
+        """Get precompressed content if it matches the original."""
+        cached = self._cache.get(key)
+        if cached is None or cached.crc != crc or cached.size != size:
+            return None
+        self._cache.move_to_end(key)
+        return cached
+
+    def _cache_put(self, key: tuple[str, str], precompressed: _Precompressed):
+        """Cache precompressed content, dropping the least recently used."""
+        if len(precompressed.data) > self._config.compression_cache_size:
+            return
+        replaced = self._cache.pop(key, None)
+        if replaced is not None:
+            self._cache_bytes -= len(replaced.data)
+        self._cache[key] = precompressed
+        self._cache_bytes += len(precompressed.data)
+        while self._cache_bytes > self._config.compression_cache_size:
+            _, dropped = self._cache.popitem(last=False)
+            self._cache_bytes -= len(dropped.data)
+
+    def invalidate(self, file_id: str) -> None:
+        """Drop the precompressed content of a file."""
+        for encoding in self.encodings:
+            dropped = self._cache.pop((file_id, encoding), None)
+            if dropped is not None:
+                self._cache_bytes -= len(dropped.data)
+
+    async def _precompress(
+        self, *, file_id: str, content: bytes, encoding: str
+    ) -> _Precompressed:
+        """Get the compressed content from the cache or compress it in a thread.
+
+        The checksum validating the cached content is computed in a thread as well,
+        as it takes a while for large files.
+        """
+        key = (file_id, encoding)
+        crc = await asyncio.to_thread(zlib.crc32, content)
+        cached = self._cache_get(key, crc, len(content))
+        if cached is not None:
+            precompressed_lookups.inc(encoding=encoding, outcome="hit")
+            return cached
+        precompressed_lookups.inc(encoding=encoding, outcome="miss")
+        data = await asyncio.to_thread(self._compress, content, encoding)
+        precompressed = _Precompressed(data=data, crc=crc, size=len(content))
+        self._cache_put(key, precompressed)
+        return precompressed
+
+    def _gzip_member(self, prefix: bytes, precompressed: _Precompressed) -> bytes:
+        """Wrap the compressed prefix and the precompressed content into one gzip
+        member with their combined checksum.
+        """
+        crc = crc32_combine(zlib.crc32(prefix), precompressed.crc, precompressed.size)
+        trailer = struct.pack("<II", crc, (len(prefix) + precompressed.size) % 2**32)
+        return (
+            GZIP_HEADER
+            + self._compress_deflate(prefix, final=False)
+            + precompressed.data
+            + trailer
+        )
+
+    async def compress(
+        self, *, file_id: str, prefix: bytes, content: bytes, encoding: str
+    ) -> bytes:
+        """Compress the prefix followed by the content, reusing the compressed content
+        if it was compressed before.
+        """
+        if encoding == "br":
+            return await asyncio.to_thread(self._compress, prefix + content, encoding)
+        precompressed = await self._precompress(
+            file_id=file_id, content=content, encoding=encoding
+        )
+        if encoding == "zstd":
+            return self._compress(prefix, encoding) + precompressed.data
+        return await asyncio.to_thread(self._gzip_member, prefix, precompressed)
+
+    async def file_response(
+        self, request: Request, *, file_id: str, correlation_id: str, file_content: str
+    ) -> Response:
+        """Create the JSON response for a file, compressed if the client accepts it
+        and its size is within the configured thresholds.
+        """
+        headers = {"Vary": "Accept-Encoding"}
+        encoding = self.negotiate(request.headers.get("accept-encoding", ""))
+        if encoding is None:
+            return FastJSONResponse(
+                content={
+                    "correlation_id": correlation_id,
+                    "file_content": file_content,
+                },
+                headers=headers,
+            )
+
+        prefix, content = render_file_response(
+            correlation_id=correlation_id, file_content=file_content
+        )
+        size = len(prefix) + len(content)
+        if (
+            self._config.compression_min_size
+            <= size
+            <= self._config.compression_max_size
+        ):
+            body = await self.compress(
+                file_id=file_id, prefix=prefix, content=content, encoding=encoding
+            )
+            headers["Content-Encoding"] = encoding
+            compressed_bytes.inc(size, encoding=encoding, stage="original")
+            compressed_bytes.inc(len(body), encoding=encoding, stage="compressed")
+            compression_ratio.observe(len(body) / size, encoding=encoding)
+        else:
+            body = prefix + content
+        return Response(
+            content=body,
+            status_code=status.HTTP_200_OK,
+            media_type="application/json",
+            headers=headers,
+        )
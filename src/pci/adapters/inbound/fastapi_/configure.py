@@ -15,20 +15,46 @@
 #
 """Utils to configure the FastAPI app"""
 
+from typing import Optional
+
 from fastapi import FastAPI
 from ghga_service_commons.api import configure_app
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from pci.adapters.inbound.fastapi_ import health
+from pci.adapters.inbound.fastapi_.admission import AdmissionController
+from pci.adapters.inbound.fastapi_.compression import ResponseCompressor
+from pci.adapters.inbound.fastapi_.rate_limit import RateLimiter
+from pci.adapters.inbound.fastapi_.responses import FastJSONResponse
 from pci.adapters.inbound.fastapi_.routes import router
 from pci.adapters.inbound.fastapi_.utils import correlation_id_middleware
 from pci.config import Config
+from pci.ports.outbound.token_buckets import TokenBucketPort
+
 
+def get_configured_app(
+    *, config: Config, token_buckets: Optional[TokenBucketPort] = None
+) -> FastAPI:
+    """Create and configure a REST API application.
 
-def get_configured_app(*, config: Config) -> FastAPI:
-    """Create and configure a REST API application."""
-    app = FastAPI()
+    Clients are rate limited if token buckets are provided.
+    """
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.include_router(health.router)
     app.include_router(router)
     configure_app(app, config=config)
+    if config.compression_enabled:
+        app.state.response_compressor = ResponseCompressor(config=config)
+
+    # added before the correlation ID middleware so that they run inside of it,
+    # rate limiting first to not queue requests that will be rejected anyway
+    if config.admission_control_enabled:
+        admission_controller = AdmissionController(config=config)
+        app.state.admission_controller = admission_controller
+        app.add_middleware(BaseHTTPMiddleware, dispatch=admission_controller.dispatch)
+    if token_buckets is not None:
+        rate_limiter = RateLimiter(config=config, token_buckets=token_buckets)
+        app.add_middleware(BaseHTTPMiddleware, dispatch=rate_limiter.dispatch)
 
     # move to "configure app"
     app.add_middleware(BaseHTTPMiddleware, dispatch=correlation_id_middleware)
@@ -0,0 +1,133 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Health endpoints of the REST API.
+
+Health probes bypass the correlation ID, admission control and rate limiting
+middlewares, so they neither write to the access log nor get shed or limited.
+"""
+
+import asyncio
+import logging
+from collections.abc import Awaitable, Mapping
+from time import monotonic
+from typing import Callable, Optional
+
+from fastapi import APIRouter, Request, status
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.adapters.inbound.fastapi_.responses import FastJSONResponse
+
+log = logging.getLogger(__name__)
+
+HEALTH_PATH_PREFIX = "/health/"
+
+# checks whether a dependency of the app is available
+HealthCheck = Callable[[], Awaitable[bool]]
+
+router = APIRouter(prefix="/health")
+
+
+class HealthConfig(BaseSettings):
+    """Config for the health endpoints."""
+
+    health_cache_ttl: float = Field(
+        default=5.0,
+        description=(
+            "The number of seconds the results of the readiness checks are reused."
+        ),
+    )
+    health_check_timeout: float = Field(
+        default=2.0,
+        description="A readiness check failing to finish in this many seconds fails.",
+    )
+
+
+def is_health_probe(request: Request) -> bool:
+    """Whether the request is for one of the health endpoints."""
+    path = request.scope["path"]
+    root_path = request.scope.get("root_path", "").rstrip("/")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path) :]
+    return path.startswith(HEALTH_PATH_PREFIX)
+
+
+class CachedHealthChecks:
+    """Runs named health checks concurrently and caches their results.
+
+    Probes arriving while the checks are running wait for the same results.
+    """
+
+    def __init__(self, *, config: HealthConfig, checks: Mapping[str, HealthCheck]):
+        self._config = config
+        self._checks = dict(checks)
+        self._results: dict[str, bool] = {}
+        self._valid_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _run_check(self, name: str, check: HealthCheck) -> bool:
+        """Run a check, treating errors and timeouts as failures."""
+        try:
+            return await asyncio.wait_for(
+                check(), timeout=self._config.health_check_timeout
+            )
+        except Exception as error:
+            log.warning("Health check %s failed: %r", name, error)
+            return False
+
+    async def run(self) -> dict[str, bool]:
+        """Get the results of all checks, running them if the cached ones expired."""
+        async with self._lock:
+            if monotonic() >= self._valid_until:
+                results = await asyncio.gather(
+                    *(
+                        self._run_check(name, check)
+                        for name, check in self._checks.items()
+                    )
+                )
+                self._results = dict(zip(self._checks, results))
+                self._valid_until = monotonic() + self._config.health_cache_ttl
+            return self._results
+
+
+@router.get("/live")
+async def live():
+    """Report that the service is running, without checking its dependencies."""
+    return {"status": "alive"}
+
+
+@router.get(
+    "/ready",
+    responses={
+        status.HTTP_503_SERVICE_UNAVAILABLE: {
+            "description": "At least one dependency is not available."
+        }
+    },
+)
+async def ready(request: Request):
+    """Report whether the dependencies of the service are available."""
+    health_checks: Optional[CachedHealthChecks] = getattr(
+        request.app.state, "health_checks", None
+    )
+    checks = {} if health_checks is None else await health_checks.run()
+    is_ready = all(checks.values())
+    return FastJSONResponse(
+        content={"status": "ready" if is_ready else "not ready", "checks": checks},
+        status_code=(
+            status.HTTP_200_OK if is_ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        ),
+    )
@@ -0,0 +1,133 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Per-client rate limiting for the REST API."""
+
+import logging
+from math import ceil
+from typing import Optional
+
+from fastapi import Request, Response, status
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.adapters.inbound.fastapi_.health import is_health_probe
+from pci.adapters.inbound.fastapi_.responses import FastJSONResponse
+from pci.context_vars import CORRELATION_ID_HEADER_NAME, get_correlation_id
+from pci.metrics import counter
+from pci.ports.outbound.token_buckets import TokenBucketPort
+
+log = logging.getLogger(__name__)
+
+rate_limited_requests = counter(
+    "pci_rate_limited_requests_total",
+    "Requests rejected because the client exceeded a rate limit.",
+    labels=("limit",),
+)
+
+
+class RateLimitConfig(BaseSettings):
+    """Config for the per-client rate limits of the REST API."""
+
+    rate_limit_enabled: bool = Field(
+        default=False,
+        description=(
+            "Whether clients are limited in how many requests they make and how many"
+            + " staging events they trigger."
+        ),
+    )
+    rate_limit_client_header: Optional[str] = Field(
+        default=None,
+        examples=["X-Forwarded-For"],
+        description=(
+            "A request header identifying the client, e.g. set by a reverse proxy."
+            + " Of comma separated values, the one appended by the outermost trusted"
+            + " proxy is used, as the values before it are controlled by the client."
+            + " If not set, clients are identified by their address."
+        ),
+    )
+    rate_limit_trusted_hops: int = Field(
+        default=1,
+        ge=1,
+        description=(
+            "The number of trusted proxies appending to the client header. The value"
+            + " this many positions from the end of the header identifies the client."
+        ),
+    )
+    request_rate_limit: float = Field(
+        default=20.0,
+        description="The number of requests a client may make per second on average.",
+    )
+    request_burst_limit: int = Field(
+        default=100, description="The number of requests a client may make at once."
+    )
+
+
+def rate_limit_response(*, limit: str, retry_after: float) -> Response:
+    """Create a 429 response carrying the correlation ID."""
+    rate_limited_requests.inc(limit=limit)
+    correlation_id = get_correlation_id()
+    return FastJSONResponse(
+        content={
+            "detail": f"The {limit} rate limit was exceeded, please retry later.",
+            "correlation_id": correlation_id,
+        },
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={
+            CORRELATION_ID_HEADER_NAME: correlation_id,
+            "Retry-After": str(ceil(retry_after)),
+        },
+    )
+
+
+class RateLimiter:
+    """Limits the requests per client with token buckets.
+
+    The client ID is stored in the request state, so that the routes can limit the
+    staging events triggered by the client as well.
+    """
+
+    def __init__(self, *, config: RateLimitConfig, token_buckets: TokenBucketPort):
+        self._config = config
+        self._token_buckets = token_buckets
+
+    def get_client_id(self, request: Request) -> str:
+        """Identify the client by the configured header or by its address."""
+        header = self._config.rate_limit_client_header
+        if header is not None and (value := request.headers.get(header)):
+            hops = value.split(",")
+            return hops[
+                max(len(hops) - self._config.rate_limit_trusted_hops, 0)
+            ].strip()
+        return request.client.host if request.client else "unknown"
+
+    async def dispatch(self, request: Request, call_next) -> Response:
+        """Reject the request with a 429 response if the client has exceeded the
+        request rate limit. Health probes are not limited.
+        """
+        if is_health_probe(request):
+            return await call_next(request)
+        client_id = self.get_client_id(request)
+        request.state.client_id = client_id
+        retry_after = await self._token_buckets.take(
+            f"requests:{client_id}",
+            rate=self._config.request_rate_limit,
+            burst=self._config.request_burst_limit,
+        )
+        if retry_after:
+            log.warning("Client %s exceeded the request rate limit", client_id)
+            return rate_limit_response(limit="request", retry_after=retry_after)
+        return await call_next(request)
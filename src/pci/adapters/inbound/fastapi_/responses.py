@@ -0,0 +1,77 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Fast rendering of JSON responses.
+
+JSON is rendered with orjson if it is installed, as with the `fast` extra, falling back
+to the standard library otherwise and for content orjson rejects, such as integers
+beyond 64 bit.
+"""
+
+import json
+import re
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    HAS_ORJSON = False
+else:
+    HAS_ORJSON = True
+
+# strings consisting of these characters need no escaping, e.g. UUIDs
+SAFE_STRING = re.compile(r"[0-9A-Za-z_.-]*")
+
+
+def dumps_json(content: Any) -> bytes:
+    """Render content as compact UTF-8 encoded JSON."""
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            pass
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def dumps_json_string(value: str) -> bytes:
+    """Render a string as JSON, skipping the encoder if no escaping is needed."""
+    if SAFE_STRING.fullmatch(value):
+        return b'"' + value.encode("ascii") + b'"'
+    return dumps_json(value)
+
+
+class FastJSONResponse(JSONResponse):
+    """A JSONResponse rendered with orjson if it is installed."""
+
+    def render(self, content: Any) -> bytes:
+        """Render the content as compact UTF-8 encoded JSON."""
+        return dumps_json(content)
+
+
+def render_file_response(
+    *, correlation_id: str, file_content: str
+) -> tuple[bytes, bytes]:
+    """Render the JSON body of a file response without building a dict.
+
+    The body is returned in two parts, the prefix holding the correlation ID and the
+    file content, so that the content can be processed separately, e.g. compressed.
+    """
+    prefix = b'{"correlation_id":%s,"file_content":' % dumps_json_string(correlation_id)
+    return prefix, dumps_json(file_content) + b"}"
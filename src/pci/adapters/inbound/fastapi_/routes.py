@@ -15,16 +15,65 @@
 #
 """API endpoints"""
 
-from fastapi import APIRouter, Request, status
-from fastapi.responses import JSONResponse
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request, status
+from fastapi.responses import RedirectResponse
 
 from pci.adapters.inbound.fastapi_.dummies import DataRepositoryDummy
-from pci.context_vars import get_correlation_id
+from pci.adapters.inbound.fastapi_.rate_limit import rate_limit_response
+from pci.adapters.inbound.fastapi_.responses import FastJSONResponse
+from pci.context_vars import CORRELATION_ID_HEADER_NAME, get_correlation_id
+from pci.models import StagingRecord, StagingStatus
+from pci.ports.inbound.data_repository import DataRepositoryPort
+from pci.ports.outbound.staging_ledger import StagingLedgerPort
 
 router = APIRouter()
 
 
-@router.get("/{file_id}")
+@router.get(
+    "/staging/requests",
+    response_model=list[StagingRecord],
+    responses={
+        status.HTTP_422_UNPROCESSABLE_ENTITY: {
+            "description": "Neither a file ID nor a correlation ID was specified."
+        }
+    },
+)
+async def find_staging_requests(
+    data_repository: DataRepositoryDummy,
+    file_id: Optional[str] = None,
+    correlation_id: Optional[str] = None,
+    staging_status: Optional[StagingStatus] = None,
+):
+    """Look up the staging requests made for a file or under a correlation ID."""
+    try:
+        return await data_repository.find_staging_records(
+            file_id=file_id, correlation_id=correlation_id, status=staging_status
+        )
+    except StagingLedgerPort.MissingLookupKeyError as error:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(error)
+        ) from error
+
+
+@router.get(
+    "/{file_id}",
+    responses={
+        status.HTTP_307_TEMPORARY_REDIRECT: {
+            "description": (
+                "The file is staged and can be downloaded from the file storage"
+                + " directly. Only if download redirects are enabled."
+            )
+        },
+        status.HTTP_429_TOO_MANY_REQUESTS: {
+            "description": (
+                "The client exceeded its request or staging rate limit. Only if rate"
+                + " limiting is enabled."
+            )
+        },
+    },
+)
 async def request_file(
     request: Request,
     file_id: str,
@@ -33,9 +82,32 @@ async def request_file(
     """Handle a request for a given file ID."""
     # correlation ID can be retrieved from the request header or from the ContextVar
     correlation_id = get_correlation_id()
-    file_content = await data_repository.handle_request(file_id=file_id)
 
-    return JSONResponse(
+    download_url = await data_repository.get_download_url(file_id=file_id)
+    if download_url is not None:
+        return RedirectResponse(
+            download_url,
+            status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+            headers={CORRELATION_ID_HEADER_NAME: correlation_id},
+        )
+
+    try:
+        file_content = await data_repository.handle_request(
+            file_id=file_id, client_id=getattr(request.state, "client_id", None)
+        )
+    except DataRepositoryPort.StagingRateLimitError as error:
+        return rate_limit_response(limit="staging", retry_after=error.retry_after)
+
+    compressor = getattr(request.app.state, "response_compressor", None)
+    if compressor is not None:
+        return await compressor.file_response(
+            request,
+            file_id=file_id,
+            correlation_id=correlation_id,
+            file_content=file_content,
+        )
+
+    return FastJSONResponse(
         content={
             "correlation_id": correlation_id,
             "file_content": file_content,
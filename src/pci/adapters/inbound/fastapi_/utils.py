@@ -19,13 +19,18 @@ This should probably be moved to ghga-service-commons and used in the configure_
 function or somewhere similar.
 """
 import logging
+from time import perf_counter
 from uuid import UUID, uuid4
 
 from fastapi import Request
 
-from pci.context_vars import set_correlation_id
-
-CORRELATION_ID_HEADER_NAME = "X-Correlation-ID"
+from pci.access_log import log_access
+from pci.adapters.inbound.fastapi_.health import is_health_probe
+from pci.context_vars import (
+    CORRELATION_ID_HEADER_NAME,
+    CorrelationContext,
+    set_correlation_context,
+)
 
 log = logging.getLogger()
 
@@ -77,19 +82,55 @@ def get_validated_correlation_id(correlation_id: str) -> str:
 async def correlation_id_middleware(request: Request, call_next):
     """Ensure request header has a valid correlation ID.
 
-    Set the correlation ID ContextVar before passing on the request.
+    Set the correlation context ContextVar before passing on the request. The span ID
+    sent by the caller, if any, becomes the parent of the context of this request.
+    Every request is written to the access log, except for health probes, which are
+    passed on right away.
 
     Raises:
         InvalidCorrelationIdError: If a correlation ID exists and is invalid.
     """
+    if is_health_probe(request):
+        return await call_next(request)
+
+    started = perf_counter()
     correlation_id = request.headers.get(CORRELATION_ID_HEADER_NAME, "")
 
     # If a correlation ID exists, validate it. If not, generate a new one.
-    validated_correlation_id = get_validated_correlation_id(correlation_id)
+    try:
+        validated_correlation_id = get_validated_correlation_id(correlation_id)
+    except InvalidCorrelationIdError:
+        log_access(
+            kind="request",
+            route=request.url.path,
+            status="invalid",
+            started=started,
+            correlation_id=correlation_id,
+            method=request.method,
+        )
+        raise
     if validate_correlation_id != correlation_id:
         set_header_correlation_id(request, validated_correlation_id)
 
-    # Set the correlation ID ContextVar
-    async with set_correlation_id(validated_correlation_id):
-        response = await call_next(request)
-        return response
+    # Set the correlation context ContextVar
+    context = CorrelationContext.from_headers(
+        request.headers, correlation_id=validated_correlation_id
+    )
+    async with set_correlation_context(context):
+        status_code = 500
+        content_length = None
+        try:
+            response = await call_next(request)
+            status_code = response.status_code
+            content_length = response.headers.get("content-length")
+            return response
+        finally:
+            route = request.scope.get("route")
+            log_access(
+                kind="request",
+                route=getattr(route, "path", request.url.path),
+                status=status_code,
+                started=started,
+                size=int(content_length) if content_length else None,
+                method=request.method,
+            )
@@ -0,0 +1,399 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A Kafka event subscriber reporting consumer lag and throughput and committing
+the offsets of handled events only.
+"""
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager, suppress
+from functools import partial
+from time import monotonic, perf_counter
+from typing import Optional
+
+from aiokafka import AIOKafkaConsumer, TopicPartition
+from aiokafka.errors import KafkaError
+from hexkit.protocols.eventsub import EventSubscriberProtocol
+from hexkit.providers.akafka import KafkaConfig, KafkaEventSubscriber
+from hexkit.providers.akafka.provider import (
+    ConsumerEvent,
+    EventTypeNotFoundError,
+    generate_client_id,
+    generate_ssl_context,
+    get_event_type,
+)
+from pydantic import Field
+
+from pci.adapters.inbound.event_acks import acknowledge_when_done
+from pci.metrics import counter, gauge, histogram
+
+log = logging.getLogger(__name__)
+
+consumed_events = counter(
+    "pci_consumed_events_total",
+    "Events received by the consumer.",
+    labels=("topic", "type", "outcome"),
+)
+events_in_flight = gauge("pci_events_in_flight", "Events currently being processed.")
+event_processing_seconds = histogram(
+    "pci_event_processing_seconds",
+    "Time spent processing an event.",
+    labels=("type",),
+)
+consumer_lag = gauge(
+    "pci_consumer_lag",
+    "The number of events in a partition that have not been consumed yet.",
+    labels=("topic", "partition"),
+)
+consumer_throughput = gauge(
+    "pci_consumer_events_per_second",
+    "The number of events consumed per second, averaged over the last interval.",
+)
+
+unacknowledged_events = gauge(
+    "pci_unacknowledged_events",
+    "Events received by the consumer whose handling has not been completed yet.",
+)
+committed_offsets = counter(
+    "pci_offset_commits_total",
+    "Attempts to commit the offsets of handled events.",
+    labels=("outcome",),
+)
+consumer_paused = gauge(
+    "pci_consumer_paused",
+    "Whether fetching events is paused because the translator is at capacity.",
+)
+
+THROUGHPUT_INTERVAL = 10.0
+# how often a paused consumer polls, to not exceed the maximum poll interval
+PAUSED_POLL_INTERVAL = 1.0
+
+
+class KafkaSubscriberConfig(KafkaConfig):
+    """Config for consuming events from Kafka."""
+
+    kafka_commit_interval: float = Field(
+        default=5.0,
+        description=(
+            "The number of seconds between commits of the offsets up to which all"
+            + " events have been handled. Offsets are also committed on shutdown."
+        ),
+    )
+
+
+class _PartitionOffsets:
+    """Tracks the events received from a partition until they are acknowledged, to
+    find the offset up to which all events have been handled.
+    """
+
+    def __init__(self):
+        # the received offsets in order, with whether they have been acknowledged
+        self._received: OrderedDict[int, bool] = OrderedDict()
+        self.committable: Optional[int] = None
+        self.committed: Optional[int] = None
+
+    def __len__(self) -> int:
+        """Return the number of received events that are not committable yet."""
+        return len(self._received)
+
+    def receive(self, offset: int):
+        """Track a received event."""
+        self._received[offset] = False
+
+    def acknowledge(self, offset: int):
+        """Mark the event as handled and advance the committable offset past all
+        events handled without gaps.
+        """
+        if offset not in self._received:
+            return
+        self._received[offset] = True
+        while self._received:
+            first, acknowledged = next(iter(self._received.items()))
+            if not acknowledged:
+                break
+            self._received.popitem(last=False)
+            self.committable = first + 1
+
+
+class InstrumentedKafkaEventSubscriber(KafkaEventSubscriber):
+    """A KafkaEventSubscriber that measures the processing of every event and the lag
+    of the partition it was consumed from.
+
+    The lag is derived from the highwater mark the consumer received with its last
+    fetch from the partition. The lag and the throughput are also updated
+    periodically, so that they do not keep their last values while no events arrive.
+
+    Offsets are committed manually and only up to the first event that has not been
+    handled yet, including handling that the translator continues in the background
+    (see `defer_ack`). While the translator has no capacity for further events,
+    fetching is paused.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: KafkaSubscriberConfig,
+        translator: EventSubscriberProtocol,
+        kafka_consumer_cls: type = AIOKafkaConsumer,
+    ) -> AsyncGenerator["InstrumentedKafkaEventSubscriber", None]:
+        """Setup an InstrumentedKafkaEventSubscriber that commits offsets
+        periodically.
+
+        On teardown, the work the translator continues in the background is awaited
+        before the offsets are committed a last time and the consumer is stopped.
+
+        Args:
+            config: Config parameters needed for connecting to Apache Kafka.
+            translator: The translator the events are passed down to.
+            kafka_consumer_cls: Overwrite the Kafka consumer class for unit testing.
+        """
+        client_id = generate_client_id(
+            service_name=config.service_name, instance_id=config.service_instance_id
+        )
+        consumer = kafka_consumer_cls(
+            *translator.topics_of_interest,
+            bootstrap_servers=",".join(config.kafka_servers),
+            security_protocol=config.kafka_security_protocol,
+            ssl_context=generate_ssl_context(config),
+            client_id=client_id,
+            group_id=config.service_name,
+            auto_offset_reset="earliest",
+            enable_auto_commit=False,
+            key_deserializer=lambda event_key: event_key.decode("ascii"),
+            value_deserializer=lambda event_value: json.loads(
+                event_value.decode("ascii")
+            ),
+        )
+        await consumer.start()
+        try:
+            subscriber = cls(consumer=consumer, translator=translator)
+            tasks = [
+                asyncio.create_task(
+                    subscriber._commit_periodically(config.kafka_commit_interval)
+                ),
+                asyncio.create_task(
+                    subscriber._report_progress_periodically(THROUGHPUT_INTERVAL)
+                ),
+            ]
+            try:
+                yield subscriber
+            finally:
+                for task in tasks:
+                    task.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await task
+                await subscriber._wait_until_idle()
+                await subscriber.commit()
+        finally:
+            await consumer.stop()
+
+    def __init__(self, **kwargs):
+        """Please do not call directly! Should be called by the `construct` method."""
+        super().__init__(**kwargs)
+        self._interval_start = monotonic()
+        self._interval_events = 0
+        self._offsets: dict[TopicPartition, _PartitionOffsets] = {}
+        # the offsets of the next events to be consumed from the partitions
+        self._positions: dict[TopicPartition, int] = {}
+
+    def _update_lag(self, partition: TopicPartition):
+        """Report the number of events written to the partition after the position
+        of the consumer, according to the highwater mark of the last fetch.
+        """
+        highwater = getattr(self._consumer, "highwater", None)
+        if highwater is None or (offset := highwater(partition)) is None:
+            return
+        consumer_lag.set(
+            max(0, offset - self._positions[partition]),
+            topic=partition.topic,
+            partition=str(partition.partition),
+        )
+
+    def _report_progress(self):
+        """Report the throughput since the last report and the lag of the assigned
+        partitions.
+        """
+        now = monotonic()
+        consumer_throughput.set(self._interval_events / (now - self._interval_start))
+        self._interval_start = now
+        self._interval_events = 0
+        assignment = self._consumer.assignment()
+        for partition in list(self._positions):
+            if partition in assignment:
+                self._update_lag(partition)
+                continue
+            # the lag is reported by the new assignee
+            del self._positions[partition]
+            consumer_lag.set(
+                0, topic=partition.topic, partition=str(partition.partition)
+            )
+
+    async def _report_progress_periodically(self, interval: float):
+        """Report the throughput and the lag in the given interval."""
+        while True:
+            await asyncio.sleep(interval)
+            self._report_progress()
+
+    def _update_unacknowledged(self):
+        """Report the number of events that are not committable yet."""
+        unacknowledged_events.set(sum(map(len, self._offsets.values())))
+
+    def _acknowledge(self, offsets: _PartitionOffsets, offset: int):
+        """Mark an event as handled."""
+        offsets.acknowledge(offset)
+        self._update_unacknowledged()
+
+    async def _consume_event(self, event: ConsumerEvent) -> None:
+        """Consume an event while measuring it and tracking its handling, then wait
+        while the translator is at capacity.
+        """
+        try:
+            type_ = get_event_type(event)
+        except EventTypeNotFoundError:
+            type_ = ""
+
+        partition = TopicPartition(event.topic, event.partition)
+        offsets = self._offsets.setdefault(partition, _PartitionOffsets())
+        offsets.receive(event.offset)
+        self._update_unacknowledged()
+
+        outcome = "error"
+        started = perf_counter()
+        events_in_flight.inc()
+        try:
+            with acknowledge_when_done(
+                partial(self._acknowledge, offsets, event.offset)
+            ):
+                await super()._consume_event(event)
+            outcome = "ok"
+        finally:
+            events_in_flight.dec()
+            event_processing_seconds.observe(perf_counter() - started, type=type_)
+            consumed_events.inc(topic=event.topic, type=type_, outcome=outcome)
+            self._interval_events += 1
+            self._positions[partition] = event.offset + 1
+            self._update_lag(partition)
+        await self._wait_for_capacity()
+
+    async def _wait_for_capacity(self):
+        """Pause fetching while the translator has no capacity for further events.
+
+        The consumer keeps polling meanwhile, so that it is not considered failed for
+        exceeding the maximum poll interval and its partitions are not reassigned.
+        Events still returned by these polls are consumed once fetching is resumed.
+        """
+        has_capacity = getattr(self._translator, "has_capacity", None)
+        if has_capacity is None or has_capacity():
+            return
+        consumer_paused.set(1)
+        capacity = asyncio.ensure_future(self._translator.wait_for_capacity())
+        received: list[ConsumerEvent] = []
+        try:
+            while True:
+                # partitions may have been assigned in the meantime
+                self._consumer.pause(*self._consumer.assignment())
+                done, _ = await asyncio.wait({capacity}, timeout=PAUSED_POLL_INTERVAL)
+                if done:
+                    break
+                polled = await self._consumer.getmany(timeout_ms=0)
+                for events in polled.values():
+                    received.extend(events)
+            capacity.result()
+        finally:
+            capacity.cancel()
+            self._consumer.resume(*self._consumer.assignment())
+            consumer_paused.set(0)
+        for event in received:
+            await self._consume_event(event)
+
+    async def _wait_until_idle(self):
+        """Wait for the work the translator continues in the background."""
+        wait_until_idle = getattr(self._translator, "wait_until_idle", None)
+        if wait_until_idle is not None:
+            await wait_until_idle()
+
+    async def commit(self) -> None:
+        """Commit the offsets up to which all events have been handled.
+
+        Tracked offsets of partitions that are no longer assigned are discarded, since
+        their events will be redelivered to the new assignee anyway.
+        """
+        assignment = self._consumer.assignment()
+        to_commit: dict[TopicPartition, int] = {}
+        for partition, offsets in list(self._offsets.items()):
+            if partition not in assignment:
+                del self._offsets[partition]
+            elif offsets.committable is not None and (
+                offsets.committable != offsets.committed
+            ):
+                to_commit[partition] = offsets.committable
+        self._update_unacknowledged()
+        if not to_commit:
+            return
+        try:
+            await self._consumer.commit(to_commit)
+        except KafkaError:
+            log.warning("Failed to commit offsets", exc_info=True)
+            committed_offsets.inc(outcome="error")
+            return
+        committed_offsets.inc(outcome="ok")
+        for partition, offset in to_commit.items():
+            if partition in self._offsets:
+                self._offsets[partition].committed = offset
+
+    async def _commit_periodically(self, interval: float):
+        """Commit the offsets of handled events in the given interval."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.commit()
+
+    async def run(self, forever: bool = True) -> None:
+        """Start consuming events and passing them down to the translator.
+
+        If `forever` is False, return once the first event has been handled
+        completely, including work the translator queued for it.
+        """
+        await super().run(forever=forever)
+        if not forever:
+            await self._wait_until_idle()
+
+    async def run_until(self, stop: asyncio.Event) -> None:
+        """Consume events until the stop event is set.
+
+        An event that has been received is always processed completely, so stopping
+        only interrupts the wait for the next event.
+        """
+        stopping = asyncio.ensure_future(stop.wait())
+        try:
+            while not stop.is_set():
+                next_event = asyncio.ensure_future(self._consumer.__anext__())
+                await asyncio.wait(
+                    {next_event, stopping}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not next_event.done():
+                    next_event.cancel()
+                    with suppress(asyncio.CancelledError):
+                        await next_event
+                    return
+                await self._consume_event(next_event.result())
+        finally:
+            stopping.cancel()
@@ -0,0 +1,126 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A minimal HTTP server exposing the metrics for scraping."""
+
+import asyncio
+import logging
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REQUEST_TIMEOUT = 5.0
+MAX_HEADER_LINES = 100
+
+
+class MetricsServerConfig(BaseSettings):
+    """Config for the metrics endpoint of the REST API and the event consumer."""
+
+    metrics_enabled: bool = Field(
+        default=True,
+        description="Whether the service serves its metrics via HTTP.",
+    )
+    metrics_host: str = Field(
+        default="127.0.0.1",
+        description="The IP address the metrics endpoint listens on.",
+    )
+    metrics_port: int = Field(
+        default=8081,
+        description=(
+            "The port the metrics endpoint listens on, serving /metrics. The REST API"
+            + " and the event consumer both serve their metrics, so they need"
+            + " different ports when running on the same host."
+        ),
+    )
+    metrics_linger: float = Field(
+        default=5.0,
+        ge=0,
+        description=(
+            "The number of seconds the metrics are still served after a graceful"
+            + " shutdown, so that final values like the shutdown duration can be"
+            + " scraped."
+        ),
+    )
+
+
+def _response(status: str, body: bytes, content_type: str = "text/plain") -> bytes:
+    """Assemble an HTTP response closing the connection."""
+    return (
+        f"HTTP/1.1 {status}\r\n"
+        + f"Content-Type: {content_type}\r\n"
+        + f"Content-Length: {len(body)}\r\n"
+        + "Connection: close\r\n\r\n"
+    ).encode() + body
+
+
+async def _read_request_line(reader: asyncio.StreamReader) -> bytes:
+    """Read the request line and skip the headers."""
+    request_line = await reader.readline()
+    for _ in range(MAX_HEADER_LINES):
+        if await reader.readline() in (b"\r\n", b"\n", b""):
+            break
+    return request_line
+
+
+async def _handle_connection(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+):
+    """Answer a single request on the connection."""
+    try:
+        request_line = await asyncio.wait_for(
+            _read_request_line(reader), timeout=REQUEST_TIMEOUT
+        )
+        method, _, rest = request_line.decode("latin-1").partition(" ")
+        path = rest.split(" ", 1)[0].split("?", 1)[0]
+        if method != "GET":
+            response = _response("405 Method Not Allowed", b"")
+        elif path != "/metrics":
+            response = _response("404 Not Found", b"")
+        else:
+            response = _response("200 OK", REGISTRY.render().encode(), CONTENT_TYPE)
+        writer.write(response)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+@asynccontextmanager
+async def serve_metrics(
+    *, config: MetricsServerConfig
+) -> AsyncGenerator[Optional[asyncio.Server], None]:
+    """Serve the metrics in the background, yield the server or None if disabled."""
+    if not config.metrics_enabled:
+        yield None
+        return
+    server = await asyncio.start_server(
+        _handle_connection, host=config.metrics_host, port=config.metrics_port
+    )
+    log.info("Serving metrics on %s:%i", config.metrics_host, config.metrics_port)
+    try:
+        yield server
+    finally:
+        server.close()
+        await server.wait_closed()
@@ -0,0 +1,189 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A priority scheduler for staging work with fairness across correlation IDs."""
+
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from collections.abc import AsyncGenerator, Coroutine, Sequence
+from contextlib import asynccontextmanager, suppress
+from time import perf_counter
+from typing import Any, Callable
+
+from pci.metrics import gauge, histogram
+
+log = logging.getLogger(__name__)
+
+Job = Callable[[], Coroutine[Any, Any, None]]
+
+queued_stagings = gauge(
+    "pci_staging_queued", "Stagings waiting to be started.", labels=("priority",)
+)
+staging_queue_seconds = histogram(
+    "pci_staging_queue_seconds",
+    "Time stagings waited to be started.",
+    labels=("priority",),
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900),
+)
+
+
+class SchedulerClosedError(RuntimeError):
+    """Raised when a job is submitted to a scheduler that has been shut down."""
+
+    def __init__(self):
+        super().__init__("The scheduler does not take further jobs.")
+
+
+class StagingScheduler:
+    """Runs jobs with a fixed number of workers, by priority class and fairly across
+    groups.
+
+    Jobs of a higher priority class are always started before jobs of lower ones.
+    Within a class, the groups (e.g. correlation IDs) with waiting jobs take turns,
+    so that a group submitting many jobs at once does not hold up the others.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, priorities: Sequence[str], concurrency: int, max_size: int
+    ) -> AsyncGenerator["StagingScheduler", None]:
+        """Setup a StagingScheduler with its workers.
+
+        On teardown, all queued jobs are completed before the workers are stopped.
+        Jobs submitted afterwards are rejected.
+        """
+        scheduler = cls(priorities=priorities, max_size=max_size)
+        workers = [asyncio.create_task(scheduler._work()) for _ in range(concurrency)]
+        try:
+            yield scheduler
+            await scheduler.wait_until_idle()
+        finally:
+            scheduler._close()
+            for worker in workers:
+                worker.cancel()
+            for worker in workers:
+                with suppress(asyncio.CancelledError):
+                    await worker
+
+    def __init__(self, *, priorities: Sequence[str], max_size: int):
+        """Please do not call directly! Should be called by the `construct` method.
+
+        Args:
+            priorities: The names of the priority classes, highest priority first.
+            max_size: Submitting waits while this many jobs are queued.
+        """
+        self._max_size = max_size
+        # groups with their waiting jobs and enqueue times, per priority class
+        self._queues: dict[str, OrderedDict[str, deque[tuple[Job, float]]]] = {
+            priority: OrderedDict() for priority in priorities
+        }
+        self._sizes = dict.fromkeys(priorities, 0)
+        self._size = 0
+        self._running = 0
+        self._has_jobs = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+
+    def __len__(self) -> int:
+        """Return the number of queued jobs."""
+        return self._size
+
+    @property
+    def full(self) -> bool:
+        """Whether submitting a job would have to wait."""
+        return not self._not_full.is_set()
+
+    async def wait_until_not_full(self) -> None:
+        """Wait until a job can be submitted without waiting."""
+        await self._not_full.wait()
+
+    def _update_size(self, priority: str, change: int):
+        """Track the number of queued jobs."""
+        self._sizes[priority] += change
+        self._size += change
+        queued_stagings.set(self._sizes[priority], priority=priority)
+        if self._size:
+            self._has_jobs.set()
+            self._idle.clear()
+        else:
+            self._has_jobs.clear()
+        if self._size < self._max_size:
+            self._not_full.set()
+        else:
+            self._not_full.clear()
+
+    async def put(self, job: Job, *, priority: str, group: str) -> None:
+        """Queue a job, waiting while the queue is full.
+
+        Raises:
+            KeyError: If the priority class is unknown.
+            SchedulerClosedError: If the scheduler has been shut down.
+        """
+        groups = self._queues[priority]
+        # all waiting submitters are woken up, only as many as fit may proceed
+        while self._size >= self._max_size and not self._closed:
+            await self._not_full.wait()
+        if self._closed:
+            raise SchedulerClosedError()
+        groups.setdefault(group, deque()).append((job, perf_counter()))
+        self._update_size(priority, 1)
+
+    def _close(self):
+        """Reject further jobs, also those of submitters waiting for space."""
+        self._closed = True
+        self._not_full.set()
+
+    def _pop(self) -> tuple[Job, str, float]:
+        """Take the next job of the highest priority class that has jobs."""
+        for priority, groups in self._queues.items():
+            if not groups:
+                continue
+            group, jobs = next(iter(groups.items()))
+            job, enqueued = jobs.popleft()
+            if jobs:
+                groups.move_to_end(group)
+            else:
+                del groups[group]
+            self._update_size(priority, -1)
+            return job, priority, enqueued
+        raise IndexError("No jobs queued")
+
+    async def _work(self):
+        """Run queued jobs one at a time."""
+        while True:
+            # another worker might have taken the job this one was woken up for
+            while not self._size:
+                await self._has_jobs.wait()
+            job, priority, enqueued = self._pop()
+            staging_queue_seconds.observe(perf_counter() - enqueued, priority=priority)
+            self._running += 1
+            try:
+                await job()
+            except Exception:
+                log.exception("Staging job of priority %s failed", priority)
+            finally:
+                self._running -= 1
+                if not self._running and not self._size:
+                    self._idle.set()
+
+    async def wait_until_idle(self) -> None:
+        """Wait until no jobs are queued or running."""
+        await self._idle.wait()
@@ -0,0 +1,103 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A hashed timer wheel for scheduling many delayed callbacks with one task."""
+
+import asyncio
+import logging
+from collections.abc import AsyncGenerator, Coroutine
+from contextlib import asynccontextmanager, suppress
+from math import ceil
+from typing import Any, Callable
+
+log = logging.getLogger(__name__)
+
+Callback = Callable[[], Coroutine[Any, Any, None]]
+
+
+class TimerWheel:
+    """Runs callbacks after a delay, with a resolution of one tick.
+
+    Timers are hashed into a ring of slots by their deadline. A single driver task
+    advances one slot per tick and starts the callbacks that are due as tasks, so
+    scheduling and expiring a timer is O(1) regardless of the number of pending timers.
+    Timers further out than one turn of the wheel wait for the according number of
+    rounds in their slot.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, tick: float, slots: int = 512
+    ) -> AsyncGenerator["TimerWheel", None]:
+        """Setup a TimerWheel with its driver task.
+
+        On teardown, pending timers are dropped while callbacks that have already been
+        started are awaited.
+        """
+        wheel = cls(tick=tick, slots=slots)
+        driver = asyncio.create_task(wheel._drive())
+        try:
+            yield wheel
+        finally:
+            driver.cancel()
+            with suppress(asyncio.CancelledError):
+                await driver
+            if wheel.pending:
+                log.warning("Dropped %i pending timers on shutdown", wheel.pending)
+            await asyncio.gather(*wheel._running, return_exceptions=True)
+
+    def __init__(self, *, tick: float, slots: int = 512):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._tick = tick
+        # every timer is stored with the number of remaining rounds
+        self._slots: list[list[tuple[int, Callback]]] = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._running: set[asyncio.Task] = set()
+        self.pending = 0
+
+    def schedule(self, delay: float, callback: Callback) -> None:
+        """Run the callback as a task once the delay in seconds has passed."""
+        ticks = max(1, ceil(delay / self._tick))
+        slot = (self._cursor + ticks) % len(self._slots)
+        self._slots[slot].append(((ticks - 1) // len(self._slots), callback))
+        self.pending += 1
+
+    def _advance(self):
+        """Move to the next slot and start the callbacks that are due."""
+        self._cursor = (self._cursor + 1) % len(self._slots)
+        timers = self._slots[self._cursor]
+        if not timers:
+            return
+        self._slots[self._cursor] = []
+        for rounds, callback in timers:
+            if rounds:
+                self._slots[self._cursor].append((rounds - 1, callback))
+                continue
+            self.pending -= 1
+            task = asyncio.create_task(callback())
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _drive(self):
+        """Advance the wheel every tick, catching up if the event loop was busy."""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time() + self._tick
+        while True:
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+            while next_tick <= loop.time():
+                self._advance()
+                next_tick += self._tick
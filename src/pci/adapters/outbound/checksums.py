@@ -0,0 +1,73 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Incremental SHA-256 verification of staged content."""
+
+import hashlib
+from collections.abc import Iterator
+
+from pci.metrics import counter
+from pci.ports.outbound.file_storage import FileStoragePort
+
+CHUNK_SIZE = 1024 * 1024
+
+checksum_verifications = counter(
+    "pci_checksum_verifications_total",
+    "Staged files verified against their expected SHA-256 checksum.",
+    labels=("outcome",),
+)
+
+
+def iter_chunks(content: bytes, chunk_size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+    """Split the content into chunks of a fixed size without copying it."""
+    view = memoryview(content)
+    for start in range(0, len(view), chunk_size):
+        yield view[start : start + chunk_size]
+
+
+class Sha256Verifier:
+    """Computes the SHA-256 checksum of a file chunk by chunk while it is written and
+    compares it with the expected one.
+
+    Hashing large chunks releases the GIL, so files written in different threads are
+    verified in parallel. Without an expected checksum, nothing is computed.
+    """
+
+    def __init__(self, *, file_id: str, expected: str):
+        self._file_id = file_id
+        self._expected = expected.lower()
+        self._hash = hashlib.sha256() if expected else None
+
+    def update(self, chunk: memoryview) -> None:
+        """Add the next chunk of the file."""
+        if self._hash is not None:
+            self._hash.update(chunk)
+
+    def verify(self) -> None:
+        """Compare the checksum of all chunks with the expected one.
+
+        Raises:
+            ChecksumMismatchError: If the checksums differ.
+        """
+        if self._hash is None:
+            return
+        actual = self._hash.hexdigest()
+        if actual != self._expected:
+            checksum_verifications.inc(outcome="mismatch")
+            raise FileStoragePort.ChecksumMismatchError(
+                file_id=self._file_id, expected=self._expected, actual=actual
+            )
+        checksum_verifications.inc(outcome="ok")
@@ -0,0 +1,153 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A Kafka producer that is connected and warmed up before it is needed."""
+
+import asyncio
+import json
+import logging
+from collections.abc import AsyncGenerator, Sequence
+from contextlib import asynccontextmanager, suppress
+from time import perf_counter
+from typing import Any
+
+from aiokafka import AIOKafkaProducer
+from hexkit.providers.akafka import KafkaConfig, KafkaEventPublisher
+from hexkit.providers.akafka.provider import generate_client_id, generate_ssl_context
+from pydantic import Field
+
+from pci.metrics import gauge
+
+log = logging.getLogger(__name__)
+
+producer_ready = gauge(
+    "pci_kafka_producer_ready",
+    "Whether the Kafka producer is connected and has the metadata of its topics.",
+)
+
+
+class KafkaProducerConfig(KafkaConfig):
+    """Config for connecting to Kafka and warming up the producer."""
+
+    kafka_warmup_timeout: float = Field(
+        default=10.0,
+        description=(
+            "The number of seconds to wait for the metadata of a topic before"
+            + " retrying."
+        ),
+    )
+    kafka_warmup_retry_delay: float = Field(
+        default=1.0,
+        description="The number of seconds to wait between warm-up attempts.",
+    )
+
+
+class SharedKafkaProducer:
+    """Owns a Kafka producer that can be shared by all publishers of a process.
+
+    The producer connects on construction, the metadata of the topics it publishes
+    to is fetched in the background. The producer is ready once it has the metadata
+    of all topics, so that the first event does not pay for fetching it.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        config: KafkaProducerConfig,
+        topics: Sequence[str],
+        kafka_producer_cls: type = AIOKafkaProducer,
+    ) -> AsyncGenerator["SharedKafkaProducer", None]:
+        """Setup a SharedKafkaProducer that warms up in the background and stop the
+        producer on teardown.
+
+        Args:
+            config: Config parameters needed for connecting to Apache Kafka.
+            topics: The topics events will be published to.
+            kafka_producer_cls: Overwrite the Kafka producer class for unit testing.
+        """
+        client_id = generate_client_id(
+            service_name=config.service_name, instance_id=config.service_instance_id
+        )
+        producer = kafka_producer_cls(
+            bootstrap_servers=",".join(config.kafka_servers),
+            security_protocol=config.kafka_security_protocol,
+            ssl_context=generate_ssl_context(config),
+            client_id=client_id,
+            key_serializer=lambda key: key.encode("ascii"),
+            value_serializer=lambda event_value: json.dumps(event_value).encode(
+                "ascii"
+            ),
+        )
+        await producer.start()
+        shared_producer = cls(config=config, producer=producer)
+        warmup_task = asyncio.create_task(shared_producer._warm_up(topics))
+        try:
+            yield shared_producer
+        finally:
+            warmup_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await warmup_task
+            producer_ready.set(0)
+            await producer.stop()
+
+    def __init__(self, *, config: KafkaProducerConfig, producer: Any):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._config = config
+        self._producer = producer
+        self._ready = asyncio.Event()
+        self.event_publisher = KafkaEventPublisher(producer=producer)
+
+    @property
+    def ready(self) -> bool:
+        """Whether the metadata of all topics has been fetched."""
+        return self._ready.is_set()
+
+    async def is_connected(self) -> bool:
+        """Check that the producer is warmed up and can reach the cluster."""
+        if not self.ready:
+            return False
+        await self._producer.client.fetch_all_metadata()
+        return True
+
+    async def wait_until_ready(self) -> None:
+        """Wait until the producer is warmed up."""
+        await self._ready.wait()
+
+    async def _warm_up(self, topics: Sequence[str]):
+        """Fetch the metadata of all topics, retrying until it succeeds."""
+        started = perf_counter()
+        pending = list(dict.fromkeys(topics))
+        while pending:
+            topic = pending[0]
+            try:
+                await asyncio.wait_for(
+                    self._producer.partitions_for(topic),
+                    timeout=self._config.kafka_warmup_timeout,
+                )
+            except Exception as error:
+                log.warning("Failed to fetch metadata of topic %s: %s", topic, error)
+                await asyncio.sleep(self._config.kafka_warmup_retry_delay)
+                continue
+            pending.pop(0)
+        self._ready.set()
+        producer_ready.set(1)
+        log.info(
+            "Kafka producer warmed up for %i topics in %.3f s",
+            len(topics),
+            perf_counter() - started,
+        )
@@ -0,0 +1,252 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Adapter for storing staged files on the local filesystem."""
+
+import asyncio
+import logging
+import os
+import uuid
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.adapters.outbound.checksums import Sha256Verifier, iter_chunks
+from pci.adapters.outbound.staged_file_index import StagedFileIndex
+from pci.adapters.outbound.staging_layout import StagingLayout
+from pci.ports.outbound.file_storage import DownloadURL, FileStoragePort, StagedFile
+
+log = logging.getLogger(__name__)
+
+
+class LocalFileStorageConfig(BaseSettings):
+    """Config for storing staged files on the local filesystem."""
+
+    staging_directory: Path = Field(
+        default=Path("staging"),
+        description=(
+            "The directory staged files are stored in when using the local storage."
+            + " Relative paths are resolved against the working directory. It must"
+            + " be dedicated to staged files and is created if it does not exist."
+        ),
+    )
+    staging_shard_levels: int = Field(
+        default=2,
+        ge=0,
+        le=4,
+        description=(
+            "Staged files are spread over this many levels of shard directories"
+            + " named after the leading hex digits of the hash of the file ID, e.g."
+            + " ab/cd/<file_id> with two levels. Set to 0 for a flat layout. Run"
+            + " `pci migrate-staging --previous-levels <levels>` after changing the"
+            + " layout."
+        ),
+    )
+    staging_index_enabled: bool = Field(
+        default=True,
+        description=(
+            "Keep an in-memory index of the staged files, so that finding a staged"
+            + " file needs no filesystem access. While the index is kept current via"
+            + " inotify, neither does checking for a file that has not been staged."
+        ),
+    )
+    staging_index_inotify: bool = Field(
+        default=True,
+        description=(
+            "Keep the index current with files staged by other processes via"
+            + " inotify, if available."
+        ),
+    )
+    staging_index_max_watches: int = Field(
+        default=1024,
+        ge=1,
+        description=(
+            "The maximum number of directories watched via inotify, each counting"
+            + " against the fs.inotify.max_user_watches limit. With more shard"
+            + " directories, the index is kept current by rescans only."
+        ),
+    )
+    staging_index_rescan_interval: float = Field(
+        default=60,
+        description=(
+            "The number of seconds between full rescans of the staging directory"
+            + " picking up changes the index missed. Set to 0 to disable rescans."
+        ),
+    )
+
+
+def get_staging_layout(config: LocalFileStorageConfig) -> StagingLayout:
+    """Get the layout of the staging directory, shared by all of its users."""
+    return StagingLayout(
+        root=config.staging_directory, shard_levels=config.staging_shard_levels
+    )
+
+
+class LocalFileStorage(FileStoragePort):
+    """An adapter implementing the FileStoragePort using the local filesystem.
+
+    Files are stored in the sharded layout of the staging directory. File I/O is
+    run in worker threads to keep the event loop responsive. With an index, staged
+    files are found without accessing the filesystem. Files that are not in the
+    index are only considered not staged right away while the index is complete,
+    and are looked up in the filesystem otherwise.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: LocalFileStorageConfig
+    ) -> AsyncGenerator["LocalFileStorage", None]:
+        """Setup a LocalFileStorage along with the index of its files, if enabled.
+
+        The staging directory is created if it does not exist yet.
+        """
+        try:
+            await asyncio.to_thread(
+                config.staging_directory.mkdir, parents=True, exist_ok=True
+            )
+        except OSError as error:
+            # the directory might become available later, see the health check
+            log.warning("Failed to create %s: %s", config.staging_directory, error)
+        if not config.staging_index_enabled:
+            yield cls(config=config)
+            return
+        async with StagedFileIndex.construct(
+            layout=get_staging_layout(config),
+            rescan_interval=config.staging_index_rescan_interval,
+            use_inotify=config.staging_index_inotify,
+            max_watches=config.staging_index_max_watches,
+        ) as index:
+            yield cls(config=config, index=index)
+
+    def __init__(
+        self,
+        *,
+        config: LocalFileStorageConfig,
+        index: Optional[StagedFileIndex] = None,
+    ):
+        """Initialize with the config and optionally an index of the staged files."""
+        self._staging_directory = config.staging_directory
+        self._layout = get_staging_layout(config)
+        self._index = index
+
+    def _get_path(self, file_id: str) -> Path:
+        """Get the path of the file with the given ID."""
+        return self._layout.get_path(file_id)
+
+    async def is_available(self) -> bool:
+        """Check whether the staging directory exists and is writable."""
+        directory = self._staging_directory
+        return await asyncio.to_thread(
+            lambda: directory.is_dir() and os.access(directory, os.W_OK | os.X_OK)
+        )
+
+    async def exists(self, file_id: str) -> bool:
+        """Check whether the file with the given ID has been staged."""
+        return await self.get_file(file_id) is not None
+
+    async def get_file(self, file_id: str) -> Optional[StagedFile]:
+        """Get the size and modification time of a staged file, or None if the file
+        has not been staged.
+        """
+        if self._index is not None and (
+            (staged_file := self._index.get(file_id)) is not None
+            or self._index.complete
+        ):
+            return staged_file
+        try:
+            stat = await asyncio.to_thread(self._get_path(file_id).stat)
+        except FileNotFoundError:
+            return None
+        staged_file = StagedFile(stat.st_size, stat.st_mtime)
+        if self._index is not None:
+            self._index.add(file_id, staged_file)
+        return staged_file
+
+    async def list_files(self) -> dict[str, StagedFile]:
+        """List all staged files by ID along with their sizes and modification times."""
+        if self._index is not None:
+            return self._index.copy()
+        return await asyncio.to_thread(lambda: dict(self._layout.scan()))
+
+    async def read(self, file_id: str) -> bytes:
+        """Read the content of a staged file.
+
+        Raises:
+            FileNotStagedError: If the file has not been staged.
+        """
+        if (
+            self._index is not None
+            and self._index.complete
+            and file_id not in self._index
+        ):
+            raise self.FileNotStagedError(file_id=file_id)
+        try:
+            return await asyncio.to_thread(self._get_path(file_id).read_bytes)
+        except OSError as error:
+            if self._index is not None:
+                self._index.discard(file_id)
+            raise self.FileNotStagedError(file_id=file_id) from error
+
+    def _write_atomically(
+        self, file_id: str, content: bytes, sha256: str
+    ) -> os.stat_result:
+        """Write to a temporary file that replaces the staged file once complete and
+        verified, so that a file is never visible half-written or corrupted.
+        """
+        path = self._get_path(file_id)
+        temp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        verifier = Sha256Verifier(file_id=file_id, expected=sha256)
+        try:
+            with temp_path.open("wb") as temp_file:
+                for chunk in iter_chunks(content):
+                    verifier.update(chunk)
+                    temp_file.write(chunk)
+            verifier.verify()
+            stat = temp_path.stat()
+            os.replace(temp_path, path)
+        except BaseException:
+            temp_path.unlink(missing_ok=True)
+            raise
+        return stat
+
+    async def write(self, file_id: str, content: bytes, *, sha256: str = "") -> None:
+        """Store the content of a file in the staging directory.
+
+        If a SHA-256 checksum is given, the content is verified while it is written
+        and the file is not stored if it does not match.
+
+        Raises:
+            ChecksumMismatchError: If the content does not match the checksum.
+        """
+        stat = await asyncio.to_thread(self._write_atomically, file_id, content, sha256)
+        if self._index is not None:
+            self._index.add(file_id, StagedFile(stat.st_size, stat.st_mtime))
+
+    async def delete(self, file_id: str) -> None:
+        """Remove a file from the staging directory, if it has been staged."""
+        await asyncio.to_thread(self._get_path(file_id).unlink, missing_ok=True)
+        if self._index is not None:
+            self._index.discard(file_id)
+
+    async def get_download_url(self, file_id: str) -> Optional[DownloadURL]:
+        """Local files cannot be downloaded directly, so this always returns None."""
+        return None
@@ -0,0 +1,468 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""An outbox decoupling the publishing of events from the availability of the broker.
+
+Events are appended to a log of memory-mapped segment files and returned from
+immediately. A relay running in the background drains the log to the actual event
+publisher in batches, retrying failed events until they are published. Events that
+cannot be parsed or keep failing are moved to a separate dead letter log.
+"""
+
+import asyncio
+import fcntl
+import logging
+import mmap
+import struct
+import zlib
+from collections import deque
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from pydantic import Field, ValidationError
+from pydantic_settings import BaseSettings
+
+from pci.context_vars import CorrelationContext, set_correlation_context
+from pci.metrics import counter
+from pci.models import NonStagedFileRequested
+from pci.ports.outbound.event_pub import EventPublisherPort
+
+log = logging.getLogger(__name__)
+
+# a segment starts with the offset up to which its records have been consumed
+SEGMENT_HEADER = struct.Struct("<Q")
+# every record is preceded by the length and the CRC-32 checksum of its payload
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".segment"
+DEAD_LETTER_DIRECTORY = "dead_letters"
+
+dead_lettered_events = counter(
+    "pci_outbox_dead_lettered_events_total",
+    "Events moved from the outbox to its dead letter log.",
+    labels=("reason",),
+)
+
+
+class OutboxConfig(BaseSettings):
+    """Config for the outbox of the REST API."""
+
+    outbox_enabled: bool = Field(
+        default=False,
+        description=(
+            "Whether events published while handling requests are written to the"
+            + " outbox and relayed to the broker in the background."
+        ),
+    )
+    outbox_directory: Path = Field(
+        default=Path("outbox"),
+        description=(
+            "The directory holding the outbox segment files. It must not be shared"
+            + " between processes."
+        ),
+    )
+    outbox_segment_size: int = Field(
+        default=16 * 1024**2, description="The size of a segment file in bytes."
+    )
+    outbox_fsync: bool = Field(
+        default=False,
+        description=(
+            "Whether every appended event is flushed to disk before returning. Events"
+            + " appended concurrently are flushed together. If disabled, events"
+            + " survive crashes of the process but not of the operating system."
+        ),
+    )
+    outbox_batch_size: int = Field(
+        default=100, description="The maximum number of events relayed concurrently."
+    )
+    outbox_retry_delay: float = Field(
+        default=0.1,
+        description=(
+            "The number of seconds to wait before retrying failed events. Doubled"
+            + " with every consecutive failure."
+        ),
+    )
+    outbox_max_retry_delay: float = Field(
+        default=30.0,
+        description="The maximum number of seconds to wait before retrying.",
+    )
+    outbox_max_attempts: int = Field(
+        default=10,
+        ge=1,
+        description=(
+            "The number of attempts to relay an event, after which it is moved to"
+            + " the dead letter log in the outbox directory so that it does not"
+            + " block the events behind it."
+        ),
+    )
+    outbox_drain_timeout: float = Field(
+        default=5.0,
+        description=(
+            "The number of seconds to keep relaying events on shutdown. Events not"
+            + " relayed by then remain in the outbox for the next start."
+        ),
+    )
+
+
+class OutboxLockedError(RuntimeError):
+    """Raised when the outbox directory is already used by another process."""
+
+    def __init__(self, *, directory: Path):
+        super().__init__(f"The outbox directory {directory} is in use.")
+
+
+class _Segment:
+    """A memory-mapped file holding a sequence of records.
+
+    Segments are only appended to and never rewritten, so a record that fails its
+    checksum marks the end of the segment (e.g. after a torn write).
+    """
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        with open(path, "a+b") as file:
+            if file.seek(0, 2) < size:
+                file.truncate(size)
+            self._map = mmap.mmap(file.fileno(), 0)
+        if self.consumed == 0:
+            self.consumed = SEGMENT_HEADER.size
+        self.end = self.consumed
+        while (record := self.record_at(self.end)) is not None:
+            self.end = record[1]
+        # the offset up to which records have been flushed to disk
+        self.flushed = self.end
+
+    @property
+    def consumed(self) -> int:
+        """The offset up to which records have been consumed."""
+        return SEGMENT_HEADER.unpack_from(self._map)[0]
+
+    @consumed.setter
+    def consumed(self, offset: int):
+        SEGMENT_HEADER.pack_into(self._map, 0, offset)
+
+    def record_at(self, offset: int) -> Optional[tuple[bytes, int]]:
+        """Get the payload of the record at the offset and the offset of the next
+        record, or None if there is no valid record.
+        """
+        start = offset + RECORD_HEADER.size
+        if start > len(self._map):
+            return None
+        length, checksum = RECORD_HEADER.unpack_from(self._map, offset)
+        if not length or start + length > len(self._map):
+            return None
+        payload = self._map[start : start + length]
+        if zlib.crc32(payload) != checksum:
+            return None
+        return payload, start + length
+
+    def append(self, payload: bytes) -> bool:
+        """Append a record, return False if it doesn't fit."""
+        start = self.end + RECORD_HEADER.size
+        if start + len(payload) > len(self._map):
+            return False
+        self._map[start : start + len(payload)] = payload
+        RECORD_HEADER.pack_into(self._map, self.end, len(payload), zlib.crc32(payload))
+        self.end = start + len(payload)
+        return True
+
+    def flush(self):
+        """Flush the pages holding records appended since the last flush to disk."""
+        end = self.end
+        start = self.flushed - self.flushed % mmap.PAGESIZE
+        self._map.flush(start, end - start)
+        self.flushed = end
+
+    def close(self):
+        """Unmap the segment file."""
+        self._map.close()
+
+
+class OutboxLog:
+    """An append-only log of records, stored in a directory of segment files.
+
+    Records are read in batches and marked as consumed afterwards. Segments are
+    deleted once all of their records have been consumed and, if records are
+    flushed to disk, after the last flush.
+    """
+
+    def __init__(self, *, directory: Path, segment_size: int, fsync: bool = False):
+        directory.mkdir(parents=True, exist_ok=True)
+        self._directory = directory
+        self._segment_size = segment_size
+        self._fsync = fsync
+        self._lock_file = open(directory / "lock", "wb")  # noqa: SIM115
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as error:
+            self._lock_file.close()
+            raise OutboxLockedError(directory=directory) from error
+
+        paths = sorted(directory.glob(f"*{SEGMENT_SUFFIX}"))
+        self._segments = deque(_Segment(path, segment_size) for path in paths)
+        if not self._segments:
+            self._add_segment(0)
+        self._batch_ends: list[int] = []
+
+    def _add_segment(self, number: int):
+        """Start a new segment to append to."""
+        path = self._directory / f"{number:016d}{SEGMENT_SUFFIX}"
+        self._segments.append(_Segment(path, self._segment_size))
+
+    def _drop_consumed_segments(self):
+        """Delete fully consumed segments that are no longer appended to."""
+        while len(self._segments) > 1:
+            segment = self._segments[0]
+            if segment.consumed < segment.end or (
+                # the segment may still be flushed in a worker thread
+                self._fsync and segment.flushed < segment.end
+            ):
+                return
+            self._segments.popleft()
+            segment.close()
+            segment.path.unlink()
+
+    @property
+    def empty(self) -> bool:
+        """Whether all records have been consumed."""
+        self._drop_consumed_segments()
+        return self._segments[0].consumed >= self._segments[0].end
+
+    def append(self, payload: bytes):
+        """Append a record to the log."""
+        if RECORD_HEADER.size + len(payload) > self._segment_size - SEGMENT_HEADER.size:
+            raise ValueError(
+                f"A record of {len(payload)} bytes does not fit into a segment."
+            )
+        if not self._segments[-1].append(payload):
+            self._add_segment(int(self._segments[-1].path.stem) + 1)
+            self._segments[-1].append(payload)
+
+    def flush(self):
+        """Flush the records appended since the last flush to disk.
+
+        This blocks and can be run in a worker thread, while records are appended.
+        """
+        for segment in list(self._segments):
+            if segment.flushed < segment.end:
+                segment.flush()
+
+    def read(self, max_records: int) -> list[bytes]:
+        """Read up to the given number of unconsumed records.
+
+        Records are returned again by the next read unless consumed in between.
+        """
+        self._drop_consumed_segments()
+        segment = self._segments[0]
+        payloads: list[bytes] = []
+        self._batch_ends = []
+        offset = segment.consumed
+        while len(payloads) < max_records and offset < segment.end:
+            payload, offset = segment.record_at(offset)  # type: ignore[misc]
+            payloads.append(payload)
+            self._batch_ends.append(offset)
+        return payloads
+
+    def consume(self, count: int):
+        """Mark the given number of records returned by the last read as consumed."""
+        if count:
+            self._segments[0].consumed = self._batch_ends[count - 1]
+        self._batch_ends = []
+
+    def close(self):
+        """Unmap all segments and release the directory."""
+        for segment in self._segments:
+            segment.close()
+        self._lock_file.close()
+
+
+class OutboxEventPublisher(EventPublisherPort):
+    """An EventPublisherPort writing events to an outbox, from which they are relayed
+    to another EventPublisherPort in the background.
+
+    Events are relayed at least once and, unless retried, in the order they were
+    published. Events that cannot be parsed, or are not relayed within the maximum
+    number of attempts, are moved to a dead letter log in a subdirectory of the
+    outbox, which is not relayed.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: OutboxConfig, event_publisher: EventPublisherPort
+    ) -> AsyncGenerator["OutboxEventPublisher", None]:
+        """Setup an OutboxEventPublisher along with its relay.
+
+        On teardown, events are relayed until the outbox is empty or the drain
+        timeout has passed.
+        """
+        outbox_log = OutboxLog(
+            directory=config.outbox_directory,
+            segment_size=config.outbox_segment_size,
+            fsync=config.outbox_fsync,
+        )
+        outbox = cls(
+            config=config, outbox_log=outbox_log, event_publisher=event_publisher
+        )
+        relay = asyncio.create_task(outbox._relay())
+        try:
+            yield outbox
+        finally:
+            outbox._stopping = True
+            outbox._records_available.set()
+            try:
+                await asyncio.wait_for(relay, timeout=config.outbox_drain_timeout)
+            except asyncio.TimeoutError:
+                log.warning("Shut down with events remaining in the outbox")
+            if outbox._flusher is not None:
+                await outbox._flusher
+            outbox_log.close()
+            if outbox._dead_letters is not None:
+                outbox._dead_letters.close()
+
+    def __init__(
+        self,
+        *,
+        config: OutboxConfig,
+        outbox_log: OutboxLog,
+        event_publisher: EventPublisherPort,
+    ):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._config = config
+        self._log = outbox_log
+        self._event_publisher = event_publisher
+        self._records_available = asyncio.Event()
+        self._stopping = False
+        self._dead_letters: Optional[OutboxLog] = None
+        # the flush waited for by events appended since the running flush started
+        self._next_flush: Optional[asyncio.Future[None]] = None
+        self._flusher: Optional[asyncio.Task[None]] = None
+
+    async def non_staged_file_requested(self, *, event: NonStagedFileRequested):
+        """Write the event to the outbox to be relayed.
+
+        If configured, wait until the event has been flushed to disk.
+        """
+        self._log.append(event.model_dump_json().encode())
+        self._records_available.set()
+        if self._config.outbox_fsync:
+            await self._flush()
+
+    async def _flush(self):
+        """Wait until the appended events have been flushed to disk.
+
+        Flushes run in a worker thread, one at a time. All events appended while a
+        flush is running are flushed together by the next one.
+        """
+        if self._next_flush is None:
+            self._next_flush = asyncio.get_running_loop().create_future()
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(self._run_flushes())
+        await asyncio.shield(self._next_flush)
+
+    async def _run_flushes(self):
+        """Flush the outbox log as long as events are waiting for a flush."""
+        while (flush := self._next_flush) is not None:
+            self._next_flush = None
+            try:
+                await asyncio.to_thread(self._log.flush)
+            except Exception as error:
+                flush.set_exception(error)
+            else:
+                flush.set_result(None)
+
+    def _dead_letter(self, payload: bytes, *, reason: str):
+        """Move an event that cannot be relayed to the dead letter log."""
+        if self._dead_letters is None:
+            self._dead_letters = OutboxLog(
+                directory=self._config.outbox_directory / DEAD_LETTER_DIRECTORY,
+                segment_size=self._config.outbox_segment_size,
+            )
+        self._dead_letters.append(payload)
+        dead_lettered_events.inc(reason=reason)
+
+    async def _relay_event(self, payload: bytes):
+        """Relay a single event in the correlation context it was published in.
+
+        Events that cannot be parsed are moved to the dead letter log.
+        """
+        try:
+            event = NonStagedFileRequested.model_validate_json(payload)
+        except ValidationError:
+            log.exception("Moving an invalid event from the outbox to dead letters")
+            self._dead_letter(payload, reason="invalid")
+            return
+        context = CorrelationContext.from_event_fields(event.model_dump())
+        async with set_correlation_context(context):
+            await self._event_publisher.non_staged_file_requested(event=event)
+
+    async def _relay_batch(self, payloads: list[bytes]) -> int:
+        """Relay a batch of events concurrently, return the number of events up to
+        the first failed one.
+        """
+        results = await asyncio.gather(
+            *(self._relay_event(payload) for payload in payloads),
+            return_exceptions=True,
+        )
+        for index, result in enumerate(results):
+            if isinstance(result, BaseException):
+                log.warning(
+                    "Failed to relay %i of %i events from the outbox: %s",
+                    len(payloads) - index,
+                    len(payloads),
+                    result,
+                )
+                return index
+        return len(payloads)
+
+    async def _relay(self):
+        """Relay events from the outbox until stopped and the outbox is empty,
+        retrying failed events with exponential backoff.
+        """
+        delay = self._config.outbox_retry_delay
+        # the number of failed attempts to relay the first unconsumed event
+        attempts = 0
+        while True:
+            self._records_available.clear()
+            payloads = self._log.read(self._config.outbox_batch_size)
+            if not payloads:
+                if self._stopping:
+                    return
+                await self._records_available.wait()
+                continue
+
+            relayed = await self._relay_batch(payloads)
+            if relayed < len(payloads):
+                attempts = attempts + 1 if relayed == 0 else 1
+                if attempts >= self._config.outbox_max_attempts:
+                    log.error(
+                        "Moving an event that failed to be relayed %i times from the"
+                        + " outbox to dead letters",
+                        attempts,
+                    )
+                    self._dead_letter(payloads[relayed], reason="failed")
+                    # retry the events behind it right away
+                    self._log.consume(relayed + 1)
+                    attempts = 0
+                    continue
+            self._log.consume(relayed)
+            if relayed == len(payloads):
+                attempts = 0
+                delay = self._config.outbox_retry_delay
+                continue
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self._config.outbox_max_retry_delay)
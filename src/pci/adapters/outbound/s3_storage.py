@@ -0,0 +1,316 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Adapter for storing staged files in an S3-compatible object storage."""
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Optional
+
+import boto3
+import botocore.config
+from botocore.exceptions import ClientError
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings
+
+from pci.adapters.outbound.checksums import Sha256Verifier, iter_chunks
+from pci.ports.outbound.file_storage import DownloadURL, FileStoragePort, StagedFile
+
+log = logging.getLogger(__name__)
+
+MISSING_OBJECT_ERROR_CODES = ("404", "NoSuchKey", "NotFound")
+CHANGED_OBJECT_ERROR_CODES = ("412", "PreconditionFailed")
+# how often a file is read from the start if it is replaced while being read
+READ_ATTEMPTS = 3
+
+
+class S3FileStorageConfig(BaseSettings):
+    """Config for storing staged files in an S3-compatible object storage.
+
+    The connection parameters are only required when using the S3 storage.
+    """
+
+    s3_endpoint_url: Optional[str] = Field(
+        default=None,
+        examples=["http://localhost:4566"],
+        description="URL to the S3 API.",
+    )
+    s3_access_key_id: Optional[str] = Field(
+        default=None,
+        examples=["my-access-key-id"],
+        description="Part of credentials for login into the S3 service.",
+    )
+    s3_secret_access_key: Optional[SecretStr] = Field(
+        default=None,
+        examples=["my-secret-access-key"],
+        description="Part of credentials for login into the S3 service.",
+    )
+    s3_session_token: Optional[SecretStr] = Field(
+        default=None,
+        examples=["my-session-token"],
+        description="Optional part of credentials for login into the S3 service.",
+    )
+    staging_bucket_id: str = Field(
+        default="staging",
+        description="The bucket staged files are stored in when using the S3 storage.",
+    )
+    s3_max_pool_connections: int = Field(
+        default=32,
+        description="The maximum number of pooled connections to the S3 API.",
+    )
+    s3_read_part_size: int = Field(
+        default=8 * 1024**2,
+        description="Files larger than this (in bytes) are read in concurrent parts.",
+    )
+    s3_max_concurrent_parts: int = Field(
+        default=8,
+        description="The maximum number of parts read concurrently per file.",
+    )
+    s3_download_url_expires_after: int = Field(
+        default=3600,
+        description="The number of seconds presigned download URLs are valid for.",
+    )
+
+
+class S3FileStorage(FileStoragePort):
+    """An adapter implementing the FileStoragePort using an S3-compatible object
+    storage.
+
+    All operations share one client with a pool of connections. Blocking client calls
+    are run in worker threads. Files larger than the configured part size are read
+    using concurrent range requests, all of the same version of the object.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(cls, *, config: S3FileStorageConfig):
+        """Setup and teardown an S3FileStorage instance with a pooled client."""
+        client = boto3.client(
+            service_name="s3",
+            endpoint_url=config.s3_endpoint_url,
+            aws_access_key_id=config.s3_access_key_id,
+            aws_secret_access_key=(
+                config.s3_secret_access_key.get_secret_value()
+                if config.s3_secret_access_key
+                else None
+            ),
+            aws_session_token=(
+                config.s3_session_token.get_secret_value()
+                if config.s3_session_token
+                else None
+            ),
+            config=botocore.config.Config(
+                max_pool_connections=config.s3_max_pool_connections
+            ),
+        )
+        try:
+            yield cls(config=config, client=client)
+        finally:
+            client.close()
+
+    def __init__(self, *, config: S3FileStorageConfig, client: Any):
+        """Please do not call directly! Should be called by the `construct` method.
+
+        Args:
+            config: The S3 storage config.
+            client: A boto3 S3 client, can be replaced for unit testing.
+        """
+        self._config = config
+        self._client = client
+        self._bucket_id = config.staging_bucket_id
+
+    def _get_range(
+        self, file_id: str, start: int, end: int, etag: Optional[str] = None
+    ) -> tuple[bytes, int, str]:
+        """Get a byte range of an object, return it along with the object size and
+        ETag. If an ETag is given, the range is only returned from that version.
+        """
+        params = {"Bucket": self._bucket_id, "Key": file_id}
+        if etag is not None:
+            params["IfMatch"] = etag
+        try:
+            response = self._client.get_object(**params, Range=f"bytes={start}-{end}")
+        except ClientError as error:
+            code = error.response.get("Error", {}).get("Code")
+            if code in MISSING_OBJECT_ERROR_CODES:
+                raise self.FileNotStagedError(file_id=file_id) from error
+            if code == "InvalidRange":
+                # the object is empty
+                return b"", 0, ""
+            raise
+        # the content range has the form "bytes <start>-<end>/<size>"
+        size = int(response["ContentRange"].rpartition("/")[2])
+        return response["Body"].read(), size, response["ETag"]
+
+    async def _read_part(  # noqa: PLR0913
+        self,
+        file_id: str,
+        start: int,
+        end: int,
+        etag: str,
+        semaphore: asyncio.Semaphore,
+    ) -> bytes:
+        """Read a byte range of a version of a file, limiting the number of
+        concurrent reads of the file with the given semaphore.
+        """
+        async with semaphore:
+            part, _, _ = await asyncio.to_thread(
+                self._get_range, file_id, start, end, etag
+            )
+            return part
+
+    async def is_available(self) -> bool:
+        """Check whether the staging bucket can be reached."""
+        try:
+            await asyncio.to_thread(self._client.head_bucket, Bucket=self._bucket_id)
+        except ClientError as error:
+            log.warning("Staging bucket %s not available: %s", self._bucket_id, error)
+            return False
+        return True
+
+    async def exists(self, file_id: str) -> bool:
+        """Check whether the file with the given ID has been staged."""
+        try:
+            await asyncio.to_thread(
+                self._client.head_object, Bucket=self._bucket_id, Key=file_id
+            )
+        except ClientError as error:
+            if (
+                error.response.get("Error", {}).get("Code")
+                in MISSING_OBJECT_ERROR_CODES
+            ):
+                return False
+            raise
+        return True
+
+    async def get_file(self, file_id: str) -> Optional[StagedFile]:
+        """Get the size and modification time of a staged file, or None if the file
+        has not been staged.
+        """
+        try:
+            response = await asyncio.to_thread(
+                self._client.head_object, Bucket=self._bucket_id, Key=file_id
+            )
+        except ClientError as error:
+            if (
+                error.response.get("Error", {}).get("Code")
+                in MISSING_OBJECT_ERROR_CODES
+            ):
+                return None
+            raise
+        return StagedFile(
+            response["ContentLength"], response["LastModified"].timestamp()
+        )
+
+    def _list_objects(self) -> dict[str, StagedFile]:
+        """List all objects in the staging bucket, page by page."""
+        files: dict[str, StagedFile] = {}
+        params = {"Bucket": self._bucket_id}
+        while True:
+            response = self._client.list_objects_v2(**params)
+            for item in response.get("Contents", []):
+                files[item["Key"]] = StagedFile(
+                    item["Size"], item["LastModified"].timestamp()
+                )
+            if not response.get("IsTruncated"):
+                return files
+            params["ContinuationToken"] = response["NextContinuationToken"]
+
+    async def list_files(self) -> dict[str, StagedFile]:
+        """List all staged files by ID along with their sizes and modification times."""
+        return await asyncio.to_thread(self._list_objects)
+
+    async def _read_version(self, file_id: str) -> bytes:
+        """Read the content of the current version of a staged file.
+
+        The first part is requested right away, which also reveals the file size and
+        its ETag. Small files thus need a single request, the remaining parts of
+        larger files are read concurrently, each only if the ETag still matches.
+        """
+        part_size = self._config.s3_read_part_size
+        first_part, size, etag = await asyncio.to_thread(
+            self._get_range, file_id, 0, part_size - 1
+        )
+        if size <= part_size:
+            return first_part
+
+        semaphore = asyncio.Semaphore(self._config.s3_max_concurrent_parts)
+        remaining_parts = await asyncio.gather(
+            *(
+                self._read_part(
+                    file_id, start, min(start + part_size, size) - 1, etag, semaphore
+                )
+                for start in range(part_size, size, part_size)
+            )
+        )
+        return b"".join((first_part, *remaining_parts))
+
+    async def read(self, file_id: str) -> bytes:
+        """Read the content of a staged file.
+
+        If the file is replaced while its parts are read, it is read again from the
+        start, so that the parts never stem from different versions.
+
+        Raises:
+            FileNotStagedError: If the file has not been staged.
+            ClientError: If the file keeps being replaced while it is read.
+        """
+        attempt = 1
+        while True:
+            try:
+                return await self._read_version(file_id)
+            except ClientError as error:
+                code = error.response.get("Error", {}).get("Code")
+                if code not in CHANGED_OBJECT_ERROR_CODES or attempt >= READ_ATTEMPTS:
+                    raise
+            log.info("%s was replaced while being read, reading it again", file_id)
+            attempt += 1
+
+    def _put_verified(self, file_id: str, content: bytes, sha256: str):
+        """Verify the content chunk by chunk and upload it if it matches."""
+        verifier = Sha256Verifier(file_id=file_id, expected=sha256)
+        for chunk in iter_chunks(content):
+            verifier.update(chunk)
+        verifier.verify()
+        self._client.put_object(Bucket=self._bucket_id, Key=file_id, Body=content)
+
+    async def write(self, file_id: str, content: bytes, *, sha256: str = "") -> None:
+        """Store the content of a file in the staging bucket.
+
+        If a SHA-256 checksum is given, the content is verified before it is
+        uploaded and the file is not stored if it does not match.
+
+        Raises:
+            ChecksumMismatchError: If the content does not match the checksum.
+        """
+        await asyncio.to_thread(self._put_verified, file_id, content, sha256)
+
+    async def delete(self, file_id: str) -> None:
+        """Remove a file from the staging bucket, if it has been staged."""
+        await asyncio.to_thread(
+            self._client.delete_object, Bucket=self._bucket_id, Key=file_id
+        )
+
+    async def get_download_url(self, file_id: str) -> Optional[DownloadURL]:
+        """Get a presigned URL to download a staged file directly from the bucket."""
+        expires_after = self._config.s3_download_url_expires_after
+        url = self._client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self._bucket_id, "Key": file_id},
+            ExpiresIn=expires_after,
+        )
+        return DownloadURL(url=url, expires_after=expires_after)
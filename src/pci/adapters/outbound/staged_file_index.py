@@ -0,0 +1,457 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""An in-memory index of the files in the local staging directory."""
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from collections.abc import AsyncGenerator, Iterator
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from pci.adapters.outbound.staging_layout import StagingLayout
+from pci.metrics import counter, gauge
+from pci.ports.outbound.file_storage import StagedFile
+
+log = logging.getLogger(__name__)
+
+indexed_files = gauge("pci_staged_files_indexed", "Staged files in the index.")
+index_rescans = counter(
+    "pci_staged_file_index_rescans_total", "Full rescans of the staging directory."
+)
+watched_directories = gauge(
+    "pci_staged_file_index_watches",
+    "Directories of the staging directory watched via inotify.",
+)
+
+# constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE | IN_DELETE
+
+
+class _Inotify:
+    """A minimal ctypes binding of the Linux inotify API for watching directories
+    for entries appearing and disappearing.
+    """
+
+    def __init__(self):
+        """Setup an inotify instance.
+
+        Raises:
+            OSError: If inotify is not available.
+        """
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    def add_watch(self, directory: Path) -> int:
+        """Watch a directory and return the watch descriptor.
+
+        Raises:
+            OSError: If the watch cannot be added, e.g. when the limit is reached.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return wd
+
+    def read_events(self) -> Iterator[tuple[int, int, str]]:
+        """Get the watch descriptors, masks and names of the events that are ready
+        to be read.
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        """Stop watching."""
+        os.close(self.fd)
+
+
+class _Changes(NamedTuple):
+    """What a batch of inotify events changed in the staging directory."""
+
+    # staged files by ID, or None for files that are gone
+    files: list[tuple[str, Optional[StagedFile]]]
+    # whether files may have been removed that were not reported one by one
+    rescan: bool
+    # why the directories cannot be watched any longer, if that is the case
+    error: Optional[OSError]
+
+
+class StagedFileIndex:
+    """Keeps the IDs, sizes and mtimes of the staged files in memory, so that
+    checking whether a file is staged needs no filesystem access.
+
+    The index is populated by scanning the staging directory and updated by the
+    writes of this process. Changes made by other processes are picked up via
+    inotify where available, watching the root and every shard directory, and by
+    periodic rescans. Only while all directories are watched is the index complete,
+    i.e. a file that is not in the index is known not to be staged. The number of
+    watches is limited, as each counts against the inotify limits of the user.
+    Beyond that, the index falls back to rescans. Changed files and directories are
+    looked up in a worker thread, in the order they are reported.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls,
+        *,
+        layout: StagingLayout,
+        rescan_interval: float,
+        use_inotify: bool,
+        max_watches: int,
+    ) -> AsyncGenerator["StagedFileIndex", None]:
+        """Setup a StagedFileIndex with an initial scan and keep it current until
+        teardown.
+
+        Args:
+            layout: The layout of the staging directory.
+            rescan_interval: Seconds between full rescans, 0 to disable them.
+            use_inotify: Whether to watch the directories via inotify if possible.
+            max_watches: The maximum number of directories watched via inotify.
+        """
+        index = cls(
+            layout=layout, rescan_interval=rescan_interval, max_watches=max_watches
+        )
+        if use_inotify:
+            # watch before scanning, so that no change falls in between
+            inotify = await asyncio.to_thread(index._add_watches)
+            if inotify is not None:
+                index._inotify = inotify
+                index._loop.add_reader(inotify.fd, index._handle_inotify)
+        try:
+            await index.rescan()
+        except OSError as error:
+            # the directory might become available later, see the health check
+            log.warning("Failed to scan %s: %s", layout.root, error)
+        rescanner = (
+            asyncio.create_task(index._rescan_periodically(rescan_interval))
+            if rescan_interval
+            else None
+        )
+        try:
+            yield index
+        finally:
+            if rescanner is not None:
+                rescanner.cancel()
+                with suppress(asyncio.CancelledError):
+                    await rescanner
+            if index._inotify is not None:
+                index._loop.remove_reader(index._inotify.fd)
+            if index._events_task is not None:
+                # the batch in progress still uses the inotify instance
+                await index._events_task
+            index._stop_watching()
+
+    def __init__(
+        self, *, layout: StagingLayout, rescan_interval: float, max_watches: int
+    ):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._layout = layout
+        self._rescan_interval = rescan_interval
+        self._max_watches = max_watches
+        self._files: dict[str, StagedFile] = {}
+        # changes made while a rescan is running, to be applied on top of its result
+        self._changes: Optional[dict[str, Optional[StagedFile]]] = None
+        self._rescan_task: Optional[asyncio.Task] = None
+        self._rescan_lock = asyncio.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._inotify: Optional[_Inotify] = None
+        # the watched directories and their shard depth by watch descriptor, only
+        # accessed by the thread applying the events once watching has begun
+        self._watches: dict[int, tuple[Path, int]] = {}
+        # the events to be applied, in the order they were reported
+        self._events: list[tuple[int, int, str]] = []
+        self._events_task: Optional[asyncio.Task] = None
+        # whether a scan has succeeded since inotify events were last lost
+        self._scanned = False
+        self._lost_events = 0
+
+    def __len__(self) -> int:
+        """Return the number of indexed files."""
+        return len(self._files)
+
+    def __contains__(self, file_id: object) -> bool:
+        """Check whether the file is staged."""
+        return file_id in self._files
+
+    @property
+    def complete(self) -> bool:
+        """Whether the index is known to contain all staged files, which is only the
+        case while the directories are watched via inotify and no events were lost.
+        """
+        return self._inotify is not None and self._scanned
+
+    def get(self, file_id: str) -> Optional[StagedFile]:
+        """Get the size and mtime of a staged file, or None if it is not staged."""
+        return self._files.get(file_id)
+
+    def copy(self) -> dict[str, StagedFile]:
+        """Get the sizes and mtimes of all staged files."""
+        return dict(self._files)
+
+    def add(self, file_id: str, staged_file: StagedFile) -> None:
+        """Record a staged file."""
+        self._files[file_id] = staged_file
+        if self._changes is not None:
+            self._changes[file_id] = staged_file
+        indexed_files.set(len(self._files))
+
+    def discard(self, file_id: str) -> None:
+        """Record that a file is no longer staged."""
+        self._files.pop(file_id, None)
+        if self._changes is not None:
+            self._changes[file_id] = None
+        indexed_files.set(len(self._files))
+
+    async def rescan(self) -> None:
+        """Replace the index with the result of a full scan of the directory.
+
+        Changes recorded while the scan runs are preserved.
+        """
+        async with self._rescan_lock:
+            lost_events = self._lost_events
+            changes: dict[str, Optional[StagedFile]] = {}
+            self._changes = changes
+            try:
+                files = await asyncio.to_thread(lambda: dict(self._layout.scan()))
+            finally:
+                self._changes = None
+            for file_id, staged_file in changes.items():
+                if staged_file is None:
+                    files.pop(file_id, None)
+                else:
+                    files[file_id] = staged_file
+            self._files = files
+            self._scanned = self._lost_events == lost_events
+        index_rescans.inc()
+        indexed_files.set(len(files))
+
+    async def _rescan_periodically(self, interval: float):
+        """Rescan the directory in the given interval."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.rescan()
+            except OSError:
+                log.exception("Failed to rescan %s", self._layout.root)
+
+    def _schedule_rescan(self):
+        """Rescan in the background unless a rescan is already scheduled."""
+        if self._rescan_task is None or self._rescan_task.done():
+            self._rescan_task = asyncio.create_task(self.rescan())
+
+    def _fallback(self) -> str:
+        """Describe how the index is kept current without inotify."""
+        if self._rescan_interval:
+            return f"rescanning every {self._rescan_interval} seconds instead"
+        return "looking up files missing from the index instead"
+
+    def _add_watch(self, inotify: _Inotify, directory: Path, depth: int):
+        """Watch a directory unless the maximum number of watches is reached.
+
+        Raises:
+            OSError: If the directory cannot be watched.
+        """
+        if len(self._watches) >= self._max_watches:
+            raise OSError(f"more than {self._max_watches} directories to watch")
+        self._watches[inotify.add_watch(directory)] = (directory, depth)
+
+    def _add_watches(self) -> Optional[_Inotify]:
+        """Watch the root and all shard directories via inotify, if possible."""
+        try:
+            inotify = _Inotify()
+        except OSError as error:
+            log.warning(
+                "Not watching %s via inotify, %s: %s",
+                self._layout.root,
+                self._fallback(),
+                error,
+            )
+            return None
+        try:
+            for directory, depth in self._layout.iter_shard_dirs():
+                self._add_watch(inotify, directory, depth)
+        except OSError as error:
+            log.warning(
+                "Not watching %s via inotify, %s: %s",
+                self._layout.root,
+                self._fallback(),
+                error,
+            )
+            inotify.close()
+            self._watches.clear()
+            return None
+        watched_directories.set(len(self._watches))
+        return inotify
+
+    def _stop_watching(self):
+        """Stop watching via inotify."""
+        if self._inotify is not None:
+            self._loop.remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        self._watches.clear()
+        self._events.clear()
+        watched_directories.set(0)
+
+    def _watch_shard(
+        self,
+        inotify: _Inotify,
+        directory: Path,
+        depth: int,
+        files: list[tuple[str, Optional[StagedFile]]],
+    ):
+        """Watch a new shard directory and collect what has been created in it before.
+
+        Each directory is watched before it is listed, so that every entry is either
+        listed or reported.
+
+        Raises:
+            OSError: If the directory cannot be watched.
+        """
+        self._add_watch(inotify, directory, depth)
+        if depth == self._layout.shard_levels:
+            with suppress(FileNotFoundError):
+                files.extend(self._layout.scan(directory, depth))
+            return
+        with suppress(FileNotFoundError), os.scandir(directory) as entries:
+            for entry in entries:
+                if self._layout.is_shard_name(entry.name) and entry.is_dir():
+                    self._watch_shard(inotify, Path(entry.path), depth + 1, files)
+
+    def _read_file_change(
+        self, directory: Path, mask: int, name: str
+    ) -> Optional[tuple[str, Optional[StagedFile]]]:
+        """Get the current state of a changed file, if it is a staged one."""
+        file_id = self._layout.decode_name(name)
+        if file_id is None or mask & IN_ISDIR:
+            return None
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            return file_id, None
+        try:
+            stat = (directory / name).stat()
+        except FileNotFoundError:
+            return file_id, None
+        return file_id, StagedFile(stat.st_size, stat.st_mtime)
+
+    def _read_changes(
+        self, inotify: _Inotify, events: list[tuple[int, int, str]]
+    ) -> _Changes:
+        """Look up what a batch of events changed, watching new shard directories.
+
+        This accesses the filesystem, so it is run in a worker thread.
+        """
+        files: list[tuple[str, Optional[StagedFile]]] = []
+        rescan = False
+        try:
+            for wd, mask, name in events:
+                if mask & IN_IGNORED:
+                    self._watches.pop(wd, None)
+                    continue
+                if wd not in self._watches:
+                    continue
+                directory, depth = self._watches[wd]
+                if depth == self._layout.shard_levels:
+                    change = self._read_file_change(directory, mask, name)
+                    if change is not None:
+                        files.append(change)
+                elif not (mask & IN_ISDIR and self._layout.is_shard_name(name)):
+                    continue
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_shard(inotify, directory / name, depth + 1, files)
+                else:
+                    # a shard has been removed along with the files in it
+                    rescan = True
+        except OSError as error:
+            return _Changes(files=files, rescan=rescan, error=error)
+        return _Changes(files=files, rescan=rescan, error=None)
+
+    async def _apply_events(self):
+        """Apply the queued inotify events batch by batch."""
+        while self._events and self._inotify is not None:
+            events, self._events = self._events, []
+            try:
+                changes = await asyncio.to_thread(
+                    self._read_changes, self._inotify, events
+                )
+            except Exception:
+                log.exception("Failed to apply inotify events, %s", self._fallback())
+                self._stop_watching()
+                return
+            for file_id, staged_file in changes.files:
+                if staged_file is None:
+                    self.discard(file_id)
+                else:
+                    self.add(file_id, staged_file)
+            if changes.rescan:
+                self._schedule_rescan()
+            if changes.error is not None:
+                log.warning(
+                    "Stopped watching %s via inotify, %s: %s",
+                    self._layout.root,
+                    self._fallback(),
+                    changes.error,
+                )
+                self._stop_watching()
+                return
+            watched_directories.set(len(self._watches))
+
+    def _handle_inotify(self):
+        """Queue the changes reported by inotify, to be applied in order."""
+        if self._inotify is None:
+            return
+        for wd, mask, name in self._inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # events have been lost, so only a rescan can tell the current state
+                self._lost_events += 1
+                self._scanned = False
+                self._schedule_rescan()
+            else:
+                self._events.append((wd, mask, name))
+        if self._events and (self._events_task is None or self._events_task.done()):
+            self._events_task = asyncio.create_task(self._apply_events())
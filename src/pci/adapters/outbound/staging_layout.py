@@ -0,0 +1,175 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""The layout of staged files in the local staging directory."""
+
+import hashlib
+import logging
+import os
+from collections.abc import Iterator
+from contextlib import suppress
+from pathlib import Path
+from typing import Optional
+from urllib.parse import quote, unquote
+
+from pci.ports.outbound.file_storage import StagedFile
+
+log = logging.getLogger(__name__)
+
+SHARD_WIDTH = 2
+
+
+class StagingLayout:
+    """Maps file IDs to paths below the staging directory.
+
+    Files are spread over nested shard directories named after the leading hex
+    digits of the SHA-256 hash of their ID, e.g. `ab/cd/<file_id>` with two levels,
+    so that no directory holds more than a fraction of the files. File IDs are
+    percent-encoded into a single, non-hidden path component, so that no ID can
+    escape the staging directory or collide with temporary files.
+    """
+
+    def __init__(self, *, root: Path, shard_levels: int):
+        self.root = root
+        self.shard_levels = shard_levels
+
+    @staticmethod
+    def encode_name(file_id: str) -> str:
+        """Get the file name of the file with the given ID.
+
+        Raises:
+            ValueError: If the file ID is empty.
+        """
+        if not file_id:
+            raise ValueError("The file ID must not be empty.")
+        name = quote(file_id, safe="")
+        # hidden names are reserved for temporary files, this also covers . and ..
+        return "%2E" + name[1:] if name.startswith(".") else name
+
+    @staticmethod
+    def decode_name(name: str) -> Optional[str]:
+        """Get the ID of the file with the given name, or None for temporary files."""
+        if name.startswith("."):
+            return None
+        return unquote(name)
+
+    def get_shards(self, file_id: str) -> list[str]:
+        """Get the names of the nested shard directories of a file."""
+        digest = hashlib.sha256(file_id.encode()).hexdigest()
+        return [
+            digest[level * SHARD_WIDTH : (level + 1) * SHARD_WIDTH]
+            for level in range(self.shard_levels)
+        ]
+
+    def get_path(self, file_id: str) -> Path:
+        """Get the path of the file with the given ID.
+
+        Raises:
+            ValueError: If the file ID is empty.
+        """
+        name = self.encode_name(file_id)
+        return self.root.joinpath(*self.get_shards(file_id), name)
+
+    @staticmethod
+    def is_shard_name(name: str) -> bool:
+        """Check whether a directory name can be a shard."""
+        return len(name) == SHARD_WIDTH and all(
+            char in "0123456789abcdef" for char in name
+        )
+
+    def scan(
+        self, directory: Optional[Path] = None, depth: int = 0
+    ) -> Iterator[tuple[str, StagedFile]]:
+        """List the staged files below a directory at the given shard depth, by
+        default all staged files, along with their sizes and mtimes.
+
+        Files that are not where the layout expects them are skipped.
+        """
+        directory = self.root if directory is None else directory
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                with suppress(FileNotFoundError):
+                    if depth < self.shard_levels:
+                        if self.is_shard_name(entry.name) and entry.is_dir():
+                            yield from self.scan(Path(entry.path), depth + 1)
+                        continue
+                    file_id = self.decode_name(entry.name)
+                    if file_id is not None and entry.is_file():
+                        stat = entry.stat()
+                        yield file_id, StagedFile(stat.st_size, stat.st_mtime)
+
+    def iter_shard_dirs(self) -> Iterator[tuple[Path, int]]:
+        """List the existing directories down to the deepest shards, starting with
+        the root, along with their depth.
+        """
+        pending = [(self.root, 0)]
+        while pending:
+            directory, depth = pending.pop()
+            yield directory, depth
+            if depth == self.shard_levels:
+                continue
+            with suppress(FileNotFoundError), os.scandir(directory) as entries:
+                pending.extend(
+                    (Path(entry.path), depth + 1)
+                    for entry in entries
+                    if self.is_shard_name(entry.name) and entry.is_dir()
+                )
+
+    def migrate(self, *, previous_levels: int, dry_run: bool = False) -> int:
+        """Move the staged files of a layout with the given number of shard levels,
+        e.g. a flat one, into the places this layout expects them.
+
+        Only regular files at the depth of the previous layout are moved, i.e.
+        directly in the root if it was flat and in shard directories otherwise, so
+        that other content of the staging directory is left alone. Shard directories
+        left empty are removed. If a file also exists in its expected place, that
+        copy is kept. Returns the number of files moved.
+        """
+        previous = StagingLayout(root=self.root, shard_levels=previous_levels)
+        moved = 0
+        # children are listed after their parents, so go bottom-up in reverse
+        for directory, depth in reversed(list(previous.iter_shard_dirs())):
+            if depth == previous_levels:
+                moved += self._move_files(directory, dry_run=dry_run)
+            if not dry_run and depth:
+                with suppress(OSError):
+                    directory.rmdir()  # only succeeds if empty
+        return moved
+
+    def _move_files(self, directory: Path, *, dry_run: bool) -> int:
+        """Move the staged files in a directory into place and return their number."""
+        with os.scandir(directory) as entries:
+            names = [
+                entry.name for entry in entries if entry.is_file(follow_symlinks=False)
+            ]
+        moved = 0
+        for name in names:
+            file_id = self.decode_name(name)
+            if file_id is None:
+                continue
+            source, target = directory / name, self.get_path(file_id)
+            if source == target:
+                continue
+            moved += 1
+            log.info("Moving %s to %s", source, target)
+            if dry_run:
+                continue
+            if target.exists():
+                source.unlink()
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, target)
+        return moved
@@ -0,0 +1,315 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Adapters for recording staging requests in memory or in a MongoDB collection."""
+
+import asyncio
+import logging
+from collections import defaultdict
+from collections.abc import AsyncGenerator, Sequence
+from contextlib import asynccontextmanager, suppress
+from typing import Any, Optional
+
+from hexkit.providers.mongodb import MongoDbConfig
+from hexkit.providers.mongodb.provider import MongoDbDaoNaturalId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings
+from pymongo import ASCENDING, IndexModel, UpdateOne
+
+from pci.models import StagingRecord, StagingStatus
+from pci.ports.outbound.staging_ledger import StagingLedgerPort
+
+log = logging.getLogger(__name__)
+
+INDEXED_FIELDS = ("file_id", "correlation_id", "status")
+
+
+class StagingLedgerConfig(BaseSettings):
+    """Config for the staging ledger.
+
+    The MongoDB connection parameters are only required when using the MongoDB
+    ledger.
+    """
+
+    db_connection_str: Optional[SecretStr] = Field(
+        default=None,
+        examples=["mongodb://localhost:27017"],
+        description="MongoDB connection string. Might include credentials.",
+    )
+    db_name: Optional[str] = Field(
+        default=None,
+        examples=["my-database"],
+        description="Name of the database located on the MongoDB server.",
+    )
+    staging_ledger_collection: str = Field(
+        default="stagingRequests",
+        description="The MongoDB collection the staging ledger is stored in.",
+    )
+    staging_ledger_batch_size: int = Field(
+        default=500,
+        description=(
+            "Buffered ledger updates are written as soon as this many have accumulated."
+        ),
+    )
+    staging_ledger_flush_interval: float = Field(
+        default=1.0,
+        description=(
+            "The maximum number of seconds ledger updates are buffered before they"
+            + " are written."
+        ),
+    )
+
+
+def _lookup_filter(
+    *,
+    file_id: Optional[str],
+    correlation_id: Optional[str],
+    status: Optional[StagingStatus],
+) -> dict[str, str]:
+    """Translate lookup criteria into a mapping of field names to values."""
+    if file_id is None and correlation_id is None:
+        raise StagingLedgerPort.MissingLookupKeyError()
+    criteria = {
+        "file_id": file_id,
+        "correlation_id": correlation_id,
+        "status": None if status is None else status.value,
+    }
+    return {field: value for field, value in criteria.items() if value is not None}
+
+
+class InMemStagingLedger(StagingLedgerPort):
+    """A staging ledger that only lives as long as the process.
+
+    Records are indexed by file ID, correlation ID and status.
+    """
+
+    def __init__(self):
+        self._records: dict[str, StagingRecord] = {}
+        self._indexes: dict[str, defaultdict[str, set[str]]] = {
+            field: defaultdict(set) for field in INDEXED_FIELDS
+        }
+
+    def _index(self, record: StagingRecord, *, remove: bool = False):
+        """Add the record to or remove it from the indexes."""
+        for field, index in self._indexes.items():
+            value = getattr(record, field)
+            key = value.value if isinstance(value, StagingStatus) else value
+            if remove:
+                index[key].discard(record.id)
+                if not index[key]:
+                    del index[key]
+            else:
+                index[key].add(record.id)
+
+    async def upsert_many(self, records: Sequence[StagingRecord]) -> None:
+        """Insert new records or update existing ones with the same ID."""
+        for record in records:
+            existing = self._records.get(record.id)
+            if existing is not None:
+                self._index(existing, remove=True)
+                record = existing.merge(record)
+            self._records[record.id] = record
+            self._index(record)
+
+    async def find(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Find all records matching all of the given criteria."""
+        criteria = _lookup_filter(
+            file_id=file_id, correlation_id=correlation_id, status=status
+        )
+        hits = set.intersection(
+            *(
+                self._indexes[field].get(value, set())
+                for field, value in criteria.items()
+            )
+        )
+        return [self._records[record_id] for record_id in sorted(hits)]
+
+
+class MongoStagingLedger(StagingLedgerPort):
+    """A staging ledger stored in a MongoDB collection.
+
+    Lookups go through a hexkit DAO. The collection is indexed by file ID, correlation
+    ID and status, and updates are sent as one unordered bulk write per batch.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: StagingLedgerConfig
+    ) -> AsyncGenerator["MongoStagingLedger", None]:
+        """Setup and teardown a MongoStagingLedger with its indexes."""
+        mongodb_config = MongoDbConfig(
+            db_connection_str=config.db_connection_str,
+            db_name=config.db_name,
+        )
+        client: Any = AsyncIOMotorClient(
+            mongodb_config.db_connection_str.get_secret_value()
+        )
+        try:
+            collection = client[mongodb_config.db_name][
+                config.staging_ledger_collection
+            ]
+            await collection.create_indexes(
+                [IndexModel([(field, ASCENDING)]) for field in INDEXED_FIELDS]
+            )
+            yield cls(collection=collection)
+        finally:
+            client.close()
+
+    def __init__(self, *, collection: Any):
+        """Please do not call directly! Should be called by the `construct` method.
+
+        Args:
+            collection: A motor collection, can be replaced for unit testing.
+        """
+        self._collection = collection
+        self._dao = MongoDbDaoNaturalId(
+            dto_model=StagingRecord, id_field="id", collection=collection
+        )
+
+    async def upsert_many(self, records: Sequence[StagingRecord]) -> None:
+        """Insert new records or update existing ones with the same ID.
+
+        The requested status is only set on insert, so that it never overwrites the
+        status of a staged or failed record written by another process before.
+        """
+        if not records:
+            return
+        operations = []
+        for record in records:
+            fields = record.model_dump(exclude_none=True, exclude={"id", "status"})
+            status = {"status": record.status.value}
+            update = (
+                {"$set": fields, "$setOnInsert": status}
+                if record.status == StagingStatus.REQUESTED
+                else {"$set": {**fields, **status}}
+            )
+            operations.append(UpdateOne({"_id": record.id}, update, upsert=True))
+        await self._collection.bulk_write(operations, ordered=False)
+
+    async def find(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Find all records matching all of the given criteria."""
+        criteria = _lookup_filter(
+            file_id=file_id, correlation_id=correlation_id, status=status
+        )
+        return [record async for record in self._dao.find_all(mapping=criteria)]
+
+
+class BufferedStagingLedger(StagingLedgerPort):
+    """Buffers updates in memory and writes them to another ledger in batches.
+
+    Updates of the same record are merged while buffered. A batch is written once
+    enough updates have accumulated or the flush interval has passed, and before
+    every lookup so that lookups see all preceding updates.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: StagingLedgerConfig, ledger: StagingLedgerPort
+    ) -> AsyncGenerator["BufferedStagingLedger", None]:
+        """Setup a BufferedStagingLedger that flushes in the background and write
+        the remaining updates on teardown.
+        """
+        buffered_ledger = cls(config=config, ledger=ledger)
+        flush_task = asyncio.create_task(buffered_ledger._flush_periodically())
+        try:
+            yield buffered_ledger
+        finally:
+            flush_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await flush_task
+            await buffered_ledger.flush()
+
+    def __init__(self, *, config: StagingLedgerConfig, ledger: StagingLedgerPort):
+        """Please do not call directly! Should be called by the `construct` method."""
+        self._ledger = ledger
+        self._batch_size = config.staging_ledger_batch_size
+        self._flush_interval = config.staging_ledger_flush_interval
+        self._buffer: dict[str, StagingRecord] = {}
+        self._batch_full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def _buffer_records(self, records: Sequence[StagingRecord]):
+        """Add records to the buffer, merging them with buffered updates."""
+        for record in records:
+            buffered = self._buffer.get(record.id)
+            self._buffer[record.id] = (
+                record if buffered is None else buffered.merge(record)
+            )
+
+    async def upsert_many(self, records: Sequence[StagingRecord]) -> None:
+        """Buffer the records to be inserted or updated with the next batch."""
+        self._buffer_records(records)
+        if len(self._buffer) >= self._batch_size:
+            self._batch_full.set()
+
+    async def flush(self) -> None:
+        """Write all buffered updates.
+
+        If writing fails, the updates are kept for the next attempt.
+        """
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = self._buffer, {}
+            try:
+                await self._ledger.upsert_many(list(batch.values()))
+            except BaseException:
+                newer, self._buffer = self._buffer, batch
+                self._buffer_records(list(newer.values()))
+                raise
+
+    async def _flush_periodically(self):
+        """Write buffered updates whenever a batch is full or the interval passed."""
+        while True:
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._batch_full.wait(), timeout=self._flush_interval
+                )
+            self._batch_full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception(
+                    "Failed to write %i staging ledger updates", len(self._buffer)
+                )
+
+    async def find(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Write buffered updates, then find all records matching all criteria."""
+        await self.flush()
+        return await self._ledger.find(
+            file_id=file_id, correlation_id=correlation_id, status=status
+        )
@@ -0,0 +1,240 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Adapters storing token buckets in memory or in a MongoDB collection."""
+
+import asyncio
+import logging
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime, timezone
+from time import monotonic, time
+from typing import Any, NamedTuple, Optional
+
+from hexkit.providers.mongodb import MongoDbConfig
+from motor.motor_asyncio import AsyncIOMotorClient
+from pydantic import Field, SecretStr
+from pydantic_settings import BaseSettings
+from pymongo import ReturnDocument
+
+from pci.ports.outbound.token_buckets import TokenBucketPort
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucketConfig(BaseSettings):
+    """Config for the token bucket store.
+
+    The MongoDB connection parameters are only required when sharing the buckets
+    between processes through MongoDB.
+    """
+
+    db_connection_str: Optional[SecretStr] = Field(
+        default=None,
+        examples=["mongodb://localhost:27017"],
+        description="MongoDB connection string. Might include credentials.",
+    )
+    db_name: Optional[str] = Field(
+        default=None,
+        examples=["my-database"],
+        description="Name of the database located on the MongoDB server.",
+    )
+    token_bucket_collection: str = Field(
+        default="tokenBuckets",
+        description="The MongoDB collection shared token buckets are stored in.",
+    )
+    token_bucket_sweep_interval: float = Field(
+        default=60.0,
+        description=(
+            "The number of seconds between removals of in-memory token buckets that"
+            + " have been refilled completely."
+        ),
+    )
+
+
+class _Bucket(NamedTuple):
+    """The state of a token bucket."""
+
+    tokens: float
+    updated: float
+    full_at: float
+
+
+class InMemTokenBuckets(TokenBucketPort):
+    """Token buckets that only live as long as the process.
+
+    Buckets are kept in a dict and updated in constant time. Buckets that have been
+    refilled completely behave like unknown ones and are swept periodically.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: TokenBucketConfig
+    ) -> AsyncGenerator["InMemTokenBuckets", None]:
+        """Setup InMemTokenBuckets that are swept in the background."""
+        token_buckets = cls()
+        sweep_task = asyncio.create_task(
+            token_buckets._sweep_periodically(config.token_bucket_sweep_interval)
+        )
+        try:
+            yield token_buckets
+        finally:
+            sweep_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await sweep_task
+
+    def __init__(self):
+        self._buckets: dict[str, _Bucket] = {}
+
+    def __len__(self) -> int:
+        """Return the number of buckets that are not full."""
+        return len(self._buckets)
+
+    async def take(
+        self, key: str, *, rate: float, burst: int, cost: float = 1.0
+    ) -> float:
+        """Take tokens from the bucket with the given key, return the seconds to wait
+        if there are not enough.
+        """
+        now = monotonic()
+        bucket = self._buckets.get(key)
+        tokens = (
+            float(burst)
+            if bucket is None
+            else min(float(burst), bucket.tokens + (now - bucket.updated) * rate)
+        )
+        if tokens < cost:
+            return (cost - tokens) / rate
+        tokens -= cost
+        self._buckets[key] = _Bucket(
+            tokens=tokens, updated=now, full_at=now + (burst - tokens) / rate
+        )
+        return 0.0
+
+    def sweep(self) -> int:
+        """Remove all buckets that have been refilled completely, return how many."""
+        now = monotonic()
+        full = [key for key, bucket in self._buckets.items() if bucket.full_at <= now]
+        for key in full:
+            del self._buckets[key]
+        return len(full)
+
+    async def _sweep_periodically(self, interval: float):
+        """Sweep the buckets every interval."""
+        while True:
+            await asyncio.sleep(interval)
+            swept = self.sweep()
+            log.debug("Swept %i full token buckets, %i remain", swept, len(self))
+
+
+class MongoTokenBuckets(TokenBucketPort):
+    """Token buckets shared between processes through a MongoDB collection.
+
+    Every take is a single atomic update, so concurrent processes never spend the
+    same tokens. Buckets are removed by a TTL index once refilled completely.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: TokenBucketConfig
+    ) -> AsyncGenerator["MongoTokenBuckets", None]:
+        """Setup and teardown MongoTokenBuckets with their TTL index."""
+        mongodb_config = MongoDbConfig(
+            db_connection_str=config.db_connection_str,
+            db_name=config.db_name,
+        )
+        client: Any = AsyncIOMotorClient(
+            mongodb_config.db_connection_str.get_secret_value()
+        )
+        try:
+            collection = client[mongodb_config.db_name][config.token_bucket_collection]
+            await collection.create_index("expires", expireAfterSeconds=0)
+            yield cls(collection=collection)
+        finally:
+            client.close()
+
+    def __init__(self, *, collection: Any):
+        """Please do not call directly! Should be called by the `construct` method.
+
+        Args:
+            collection: A motor collection, can be replaced for unit testing.
+        """
+        self._collection = collection
+
+    async def take(
+        self, key: str, *, rate: float, burst: int, cost: float = 1.0
+    ) -> float:
+        """Take tokens from the bucket with the given key, return the seconds to wait
+        if there are not enough.
+        """
+        now = time()
+        refilled = {
+            "$min": [
+                burst,
+                {
+                    "$add": [
+                        {"$ifNull": ["$tokens", burst]},
+                        {
+                            "$multiply": [
+                                {"$subtract": [now, {"$ifNull": ["$updated", now]}]},
+                                rate,
+                            ]
+                        },
+                    ]
+                },
+            ]
+        }
+        allowed = {"$gte": ["$tokens", cost]}
+        bucket = await self._collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": refilled, "updated": now}},
+                {
+                    "$set": {
+                        "allowed": allowed,
+                        "tokens": {
+                            "$cond": [
+                                allowed,
+                                {"$subtract": ["$tokens", cost]},
+                                "$tokens",
+                            ]
+                        },
+                    }
+                },
+                {
+                    "$set": {
+                        "expires": {
+                            "$add": [
+                                datetime.fromtimestamp(now, timezone.utc),
+                                {
+                                    "$multiply": [
+                                        {"$subtract": [burst, "$tokens"]},
+                                        1000 / rate,
+                                    ]
+                                },
+                            ]
+                        }
+                    }
+                },
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        if bucket["allowed"]:
+            return 0.0
+        return (cost - bucket["tokens"]) / rate
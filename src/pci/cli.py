@@ -20,7 +20,7 @@ import asyncio
 
 import typer
 
-from pci.main import consume_events, run_rest_app
+from pci.main import consume_events, migrate_staging_layout, run_rest_app
 
 cli = typer.Typer()
 
@@ -35,3 +35,19 @@ def sync_run_api():
 def sync_consume_events(run_forever: bool = True):
     """Run an event consumer listening to the specified topic."""
     asyncio.run(consume_events(run_forever=run_forever))
+
+
+@cli.command(name="migrate-staging")
+def sync_migrate_staging(
+    previous_levels: int = typer.Option(
+        ..., help="The number of shard levels of the layout to migrate from."
+    ),
+    dry_run: bool = False,
+):
+    """Move staged files into the configured layout of the staging directory."""
+    try:
+        moved = migrate_staging_layout(previous_levels=previous_levels, dry_run=dry_run)
+    except ValueError as error:
+        typer.echo(str(error), err=True)
+        raise typer.Exit(code=1) from error
+    typer.echo(f"{'Would move' if dry_run else 'Moved'} {moved} staged files.")
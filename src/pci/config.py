@@ -15,24 +15,107 @@
 
 """Config Parameter Modeling and Parsing."""
 
+from pathlib import Path
+from typing import Literal, Optional
+
 from ghga_service_commons.api import ApiConfigBase
 from hexkit.config import config_from_yaml
-from hexkit.providers.akafka import KafkaConfig
+from pydantic import Field, model_validator
 
+from pci.access_log import AccessLogConfig
 from pci.adapters.inbound.event_sub import EventSubTranslatorConfig
+from pci.adapters.inbound.fastapi_.admission import AdmissionConfig
+from pci.adapters.inbound.fastapi_.compression import CompressionConfig
+from pci.adapters.inbound.fastapi_.health import HealthConfig
+from pci.adapters.inbound.fastapi_.rate_limit import RateLimitConfig
+from pci.adapters.inbound.kafka_subscriber import KafkaSubscriberConfig
+from pci.adapters.inbound.metrics_server import MetricsServerConfig
 from pci.adapters.outbound.event_pub import EventPubTranslatorConfig
+from pci.adapters.outbound.kafka_producer import KafkaProducerConfig
+from pci.adapters.outbound.local_storage import LocalFileStorageConfig
+from pci.adapters.outbound.outbox import OutboxConfig
+from pci.adapters.outbound.s3_storage import S3FileStorageConfig
+from pci.adapters.outbound.staging_ledger import StagingLedgerConfig
+from pci.adapters.outbound.token_buckets import TokenBucketConfig
+from pci.core.capacity import CapacityConfig
+from pci.core.data_repository import DataRepositoryConfig
+from pci.shutdown import ShutdownConfig
 
 
 @config_from_yaml(prefix="pci")
 class Config(
     ApiConfigBase,
-    KafkaConfig,
+    AdmissionConfig,
+    RateLimitConfig,
+    CompressionConfig,
+    HealthConfig,
+    KafkaProducerConfig,
+    KafkaSubscriberConfig,
     EventPubTranslatorConfig,
+    OutboxConfig,
     EventSubTranslatorConfig,
+    MetricsServerConfig,
+    AccessLogConfig,
+    LocalFileStorageConfig,
+    S3FileStorageConfig,
+    StagingLedgerConfig,
+    TokenBucketConfig,
+    DataRepositoryConfig,
+    CapacityConfig,
+    ShutdownConfig,
 ):
     """Config parameters and their defaults."""
 
     service_name: str = "pci"
+    file_storage_backend: Literal["local", "s3"] = Field(
+        default="local",
+        description="Where staged files are stored: on the local filesystem or in S3.",
+    )
+    staging_ledger_backend: Literal["memory", "mongodb"] = Field(
+        default="memory",
+        description=(
+            "Where staging requests are recorded: in memory, for the lifetime of the"
+            + " process only, or in MongoDB. In memory, every process has a ledger of"
+            + " its own, so the REST API does not see the stagings recorded by the"
+            + " event consumer. Use MongoDB to share the ledger between processes."
+        ),
+    )
+    rate_limit_backend: Literal["memory", "mongodb"] = Field(
+        default="memory",
+        description=(
+            "Where the token buckets of the rate limits are kept: in memory, per"
+            + " process, or in MongoDB, shared between all processes."
+        ),
+    )
+
+    def find_foreign_directory(self) -> Optional[Path]:
+        """Get a directory holding other files than staged ones that the local
+        staging directory is or contains, i.e. the working directory or the outbox
+        directory if the outbox is enabled, or None if the staging directory is a
+        dedicated one.
+        """
+        staging_directory = self.staging_directory.resolve()
+        directories = [Path.cwd()]
+        if self.outbox_enabled:
+            directories.append(self.outbox_directory.resolve())
+        for directory in directories:
+            if staging_directory in (directory, *directory.parents):
+                return directory
+        return None
+
+    @model_validator(mode="after")
+    def check_eviction_directory(self) -> "Config":
+        """Make sure that files are only evicted from a dedicated staging directory,
+        as every file found in it is considered staged.
+        """
+        if not self.staging_eviction_enabled or self.file_storage_backend != "local":
+            return self
+        if (directory := self.find_foreign_directory()) is not None:
+            raise ValueError(
+                "Evicting staged files requires a dedicated staging directory, but"
+                + f" {self.staging_directory.resolve()} contains {directory}."
+            )
+        return self
 
 
 CONFIG = Config()  # type: ignore [call-arg]
@@ -17,18 +17,47 @@
 
 These should be moved into a library like GHGA-Service-Commons.
 """
+import inspect
 import logging
-from contextlib import asynccontextmanager
-from contextvars import ContextVar
-from typing import Any
+import os
+import re
+import sys
+from collections.abc import Iterable, Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar, Token, copy_context
+from functools import wraps
+from types import MappingProxyType
+from typing import Any, Callable, Generic, Optional, TypeVar, cast
+from urllib.parse import quote, unquote
+from uuid import uuid4
 
 log = logging.getLogger()
 
-correlation_id_var: ContextVar[str] = ContextVar("correlation_id", default="")
+T = TypeVar("T")
+F = TypeVar("F", bound=Callable[..., Any])
+
+CORRELATION_ID_HEADER_NAME = "X-Correlation-ID"
+SPAN_ID_HEADER_NAME = "X-Span-ID"
+BAGGAGE_HEADER_NAME = "X-Correlation-Baggage"
+
+# limits for baggage received from other hops, following the W3C baggage spec
+MAX_BAGGAGE_ITEMS = 64
+MAX_BAGGAGE_BYTES = 8192
+
+SPAN_ID_PATTERN = re.compile(r"^[0-9a-f]{16}$")
 
 __all__ = [
+    "CorrelationContext",
+    "correlation_id_var",
     "set_context_var",
+    "is_context_debugging",
+    "set_context_debugging",
+    "set_correlation_context",
     "set_correlation_id",
+    "with_correlation_id",
+    "ContextThreadPoolExecutor",
+    "ContextProcessPoolExecutor",
+    "get_correlation_context",
     "get_correlation_id",
 ]
 
@@ -37,23 +66,431 @@ class MissingCorrelationIdError(RuntimeError):
     """Raised when the correlation ID ContextVar is unexpectedly not set."""
 
 
-@asynccontextmanager
-async def set_context_var(context_var: ContextVar, value: Any):
-    """An async context manager to simplify the use of ContextVars.
+def new_span_id() -> str:
+    """Generate a random 64-bit span ID in hex representation."""
+    return os.urandom(8).hex()
+
+
+def _validate_span_id(span_id: str) -> str:
+    """Return the span ID received from another hop or an empty string if it is not
+    a 64-bit hex value.
+    """
+    if span_id and not SPAN_ID_PATTERN.match(span_id):
+        log.warning("Ignoring invalid span ID: %.32r", span_id)
+        return ""
+    return span_id
+
+
+def _limit_baggage(items: Iterable[tuple[str, str]]) -> dict[str, str]:
+    """Collect baggage items received from another hop.
+
+    Items beyond MAX_BAGGAGE_ITEMS or MAX_BAGGAGE_BYTES are dropped.
+    """
+    baggage: dict[str, str] = {}
+    size = 0
+    for key, value in items:
+        size += len(key.encode()) + len(value.encode())
+        if len(baggage) >= MAX_BAGGAGE_ITEMS or size > MAX_BAGGAGE_BYTES:
+            log.warning("Dropping baggage items exceeding the limits")
+            break
+        baggage[key] = value
+    return baggage
+
+
+class CorrelationContext:
+    """An immutable snapshot of the correlation state of a single hop.
+
+    Besides the correlation ID, which is shared by everything originating from the
+    same request, every hop (an HTTP request, a consumed event, a worker task) gets
+    its own span ID and remembers the span ID of the hop it was spawned from.
+    The baggage is a small string map that travels along with the correlation ID.
+
+    Instances cannot be modified. Use `child` or `with_baggage` to derive new ones.
+    """
+
+    __slots__ = ("_baggage", "correlation_id", "parent_id", "span_id")
+
+    correlation_id: str
+    span_id: str
+    parent_id: str
+    _baggage: dict[str, str]
+
+    def __init__(
+        self,
+        correlation_id: str,
+        span_id: str = "",
+        parent_id: str = "",
+        baggage: Optional[Mapping[str, str]] = None,
+    ):
+        object.__setattr__(self, "correlation_id", correlation_id)
+        object.__setattr__(self, "span_id", span_id)
+        object.__setattr__(self, "parent_id", parent_id)
+        object.__setattr__(self, "_baggage", dict(baggage) if baggage else {})
+
+    @classmethod
+    def new(
+        cls, correlation_id: str, baggage: Optional[Mapping[str, str]] = None
+    ) -> "CorrelationContext":
+        """Create the root context for a correlation ID with a fresh span ID."""
+        return cls(correlation_id, new_span_id(), "", baggage)
+
+    @property
+    def baggage(self) -> Mapping[str, str]:
+        """A read-only view of the baggage items."""
+        return MappingProxyType(self._baggage)
+
+    def child(self, **baggage: str) -> "CorrelationContext":
+        """Derive the context of a new hop spawned from this one.
+
+        The child keeps the correlation ID, gets a fresh span ID and references the
+        span ID of this context as its parent. Extra baggage items can be supplied as
+        keyword arguments.
+        """
+        merged = {**self._baggage, **baggage} if baggage else self._baggage
+        return CorrelationContext(
+            self.correlation_id, new_span_id(), self.span_id, merged
+        )
+
+    def with_baggage(self, **baggage: str) -> "CorrelationContext":
+        """Return a copy of this context with the given baggage items added."""
+        return CorrelationContext(
+            self.correlation_id,
+            self.span_id,
+            self.parent_id,
+            {**self._baggage, **baggage},
+        )
+
+    def to_headers(self) -> dict[str, str]:
+        """Serialize the context into headers to be sent to the next hop."""
+        headers = {
+            CORRELATION_ID_HEADER_NAME: self.correlation_id,
+            SPAN_ID_HEADER_NAME: self.span_id,
+        }
+        if self._baggage:
+            headers[BAGGAGE_HEADER_NAME] = ",".join(
+                f"{quote(key)}={quote(value)}" for key, value in self._baggage.items()
+            )
+        return headers
+
+    @classmethod
+    def from_headers(
+        cls, headers: Mapping[str, str], *, correlation_id: Optional[str] = None
+    ) -> "CorrelationContext":
+        """Create the context of a new hop from the headers sent by the previous one.
+
+        The span ID found in the headers becomes the parent ID of the new context.
+        If `correlation_id` is given, it takes precedence over the header value.
+        Invalid span IDs are ignored and the baggage is limited in size.
+        """
+        raw_baggage = headers.get(BAGGAGE_HEADER_NAME, "")
+        if len(raw_baggage) > MAX_BAGGAGE_BYTES * 3:
+            # bound the parsing work for oversized headers
+            raw_baggage = raw_baggage[: MAX_BAGGAGE_BYTES * 3].rpartition(",")[0]
+        items = (item.partition("=") for item in raw_baggage.split(","))
+        baggage = _limit_baggage(
+            (unquote(key.strip()), unquote(value.strip()))
+            for key, _, value in items
+            if key.strip()
+        )
+        return cls(
+            correlation_id
+            if correlation_id is not None
+            else headers.get(CORRELATION_ID_HEADER_NAME, ""),
+            new_span_id(),
+            _validate_span_id(headers.get(SPAN_ID_HEADER_NAME, "")),
+            baggage,
+        )
+
+    def to_event_fields(self) -> dict[str, Any]:
+        """Serialize the context into the correlation fields of an event payload."""
+        return {
+            "correlation_id": self.correlation_id,
+            "span_id": self.span_id,
+            "baggage": dict(self._baggage),
+        }
+
+    @classmethod
+    def from_event_fields(
+        cls, fields: Mapping[str, Any], *, correlation_id: Optional[str] = None
+    ) -> "CorrelationContext":
+        """Create the context of a new hop from the correlation fields of an event.
+
+        The span ID found in the event becomes the parent ID of the new context.
+        If `correlation_id` is given, it takes precedence over the event field.
+        Invalid span IDs are ignored and the baggage is limited in size.
+        """
+        return cls(
+            correlation_id
+            if correlation_id is not None
+            else fields.get("correlation_id", ""),
+            new_span_id(),
+            _validate_span_id(fields.get("span_id", "")),
+            _limit_baggage((fields.get("baggage") or {}).items()),
+        )
+
+    def __setattr__(self, name: str, value: Any):
+        """Refuse to modify the context."""
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str):
+        """Refuse to modify the context."""
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __copy__(self) -> "CorrelationContext":
+        """Immutable objects need not be copied."""
+        return self
+
+    def __deepcopy__(self, memo: dict) -> "CorrelationContext":
+        """Immutable objects need not be copied."""
+        return self
+
+    def __reduce__(self):
+        """Support pickling despite the immutability."""
+        return (
+            CorrelationContext,
+            (self.correlation_id, self.span_id, self.parent_id, self._baggage),
+        )
+
+    def __eq__(self, other: object) -> bool:
+        """Compare all fields of two contexts."""
+        if not isinstance(other, CorrelationContext):
+            return NotImplemented
+        return (
+            self.correlation_id == other.correlation_id
+            and self.span_id == other.span_id
+            and self.parent_id == other.parent_id
+            and self._baggage == other._baggage
+        )
+
+    def __hash__(self) -> int:
+        """Hash the identifying fields of the context."""
+        return hash((self.correlation_id, self.span_id, self.parent_id))
+
+    def __repr__(self) -> str:
+        """Show all fields of the context."""
+        return (
+            f"{type(self).__name__}(correlation_id={self.correlation_id!r}, "
+            + f"span_id={self.span_id!r}, parent_id={self.parent_id!r}, "
+            + f"baggage={self._baggage!r})"
+        )
+
+
+correlation_context_var: ContextVar[CorrelationContext] = ContextVar(
+    "correlation_context", default=CorrelationContext("")
+)
+
+
+class CorrelationIdVar:
+    """A stand-in for the former correlation ID ContextVar, which is kept for
+    compatibility and operates on the correlation context.
+
+    Setting a correlation ID starts a new root context for it.
+    """
+
+    name = "correlation_id"
+
+    def get(self) -> str:
+        """Get the correlation ID of the current correlation context."""
+        return correlation_context_var.get().correlation_id
+
+    def set(self, correlation_id: str) -> Token[CorrelationContext]:
+        """Set a new root correlation context for the correlation ID."""
+        return correlation_context_var.set(CorrelationContext.new(correlation_id))
+
+    def reset(self, token: Token[CorrelationContext]) -> None:
+        """Reset the correlation context to the value it had before the token was
+        created.
+        """
+        correlation_context_var.reset(token)
+
+
+correlation_id_var = CorrelationIdVar()
+
+
+class UnbalancedContextError(RuntimeError):
+    """Raised in debug mode when a ContextVarSetter is entered or exited out of order or
+    when the ContextVar was set inside of it without being reset.
+    """
+
+
+_debug = sys.flags.dev_mode
+
+
+def set_context_debugging(enabled: bool) -> None:
+    """Enable or disable the detection of leaked and unbalanced contexts.
+
+    This is enabled by default when Python runs in development mode (`python -X dev`).
+    """
+    global _debug
+    _debug = enabled
+
+
+def is_context_debugging() -> bool:
+    """Check whether the detection of leaked and unbalanced contexts is enabled."""
+    return _debug
+
+
+class ContextVarSetter(Generic[T]):
+    """A context manager to simplify the use of ContextVars.
+
+    The value is set upon entering and reset upon exiting the context, also if the
+    body raises. It can be used both with `with` and `async with`, so it also works in
+    sync code and in thread pool workers. An instance can be entered only once at a
+    time.
+
+    In debug mode (see `set_context_debugging`), an UnbalancedContextError is raised
+    when an instance is entered twice or exited without being entered, and when the
+    ContextVar does not hold the value set by this instance upon exiting, i.e. some
+    code in the body set the ContextVar without resetting it.
+    """
+
+    __slots__ = ("_context_var", "_token", "_value")
+
+    def __init__(self, context_var: ContextVar[T], value: T):
+        self._context_var = context_var
+        self._value = value
+        self._token: Optional[Token[T]] = None
+
+    def __enter__(self) -> T:
+        """Set the value of the ContextVar."""
+        if _debug and self._token is not None:
+            raise UnbalancedContextError(
+                f"Context for {self._context_var.name} was entered twice."
+            )
+        self._token = self._context_var.set(self._value)
+        return self._value
+
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None) -> None:
+        """Reset the ContextVar to the value it had before entering."""
+        token = self._token
+        if token is None:
+            if _debug:
+                raise UnbalancedContextError(
+                    f"Context for {self._context_var.name} was exited without"
+                    + " being entered."
+                )
+            return
+        self._token = None
+        if not _debug:
+            self._context_var.reset(token)
+            return
+
+        leaked = self._context_var.get() is not self._value
+        try:
+            self._context_var.reset(token)
+        except ValueError as error:
+            raise UnbalancedContextError(
+                f"Context for {self._context_var.name} was exited in another"
+                + " context than it was entered in."
+            ) from error
+        if leaked:
+            message = (
+                f"The value of {self._context_var.name} was set within the context"
+                + " without being reset."
+            )
+            if exc_type is not None:
+                # don't mask the original error
+                log.error(message)
+            else:
+                raise UnbalancedContextError(message)
+
+    async def __aenter__(self) -> T:
+        """Set the value of the ContextVar."""
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None) -> None:
+        """Reset the ContextVar to the value it had before entering."""
+        self.__exit__(exc_type, exc_value, traceback)
+
+
+class CorrelationContextSetter(ContextVarSetter[CorrelationContext]):
+    """A ContextVarSetter for the correlation context that logs the context it sets."""
+
+    __slots__ = ()
+
+    def __init__(self, context: CorrelationContext):
+        super().__init__(correlation_context_var, context)
+
+    def __enter__(self) -> CorrelationContext:
+        """Set the correlation context."""
+        context = self._value
+        log.info(
+            "Set context correlation ID to %s (span %s, parent span %s)",
+            context.correlation_id,
+            context.span_id,
+            context.parent_id,
+        )
+        return super().__enter__()
+
+
+def set_context_var(context_var: ContextVar[T], value: T) -> ContextVarSetter[T]:
+    """A context manager to simplify the use of ContextVars.
 
     The value will be reset upon exiting the context.
     """
-    token = context_var.set(value)
-    yield
-    context_var.reset(token)
+    return ContextVarSetter(context_var, value)
+
+
+def set_correlation_context(context: CorrelationContext) -> CorrelationContextSetter:
+    """Set the correlation context for the life of the context."""
+    return CorrelationContextSetter(context)
+
+
+def set_correlation_id(correlation_id: str) -> CorrelationContextSetter:
+    """Set the correlation ID for the life of the context.
+
+    This starts a new root context with a fresh span ID for the given correlation ID.
+    """
+    return CorrelationContextSetter(CorrelationContext.new(correlation_id))
+
 
+def _derive_correlation_context() -> CorrelationContext:
+    """Derive a child of the current correlation context or create a new root context
+    if none is set.
+    """
+    current = correlation_context_var.get()
+    if current.correlation_id:
+        return current.child()
+    correlation_id = str(uuid4())
+    log.warning("Generated new correlation id: %s", correlation_id)
+    return CorrelationContext.new(correlation_id)
 
-@asynccontextmanager
-async def set_correlation_id(correlation_id: str):
-    """Set the correlation ID for the life of the context."""
-    log.info("Set context correlation ID to %s", correlation_id)
-    async with set_context_var(correlation_id_var, correlation_id):
-        yield
+
+def with_correlation_id(func: F) -> F:
+    """Decorate a function or coroutine function to run in a correlation context.
+
+    If a correlation context is set when the function is called, the function runs in
+    a child span of it. Otherwise, a new correlation ID is generated.
+    """
+    if inspect.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with CorrelationContextSetter(_derive_correlation_context()):
+                return await func(*args, **kwargs)
+
+        return cast(F, async_wrapper)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with CorrelationContextSetter(_derive_correlation_context()):
+            return func(*args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+def get_correlation_context() -> CorrelationContext:
+    """Get the correlation context.
+
+    This should only be called when the correlation ID ContextVar is expected to be set.
+
+    Raises:
+        MissingCorrelationIdError: when the correlation ID ContextVar is not set.
+    """
+    context = correlation_context_var.get()
+    if not context.correlation_id:
+        raise MissingCorrelationIdError()
+    return context
 
 
 def get_correlation_id() -> str:
@@ -64,6 +501,39 @@ def get_correlation_id() -> str:
     Raises:
         MissingCorrelationIdError: when the correlation ID ContextVar is not set.
     """
-    if not (correlation_id := correlation_id_var.get()):
-        raise MissingCorrelationIdError()
-    return correlation_id
+    return get_correlation_context().correlation_id
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor that runs every submitted callable in a copy of the
+    context it was submitted from, so that ContextVars like the correlation context
+    are available in the worker threads.
+    """
+
+    def submit(self, fn: Callable[..., T], /, *args, **kwargs) -> "Future[T]":
+        """Submit a callable to be run in a copy of the current context."""
+        return super().submit(copy_context().run, fn, *args, **kwargs)
+
+
+def _run_in_correlation_context(
+    context: CorrelationContext, fn: Callable[..., T], args: tuple, kwargs: dict
+) -> T:
+    """Run a callable in a worker process with the transmitted correlation context."""
+    with CorrelationContextSetter(context):
+        return fn(*args, **kwargs)
+
+
+class ContextProcessPoolExecutor(ProcessPoolExecutor):
+    """A ProcessPoolExecutor that transmits the correlation context along with every
+    submitted callable and re-establishes it in the worker process.
+
+    The callable runs in a child span of the submitter's correlation context. Like
+    for any ProcessPoolExecutor, callables and their arguments must be picklable.
+    """
+
+    def submit(self, fn: Callable[..., T], /, *args, **kwargs) -> "Future[T]":
+        """Submit a callable to be run in the current correlation context."""
+        context = correlation_context_var.get()
+        if context.correlation_id:
+            context = context.child()
+        return super().submit(_run_in_correlation_context, context, fn, args, kwargs)
@@ -0,0 +1,275 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Keeping the staging storage below its capacity by evicting unused files."""
+
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager, suppress
+from time import time
+from typing import Callable, Optional
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.metrics import counter, gauge
+from pci.ports.outbound.file_storage import FileStoragePort, StagedFile
+
+log = logging.getLogger(__name__)
+
+staged_bytes = gauge("pci_staged_bytes", "The total size of all staged files.")
+staging_capacity = gauge(
+    "pci_staging_capacity_bytes",
+    "The total size of staged files above which files are evicted.",
+)
+evicted_files = counter(
+    "pci_evicted_files_total",
+    "Staged files evicted to stay below the capacity.",
+    labels=("outcome",),
+)
+evicted_bytes = counter("pci_evicted_bytes_total", "The total size of evicted files.")
+
+
+class CapacityConfig(BaseSettings):
+    """Config for evicting staged files."""
+
+    staging_eviction_enabled: bool = Field(
+        default=False,
+        description=(
+            "Whether this process evicts staged files, which requires a dedicated"
+            + " local staging directory. Evictions are not coordinated between"
+            + " processes, so enable it for exactly one REST API process per staging"
+            + " storage, i.e. one worker of one replica. Only the requests served by"
+            + " that process count as accesses."
+        ),
+    )
+    staging_high_water_mark: Optional[int] = Field(
+        default=None,
+        description=(
+            "Once the staged files take up more than this many bytes, the least"
+            + " recently requested ones are evicted if eviction is enabled. If not"
+            + " set, files are never evicted."
+        ),
+    )
+    staging_low_water_mark: Optional[int] = Field(
+        default=None,
+        description=(
+            "Files are evicted until the staged files take up no more than this"
+            + " many bytes. Defaults to 90% of the high-water mark."
+        ),
+    )
+    staging_capacity_sync_interval: float = Field(
+        default=60,
+        description=(
+            "The number of seconds between listings of the staged files, picking up"
+            + " files staged by other processes."
+        ),
+    )
+
+
+class StagingCapacityManager:
+    """Tracks the total size of the staged files and when each was last requested,
+    and evicts the least recently requested files in the background once the
+    high-water mark is exceeded.
+
+    Files staged by other processes are picked up by listing the storage
+    periodically. Files younger than the minimum age are never evicted, so that a
+    staging that was deduplicated against a recent one is not left without a file.
+    """
+
+    @classmethod
+    @asynccontextmanager
+    async def construct(
+        cls, *, config: CapacityConfig, file_storage: FileStoragePort, min_age: float
+    ) -> AsyncGenerator["StagingCapacityManager", None]:
+        """Setup a StagingCapacityManager that syncs with the storage and evicts
+        files in the background until teardown.
+        """
+        manager = cls(config=config, file_storage=file_storage, min_age=min_age)
+        task = asyncio.create_task(manager._manage())
+        try:
+            yield manager
+        finally:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    def __init__(
+        self, *, config: CapacityConfig, file_storage: FileStoragePort, min_age: float
+    ):
+        """Please do not call directly! Should be called by the `construct` method."""
+        high_water_mark = config.staging_high_water_mark or 0
+        self._high_water_mark = high_water_mark
+        self._low_water_mark = (
+            config.staging_low_water_mark
+            if config.staging_low_water_mark is not None
+            else int(high_water_mark * 0.9)
+        )
+        self._sync_interval = config.staging_capacity_sync_interval
+        self._file_storage = file_storage
+        self._min_age = min_age
+        # the staged files, least recently requested first
+        self._files: OrderedDict[str, StagedFile] = OrderedDict()
+        self._total_bytes = 0
+        self._over_capacity = asyncio.Event()
+        self._eviction_listeners: list[Callable[[str], None]] = []
+        staging_capacity.set(high_water_mark)
+
+    @property
+    def total_bytes(self) -> int:
+        """The total size of all tracked files."""
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        """Return the number of tracked files."""
+        return len(self._files)
+
+    def add_eviction_listener(self, listener: Callable[[str], None]) -> None:
+        """Call the listener with the ID of every evicted file, e.g. to drop it from
+        caches.
+        """
+        self._eviction_listeners.append(listener)
+
+    def _set(self, file_id: str, staged_file: StagedFile):
+        """Track a file as the most recently requested one."""
+        previous = self._files.pop(file_id, None)
+        if previous is not None:
+            self._total_bytes -= previous.size
+        self._files[file_id] = staged_file
+        self._total_bytes += staged_file.size
+        self._update_total()
+
+    def _remove(self, file_id: str):
+        """Stop tracking a file."""
+        previous = self._files.pop(file_id, None)
+        if previous is not None:
+            self._total_bytes -= previous.size
+            self._update_total()
+
+    def _update_total(self):
+        """Report the total size and trigger an eviction if it is too large."""
+        staged_bytes.set(self._total_bytes)
+        if self._total_bytes > self._high_water_mark:
+            self._over_capacity.set()
+
+    def record_access(self, file_id: str, size: Optional[int] = None) -> None:
+        """Record that a staged file has been requested.
+
+        Files that are not tracked yet, e.g. because they were staged by another
+        process since the last sync, are tracked right away if their size is given.
+        """
+        staged_file = self._files.get(file_id)
+        if staged_file is not None:
+            self._files.move_to_end(file_id)
+            if size is None or size == staged_file.size:
+                return
+            staged_file = staged_file._replace(size=size)
+        elif size is None:
+            return
+        else:
+            # the file has been staged recently, so it is too young to be evicted
+            staged_file = StagedFile(size, time())
+        self._set(file_id, staged_file)
+
+    async def sync(self) -> None:
+        """Update the tracked files from a listing of the storage.
+
+        Files that are new are considered requested at the time they were staged.
+        """
+        listed = await self._file_storage.list_files()
+        for file_id in [file_id for file_id in self._files if file_id not in listed]:
+            self._remove(file_id)
+        new_files = []
+        for file_id, staged_file in listed.items():
+            tracked = self._files.get(file_id)
+            if tracked is None:
+                new_files.append((file_id, staged_file))
+            elif tracked.size != staged_file.size or tracked.mtime < staged_file.mtime:
+                # the file has been staged again in the meantime
+                self._files[file_id] = staged_file
+                self._total_bytes += staged_file.size - tracked.size
+        for file_id, staged_file in sorted(new_files, key=lambda item: item[1].mtime):
+            self._set(file_id, staged_file)
+        self._update_total()
+
+    def _select_victims(self) -> list[str]:
+        """Select the least recently requested files that are old enough to be
+        evicted, until the low-water mark would be reached.
+        """
+        victims: list[str] = []
+        excess = self._total_bytes - self._low_water_mark
+        youngest = time() - self._min_age
+        for file_id, staged_file in self._files.items():
+            if excess <= 0:
+                break
+            if staged_file.mtime > youngest:
+                continue
+            victims.append(file_id)
+            excess -= staged_file.size
+        return victims
+
+    async def _evict_file(self, file_id: str):
+        """Delete a file from the storage, unless it has been staged again since it
+        was selected.
+        """
+        try:
+            staged_file = await self._file_storage.get_file(file_id)
+            if staged_file is not None:
+                if staged_file.mtime > time() - self._min_age:
+                    self._set(file_id, staged_file)
+                    return
+                await self._file_storage.delete(file_id)
+                evicted_bytes.inc(staged_file.size)
+        except Exception:
+            log.exception("Failed to evict %s", file_id)
+            evicted_files.inc(outcome="error")
+            return
+        evicted_files.inc(outcome="ok")
+        self._remove(file_id)
+        for listener in self._eviction_listeners:
+            listener(file_id)
+
+    async def evict(self) -> None:
+        """Evict the least recently requested files if the high-water mark is
+        exceeded, until the low-water mark is reached.
+        """
+        self._over_capacity.clear()
+        if self._total_bytes <= self._high_water_mark:
+            return
+        victims = self._select_victims()
+        if not victims:
+            log.warning(
+                "Staged files exceed the capacity but none is old enough to evict"
+            )
+        for file_id in victims:
+            await self._evict_file(file_id)
+
+    async def _manage(self):
+        """Sync with the storage periodically and evict files whenever the
+        high-water mark is exceeded.
+        """
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                log.exception("Failed to list the staged files")
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    self._over_capacity.wait(), timeout=self._sync_interval
+                )
+            await self.evict()
@@ -15,32 +15,112 @@
 #
 """Describes the concrete data repository object."""
 
+from datetime import datetime, timezone
+from typing import Optional
 
-from pci.config import Config
-from pci.context_vars import get_correlation_id
-from pci.models import NonStagedFileRequested
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.context_vars import get_correlation_context, get_correlation_id
+from pci.core.capacity import StagingCapacityManager
+from pci.core.download_urls import DownloadURLCache
+from pci.models import NonStagedFileRequested, StagingRecord, StagingStatus
 from pci.ports.inbound.data_repository import DataRepositoryPort
 from pci.ports.outbound.event_pub import EventPublisherPort
+from pci.ports.outbound.file_storage import FileStoragePort
+from pci.ports.outbound.staging_ledger import StagingLedgerPort
+from pci.ports.outbound.token_buckets import TokenBucketPort
+
+
+class DataRepositoryConfig(BaseSettings):
+    """Config for the data repository."""
+
+    download_redirect_enabled: bool = Field(
+        default=False,
+        description=(
+            "Whether requests for staged files are redirected to a presigned URL"
+            + " of the file storage instead of returning the file content."
+            + " Only has an effect if the file storage supports direct downloads."
+        ),
+    )
+    download_url_cache_size: int = Field(
+        default=10_000, description="The maximum number of download URLs to cache."
+    )
+    download_url_expiry_margin: int = Field(
+        default=60,
+        description=(
+            "Cached download URLs are renewed this many seconds before they expire."
+        ),
+    )
+    staging_rate_limit: float = Field(
+        default=1.0,
+        description=(
+            "The number of non-staged files a client may request per second on"
+            + " average, if rate limiting is enabled."
+        ),
+    )
+    staging_burst_limit: int = Field(
+        default=20,
+        description=(
+            "The number of non-staged files a client may request at once, if rate"
+            + " limiting is enabled."
+        ),
+    )
 
 
 class DataRepository(DataRepositoryPort):
     """Concrete implementation of the data repository."""
 
-    def __init__(self, *, config: Config, event_publisher: EventPublisherPort):
+    def __init__(  # noqa: PLR0913
+        self,
+        *,
+        config: DataRepositoryConfig,
+        event_publisher: EventPublisherPort,
+        file_storage: FileStoragePort,
+        staging_ledger: Optional[StagingLedgerPort] = None,
+        token_buckets: Optional[TokenBucketPort] = None,
+        capacity_manager: Optional[StagingCapacityManager] = None,
+    ):
         self._config = config
         self._event_publisher = event_publisher
+        self._file_storage = file_storage
+        self._staging_ledger = staging_ledger
+        self._token_buckets = token_buckets
+        self._download_urls = DownloadURLCache(
+            max_size=config.download_url_cache_size,
+            expiry_margin=config.download_url_expiry_margin,
+        )
+        self._capacity_manager = capacity_manager
+        if capacity_manager is not None:
+            capacity_manager.add_eviction_listener(self._download_urls.invalidate)
 
-    async def handle_request(self, file_id: str) -> str:
+    async def handle_request(
+        self, file_id: str, client_id: Optional[str] = None
+    ) -> str:
         """Handle a request for a file.
 
-        If the file doesn't exist, publish an event to request it.
+        If the file doesn't exist, publish an event to request it. If token buckets
+        are available, the client is limited in how many events it can trigger.
+
+        Raises:
+            StagingRateLimitError: If the client has exceeded the staging rate limit.
         """
         try:
-            with open(file_id, encoding="utf-8") as file:
-                return file.read()
-        except OSError:
+            content = await self._file_storage.read(file_id)
+        except FileStoragePort.FileNotStagedError:
+            if self._token_buckets is not None and client_id is not None:
+                retry_after = await self._token_buckets.take(
+                    f"staging:{client_id}",
+                    rate=self._config.staging_rate_limit,
+                    burst=self._config.staging_burst_limit,
+                )
+                if retry_after:
+                    raise self.StagingRateLimitError(
+                        client_id=client_id, retry_after=retry_after
+                    ) from None
+
             event = NonStagedFileRequested(
-                correlation_id=get_correlation_id(),
+                **get_correlation_context().to_event_fields(),
                 file_id=file_id,
                 target_object_id=file_id,
                 target_bucket_id="test",
@@ -48,5 +128,112 @@ class DataRepository(DataRepositoryPort):
                 decrypted_sha256="",
             )
 
+            # recorded before publishing, so the staging can never be recorded first
+            await self._record_staging(
+                file_id,
+                StagingStatus.REQUESTED,
+                requested_at=datetime.now(timezone.utc),
+            )
             await self._event_publisher.non_staged_file_requested(event=event)
             return "file requested"
+        self._record_access(file_id, len(content))
+        return content.decode("utf-8")
+
+    async def is_storage_available(self) -> bool:
+        """Check whether staged files can be read and written."""
+        return await self._file_storage.is_available()
+
+    async def get_download_url(self, file_id: str) -> Optional[str]:
+        """Get a URL to download a staged file directly from the file storage.
+
+        Returns None if redirects are disabled, the storage does not support them or
+        the file has not been staged.
+        """
+        if not self._config.download_redirect_enabled:
+            return None
+
+        if (url := self._download_urls.get(file_id)) is not None:
+            self._record_access(file_id)
+            return url
+
+        if not await self._file_storage.exists(file_id):
+            return None
+
+        download_url = await self._file_storage.get_download_url(file_id)
+        if download_url is None:
+            return None
+        self._download_urls.put(file_id, download_url)
+        self._record_access(file_id)
+        return download_url.url
+
+    def _record_access(self, file_id: str, size: Optional[int] = None):
+        """Record that a staged file has been requested, so that it is evicted
+        later than files that have not been requested recently.
+        """
+        if self._capacity_manager is not None:
+            self._capacity_manager.record_access(file_id, size)
+
+    async def stage_file(self, file_id: str) -> int:
+        """Stage a requested file and return the number of bytes written.
+
+        The staged content records the correlation ID it was staged for.
+        """
+        content = f"The name of this file is {file_id}\n{get_correlation_id()}".encode()
+        await self._file_storage.write(file_id, content)
+        await self._record_staging(
+            file_id, StagingStatus.STAGED, staged_at=datetime.now(timezone.utc)
+        )
+        return len(content)
+
+    async def mark_staged(self, file_id: str) -> None:
+        """Record that the request made under the current correlation ID is satisfied
+        by a file staged for an earlier request.
+        """
+        await self._record_staging(
+            file_id, StagingStatus.STAGED, staged_at=datetime.now(timezone.utc)
+        )
+
+    async def mark_failed(self, file_id: str) -> None:
+        """Record that staging the file requested under the current correlation ID
+        has failed for good.
+        """
+        await self._record_staging(file_id, StagingStatus.FAILED)
+
+    async def find_staging_records(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Find the recorded staging requests for a file or a correlation ID.
+
+        Without a staging ledger, nothing is recorded and nothing is found.
+        """
+        if self._staging_ledger is None:
+            return []
+        return await self._staging_ledger.find(
+            file_id=file_id, correlation_id=correlation_id, status=status
+        )
+
+    async def _record_staging(
+        self,
+        file_id: str,
+        status: StagingStatus,
+        *,
+        requested_at: Optional[datetime] = None,
+        staged_at: Optional[datetime] = None,
+    ):
+        """Record the status of the staging request made under the current
+        correlation ID, if there is a staging ledger.
+        """
+        if self._staging_ledger is None:
+            return
+        record = StagingRecord(
+            file_id=file_id,
+            correlation_id=get_correlation_id(),
+            status=status,
+            requested_at=requested_at,
+            staged_at=staged_at,
+        )
+        await self._staging_ledger.upsert_many([record])
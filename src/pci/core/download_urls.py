@@ -0,0 +1,62 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""A cache for the download URLs of staged files."""
+
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional
+
+from pci.ports.outbound.file_storage import DownloadURL
+
+
+class DownloadURLCache:
+    """A bounded cache of download URLs keyed by file ID.
+
+    URLs are handed out until `expiry_margin` seconds before they expire. When the cache
+    is full, the least recently used URL is dropped.
+    """
+
+    def __init__(self, *, max_size: int, expiry_margin: int):
+        self._max_size = max_size
+        self._expiry_margin = expiry_margin
+        self._urls: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def get(self, file_id: str) -> Optional[str]:
+        """Get the cached URL for the file if it is still valid long enough."""
+        try:
+            url, valid_until = self._urls[file_id]
+        except KeyError:
+            return None
+        if monotonic() >= valid_until:
+            del self._urls[file_id]
+            return None
+        self._urls.move_to_end(file_id)
+        return url
+
+    def put(self, file_id: str, download_url: DownloadURL) -> None:
+        """Cache a URL unless it expires too soon to be worth caching."""
+        lifetime = download_url.expires_after - self._expiry_margin
+        if lifetime <= 0 or self._max_size <= 0:
+            return
+        self._urls[file_id] = (download_url.url, monotonic() + lifetime)
+        self._urls.move_to_end(file_id)
+        if len(self._urls) > self._max_size:
+            self._urls.popitem(last=False)
+
+    def invalidate(self, file_id: str) -> None:
+        """Drop the cached URL of a file, e.g. when it is no longer staged."""
+        self._urls.pop(file_id, None)
@@ -20,39 +20,206 @@ from typing import Optional
 
 from fastapi import FastAPI
 from ghga_service_commons.utils.context import asyncnullcontext
-from hexkit.providers.akafka import KafkaEventPublisher, KafkaEventSubscriber
 
 from pci.adapters.inbound.event_sub import EventSubTranslator
 from pci.adapters.inbound.fastapi_ import dummies
 from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.inbound.fastapi_.health import CachedHealthChecks
+from pci.adapters.inbound.kafka_subscriber import InstrumentedKafkaEventSubscriber
 from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.kafka_producer import SharedKafkaProducer
+from pci.adapters.outbound.local_storage import LocalFileStorage
+from pci.adapters.outbound.outbox import OutboxEventPublisher
+from pci.adapters.outbound.s3_storage import S3FileStorage
+from pci.adapters.outbound.staging_ledger import (
+    BufferedStagingLedger,
+    InMemStagingLedger,
+    MongoStagingLedger,
+)
+from pci.adapters.outbound.token_buckets import InMemTokenBuckets, MongoTokenBuckets
 from pci.config import Config
+from pci.core.capacity import StagingCapacityManager
 from pci.core.data_repository import DataRepository
 from pci.ports.inbound.data_repository import DataRepositoryPort
+from pci.ports.outbound.event_pub import EventPublisherPort
+from pci.ports.outbound.file_storage import FileStoragePort
+from pci.ports.outbound.staging_ledger import StagingLedgerPort
+from pci.ports.outbound.token_buckets import TokenBucketPort
 
 
 @asynccontextmanager
-async def prepare_core(*, config: Config) -> AsyncGenerator[DataRepositoryPort, None]:
-    """Constructs and initializes all core components and their outbound dependencies."""
-    async with KafkaEventPublisher.construct(config=config) as kafka_event_publisher:
-        event_publisher = EventPubTranslator(
-            config=config, provider=kafka_event_publisher
+async def prepare_file_storage(
+    *, config: Config
+) -> AsyncGenerator[FileStoragePort, None]:
+    """Construct the file storage adapter selected in the config."""
+    if config.file_storage_backend == "s3":
+        async with S3FileStorage.construct(config=config) as s3_file_storage:
+            yield s3_file_storage
+    else:
+        async with LocalFileStorage.construct(config=config) as local_file_storage:
+            yield local_file_storage
+
+
+@asynccontextmanager
+async def prepare_staging_ledger(
+    *, config: Config
+) -> AsyncGenerator[StagingLedgerPort, None]:
+    """Construct the staging ledger selected in the config, buffering its updates."""
+    async with (
+        MongoStagingLedger.construct(config=config)
+        if config.staging_ledger_backend == "mongodb"
+        else asyncnullcontext(InMemStagingLedger())
+    ) as ledger, BufferedStagingLedger.construct(
+        config=config, ledger=ledger
+    ) as buffered_ledger:
+        yield buffered_ledger
+
+
+@asynccontextmanager
+async def prepare_token_buckets(
+    *, config: Config
+) -> AsyncGenerator[Optional[TokenBucketPort], None]:
+    """Construct the token bucket store selected in the config, or provide None if
+    rate limiting is disabled.
+    """
+    if not config.rate_limit_enabled:
+        yield None
+        return
+    async with (
+        MongoTokenBuckets.construct(config=config)
+        if config.rate_limit_backend == "mongodb"
+        else InMemTokenBuckets.construct(config=config)
+    ) as token_buckets:
+        yield token_buckets
+
+
+@asynccontextmanager
+async def prepare_kafka_producer(
+    *, config: Config
+) -> AsyncGenerator[SharedKafkaProducer, None]:
+    """Construct a Kafka producer warming up for all topics events are published to."""
+    async with SharedKafkaProducer.construct(
+        config=config, topics=[config.file_events_topic, config.dead_letter_topic]
+    ) as kafka_producer:
+        yield kafka_producer
+
+
+def prepare_kafka_producer_with_override(
+    *, config: Config, kafka_producer: Optional[SharedKafkaProducer] = None
+):
+    """Resolve the prepare_kafka_producer context manager based on config and an
+    existing producer to share (if any).
+    """
+    return (
+        asyncnullcontext(kafka_producer)
+        if kafka_producer
+        else prepare_kafka_producer(config=config)
+    )
+
+
+@asynccontextmanager
+async def prepare_event_publisher(
+    *, config: Config, kafka_producer: SharedKafkaProducer, use_outbox: bool = False
+) -> AsyncGenerator[EventPublisherPort, None]:
+    """Construct the event publisher, publishing through the outbox if requested."""
+    event_publisher = EventPubTranslator(
+        config=config, provider=kafka_producer.event_publisher
+    )
+    if not use_outbox:
+        yield event_publisher
+        return
+    async with OutboxEventPublisher.construct(
+        config=config, event_publisher=event_publisher
+    ) as outbox_event_publisher:
+        yield outbox_event_publisher
+
+
+@asynccontextmanager
+async def prepare_capacity_manager(
+    *, config: Config, file_storage: FileStoragePort, manage_capacity: bool
+) -> AsyncGenerator[Optional[StagingCapacityManager], None]:
+    """Construct a capacity manager if requested, eviction is enabled in the config
+    and a high-water mark is set.
+
+    Files younger than the deduplication window are never evicted, so that staging
+    requests the event subscriber skipped as duplicates still find their file.
+    """
+    if (
+        not manage_capacity
+        or not config.staging_eviction_enabled
+        or config.staging_high_water_mark is None
+    ):
+        yield None
+        return
+    async with StagingCapacityManager.construct(
+        config=config, file_storage=file_storage, min_age=config.dedup_window
+    ) as capacity_manager:
+        yield capacity_manager
+
+
+@asynccontextmanager
+async def prepare_core(
+    *,
+    config: Config,
+    use_outbox: bool = False,
+    token_buckets: Optional[TokenBucketPort] = None,
+    kafka_producer: Optional[SharedKafkaProducer] = None,
+    manage_capacity: bool = False,
+) -> AsyncGenerator[DataRepositoryPort, None]:
+    """Constructs and initializes all core components and their outbound dependencies.
+
+    Events are only published through the outbox if `use_outbox` is set, as every
+    outbox must be owned by a single process. Staging requests are only rate limited
+    if token buckets are provided. A Kafka producer is constructed unless an existing
+    one is provided to share. Staged files are only evicted if `manage_capacity` is
+    set and eviction is enabled in the config, as a single process should decide
+    which files to evict.
+    """
+    async with (
+        prepare_kafka_producer_with_override(
+            config=config, kafka_producer=kafka_producer
+        ) as shared_producer,
+        prepare_event_publisher(
+            config=config, kafka_producer=shared_producer, use_outbox=use_outbox
+        ) as event_publisher,
+        prepare_file_storage(config=config) as file_storage,
+        prepare_staging_ledger(config=config) as staging_ledger,
+        prepare_capacity_manager(
+            config=config, file_storage=file_storage, manage_capacity=manage_capacity
+        ) as capacity_manager,
+    ):
+        data_repository = DataRepository(
+            config=config,
+            event_publisher=event_publisher,
+            file_storage=file_storage,
+            staging_ledger=staging_ledger,
+            token_buckets=token_buckets,
+            capacity_manager=capacity_manager,
         )
-        data_repository = DataRepository(config=config, event_publisher=event_publisher)
 
         yield data_repository
 
 
-def prepare_core_with_override(
+def prepare_core_with_override(  # noqa: PLR0913
     *,
     config: Config,
     core_override: Optional[DataRepositoryPort] = None,
+    use_outbox: bool = False,
+    token_buckets: Optional[TokenBucketPort] = None,
+    kafka_producer: Optional[SharedKafkaProducer] = None,
+    manage_capacity: bool = False,
 ):
     """Resolve the prepare_core context manager based on config and override (if any)."""
     return (
         asyncnullcontext(core_override)
         if core_override
-        else prepare_core(config=config)
+        else prepare_core(
+            config=config,
+            use_outbox=use_outbox,
+            token_buckets=token_buckets,
+            kafka_producer=kafka_producer,
+            manage_capacity=manage_capacity,
+        )
     )
 
 
@@ -61,35 +228,67 @@ async def prepare_rest_app(
     *,
     config: Config,
     data_respository_override: Optional[DataRepositoryPort] = None,
+    kafka_producer: Optional[SharedKafkaProducer] = None,
 ) -> AsyncGenerator[FastAPI, None]:
     """Construct and initialize an REST API app along with all its dependencies.
     By default, the core dependencies are automatically prepared but you can also
-    provide them using the override parameter.
+    provide them using the override parameter. The app only reports to be ready
+    once the Kafka producer, which can be shared with other components of the
+    process, is warmed up and connected, and the file storage is available.
     """
-    app = get_configured_app(config=config)
-
-    async with prepare_core_with_override(
-        config=config, core_override=data_respository_override
-    ) as data_repository:
+    async with (
+        prepare_token_buckets(config=config) as token_buckets,
+        prepare_kafka_producer_with_override(
+            config=config, kafka_producer=kafka_producer
+        ) as shared_producer,
+        prepare_core_with_override(
+            config=config,
+            core_override=data_respository_override,
+            use_outbox=config.outbox_enabled,
+            token_buckets=token_buckets,
+            kafka_producer=shared_producer,
+            manage_capacity=True,
+        ) as data_repository,
+    ):
+        app = get_configured_app(config=config, token_buckets=token_buckets)
         app.dependency_overrides[dummies.data_repository_port] = lambda: data_repository
+        app.state.health_checks = CachedHealthChecks(
+            config=config,
+            checks={
+                "kafka": shared_producer.is_connected,
+                "storage": data_repository.is_storage_available,
+            },
+        )
         yield app
 
 
 @asynccontextmanager
 async def prepare_event_subscriber(
-    *, config: Config, core_override: Optional[DataRepositoryPort] = None
+    *,
+    config: Config,
+    core_override: Optional[DataRepositoryPort] = None,
+    kafka_producer: Optional[SharedKafkaProducer] = None,
 ):
     """Construct and initialize an event subscriber with all its dependencies.
     By default, the core dependencies are automatically prepared but you can also
-    provide them using the core_override parameter.
+    provide them using the core_override parameter. The core and the dead-letter
+    publisher share one Kafka producer, which can also be shared with other
+    components of the process.
     """
-    async with prepare_core_with_override(
-        config=config, core_override=core_override
-    ) as data_repository:
-        event_sub_translator = EventSubTranslator(
-            data_repository=data_repository, config=config
-        )
-        async with KafkaEventSubscriber.construct(
+    async with (
+        prepare_kafka_producer_with_override(
+            config=config, kafka_producer=kafka_producer
+        ) as shared_producer,
+        prepare_core_with_override(
+            config=config, core_override=core_override, kafka_producer=shared_producer
+        ) as data_repository,
+        EventSubTranslator.construct(
+            config=config,
+            data_repository=data_repository,
+            dead_letter_publisher=shared_producer.event_publisher,
+        ) as event_sub_translator,
+        InstrumentedKafkaEventSubscriber.construct(
             config=config, translator=event_sub_translator
-        ) as kafka_event_subscriber:
-            yield kafka_event_subscriber
+        ) as kafka_event_subscriber,
+    ):
+        yield kafka_event_subscriber
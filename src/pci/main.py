@@ -14,23 +14,119 @@
 # limitations under the License.
 #
 """Top-level service functions"""
-from ghga_service_commons.api import run_server
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from types import FrameType
+from typing import Optional
 
+import uvicorn
+from fastapi import FastAPI
+
+from pci.access_log import access_log_listener
+from pci.adapters.inbound.metrics_server import serve_metrics
+from pci.adapters.outbound.local_storage import get_staging_layout
 from pci.config import Config
 from pci.inject import prepare_event_subscriber, prepare_rest_app
+from pci.shutdown import GracefulShutdown
+
+
+class _Server(uvicorn.Server):
+    """A uvicorn server notifying the graceful shutdown when asked to exit."""
+
+    def __init__(self, config: uvicorn.Config, shutdown: GracefulShutdown):
+        super().__init__(config)
+        self._shutdown = shutdown
+
+    def handle_exit(self, sig: int, frame: Optional[FrameType]) -> None:
+        """Begin the shutdown and let uvicorn stop accepting requests.
+
+        This is called by a signal handler installed with `signal.signal`, so the
+        shutdown is begun on the event loop rather than right here.
+        """
+        self._shutdown.begin_threadsafe()
+        super().handle_exit(sig, frame)
+
+
+async def _run_server(*, app: FastAPI, config: Config, shutdown: GracefulShutdown):
+    """Run the REST API until asked to exit, then finish in-flight requests."""
+    uv_config = uvicorn.Config(
+        app=app,
+        host=config.host,
+        port=config.port,
+        log_level=config.log_level,
+        reload=config.auto_reload,
+        workers=config.workers,
+        timeout_graceful_shutdown=config.shutdown_timeout,
+    )
+    await _Server(uv_config, shutdown).serve()
 
 
 async def run_rest_app():
-    """Run the HTTP REST API."""
+    """Run the HTTP REST API.
+
+    On shutdown, in-flight requests are completed before the outbox is drained and
+    the publisher is flushed, each within a timeout of its own. The metrics are served on a port of their own, and
+    stay available for a while after a shutdown, so the duration can be scraped.
+    """
     config = Config()  # type: ignore [call-arg]
 
-    async with prepare_rest_app(config=config) as app:
-        await run_server(app=app, config=config)
+    with access_log_listener(config=config):
+        async with serve_metrics(config=config):
+            with GracefulShutdown(
+                config=config, process="rest", handle_signals=False
+            ) as shutdown:
+                async with prepare_rest_app(config=config) as app:
+                    await _run_server(app=app, config=config, shutdown=shutdown)
+                    shutdown.begin_teardown()
+            if config.metrics_enabled and shutdown.stopping.is_set():
+                await asyncio.sleep(config.metrics_linger)
 
 
 async def consume_events(run_forever: bool = False):
-    """Run an event consumer listening to the specified topic."""
+    """Run an event consumer listening to the specified topic.
+
+    On shutdown, the event being processed and the stagings already queued are
+    completed before the offsets of handled events are committed and the publishers
+    are flushed. Blocking file I/O runs in a bounded pool of threads. The metrics
+    stay available for a while after a shutdown, so the duration can be scraped.
+    """
     config = Config()  # type: ignore [call-arg]
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=config.staging_io_threads, thread_name_prefix="staging-io"
+        )
+    )
+
+    with access_log_listener(config=config):
+        async with serve_metrics(config=config):
+            with GracefulShutdown(config=config, process="consumer") as shutdown:
+                async with prepare_event_subscriber(config=config) as event_subscriber:
+                    if run_forever:
+                        await event_subscriber.run_until(shutdown.stopping)
+                    else:
+                        await event_subscriber.run(forever=False)
+                    shutdown.begin_teardown()
+            if config.metrics_enabled and shutdown.stopping.is_set():
+                await asyncio.sleep(config.metrics_linger)
+
 
-    async with prepare_event_subscriber(config=config) as event_subscriber:
-        await event_subscriber.run(forever=run_forever)
+def migrate_staging_layout(*, previous_levels: int, dry_run: bool = False) -> int:
+    """Move the files in the local staging directory from a layout with the given
+    number of shard levels into the configured layout and return the number of files
+    moved.
+
+    Should be run while no other process uses the staging directory.
+
+    Raises:
+        ValueError: If the staging directory is not a dedicated one, i.e. it contains
+            the working directory or the outbox directory.
+    """
+    config = Config()  # type: ignore [call-arg]
+    if (directory := config.find_foreign_directory()) is not None:
+        raise ValueError(
+            f"The staging directory {config.staging_directory.resolve()} contains"
+            + f" {directory}, please use a dedicated staging directory."
+        )
+    return get_staging_layout(config).migrate(
+        previous_levels=previous_levels, dry_run=dry_run
+    )
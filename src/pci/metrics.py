@@ -0,0 +1,267 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Minimal in-process metrics rendered in the Prometheus text exposition format.
+
+Metrics are created through the module-level `counter`, `gauge` and `histogram`
+functions, which register them with the default registry or return the already
+registered metric of the same name. All metrics can be updated from any thread.
+"""
+
+import threading
+from bisect import bisect_left
+from collections.abc import Iterable, Sequence
+from math import inf
+from typing import Optional, TypeVar
+
+__all__ = [
+    "REGISTRY",
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "MetricsRegistry",
+    "counter",
+    "gauge",
+    "histogram",
+]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value, using the Prometheus spelling of infinity."""
+    if value == inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    """Format label names and values as a label set."""
+    if not names:
+        return ""
+    pairs = (
+        name
+        + '="'
+        + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class _Metric:
+    """Base class of all metrics, holding one value per combination of labels."""
+
+    type_name = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        """Get the label values in the order of the label names."""
+        if labels.keys() != set(self.label_names):
+            raise ValueError(
+                f"Metric {self.name} requires the labels {self.label_names}."
+            )
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> Iterable[tuple[str, LabelValues, float]]:
+        """Yield the name suffix, label values and value of all samples."""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text format."""
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        with self._lock:
+            samples = list(self._samples())
+        for suffix, label_values, value in samples:
+            names = (
+                (*self.label_names, "le") if suffix == "_bucket" else self.label_names
+            )
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, label_values)}"
+                + f" {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class _ScalarMetric(_Metric):
+    """Base class of metrics holding a single number per combination of labels."""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def _add(self, amount: float, labels: dict[str, str]):
+        """Add to the value for the given labels."""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Get the current value for the given labels."""
+        return self._values.get(self._label_values(labels), 0)
+
+    def _samples(self):
+        for label_values, value in self._values.items():
+            yield "", label_values, value
+
+
+class Counter(_ScalarMetric):
+    """A value that only ever increases."""
+
+    type_name = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the value of the counter for the given labels."""
+        if amount < 0:
+            raise ValueError("Counters can only be increased.")
+        self._add(amount, labels)
+
+
+class Gauge(_ScalarMetric):
+    """A value that can go up and down."""
+
+    type_name = "gauge"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the value of the gauge for the given labels."""
+        self._add(amount, labels)
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Decrease the value of the gauge for the given labels."""
+        self._add(-amount, labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the value of the gauge for the given labels."""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Buckets:
+    """The observations of a histogram for one combination of labels."""
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, size: int):
+        # the last count is the one of the implicit +Inf bucket
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+
+
+class Histogram(_Metric):
+    """Counts observed values in cumulative buckets and tracks their sum."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[LabelValues, _Buckets] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observed value for the given labels."""
+        key = self._label_values(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            buckets = self._values.get(key)
+            if buckets is None:
+                buckets = self._values[key] = _Buckets(len(self.buckets))
+            buckets.counts[index] += 1
+            buckets.sum += value
+
+    def count(self, **labels: str) -> int:
+        """Get the number of observed values for the given labels."""
+        buckets = self._values.get(self._label_values(labels))
+        return sum(buckets.counts) if buckets else 0
+
+    def _samples(self):
+        for label_values, buckets in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, inf), buckets.counts):
+                cumulative += count
+                yield "_bucket", (*label_values, _format_value(bound)), cumulative
+            yield "_sum", label_values, buckets.sum
+            yield "_count", label_values, cumulative
+
+
+MetricType = TypeVar("MetricType", bound=_Metric)
+
+
+class MetricsRegistry:
+    """A collection of uniquely named metrics."""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: MetricType) -> MetricType:
+        """Register a metric, or return the registered metric of the same name."""
+        with self._lock:
+            registered = self._metrics.setdefault(metric.name, metric)
+        if type(registered) is not type(metric):
+            raise ValueError(f"Metric {metric.name} is registered as another type.")
+        return registered  # type: ignore[return-value]
+
+    def get(self, name: str) -> Optional[_Metric]:
+        """Get a registered metric by name."""
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, description: str, labels: Sequence[str] = ()) -> Counter:
+    """Get or create a counter in the default registry."""
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name: str, description: str, labels: Sequence[str] = ()) -> Gauge:
+    """Get or create a gauge in the default registry."""
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(
+    name: str,
+    description: str,
+    labels: Sequence[str] = (),
+    buckets: Optional[Sequence[float]] = None,
+) -> Histogram:
+    """Get or create a histogram in the default registry."""
+    return REGISTRY.register(
+        Histogram(name, description, labels, buckets or DEFAULT_BUCKETS)
+    )
@@ -13,15 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-"""Contains an event model used to simulate correlation ID in header."""
+"""Contains an event model used to simulate correlation ID in header and the models
+of the staging ledger.
+"""
+from datetime import datetime
+from enum import Enum
+from typing import Any, Optional
+
 from ghga_event_schemas.pydantic_ import NonStagedFileRequested as Event
-from pydantic import Field
+from pydantic import BaseModel, Field, model_validator
 
 
 class NonStagedFileRequested(Event):
-    """A copy of NonStagedFileRequested with a `correlation_id` field added.
+    """A copy of NonStagedFileRequested with the correlation context fields added.
 
-    The reason this is used is that the correlation ID would actually be stored in
+    The reason this is used is that the correlation context would actually be stored in
     the header field of a Kafka event, and accessing event headers is not currently
     supported by hexkit.
     """
@@ -32,3 +38,71 @@ class NonStagedFileRequested(Event):
             "A unique ID used to track the flow of events related to a single request."
         ),
     )
+    span_id: str = Field(
+        "",
+        description="The ID of the span (hop) that published this event.",
+    )
+    baggage: dict[str, str] = Field(
+        default_factory=dict,
+        description="Small key-value items propagated along with the correlation ID.",
+    )
+    priority: str = Field(
+        "",
+        description=(
+            "The priority class of the staging, e.g. 'bulk'. If empty, the 'priority'"
+            + " baggage item or else the default priority applies."
+        ),
+    )
+
+
+class StagingStatus(str, Enum):
+    """The status of a staging request."""
+
+    REQUESTED = "requested"
+    STAGED = "staged"
+    FAILED = "failed"
+
+
+class StagingRecord(BaseModel):
+    """A record of a request to stage a file, made under a specific correlation ID.
+
+    Timestamps that are None are not known (yet).
+    """
+
+    id: str = Field(
+        default="",
+        description=(
+            "The file ID and the correlation ID, joined by a colon. Derived if not"
+            + " given."
+        ),
+    )
+    file_id: str = Field(..., description="The ID of the requested file.")
+    correlation_id: str = Field(
+        ..., description="The correlation ID of the request that caused the staging."
+    )
+    status: StagingStatus = Field(..., description="The current status.")
+    requested_at: Optional[datetime] = Field(
+        default=None, description="When the staging was requested."
+    )
+    staged_at: Optional[datetime] = Field(
+        default=None, description="When the file was staged."
+    )
+
+    @model_validator(mode="before")
+    @classmethod
+    def derive_id(cls, data: Any) -> Any:
+        """Derive the ID from the file ID and the correlation ID if not given."""
+        if isinstance(data, dict) and not data.get("id"):
+            data = {**data, "id": f"{data.get('file_id')}:{data.get('correlation_id')}"}
+        return data
+
+    def merge(self, update: "StagingRecord") -> "StagingRecord":
+        """Return a copy of this record updated with the set fields of another one.
+
+        The status of a staged or failed record is not set back to requested, since
+        the updates of different processes may arrive in any order.
+        """
+        fields = update.model_dump(exclude_none=True)
+        if update.status == StagingStatus.REQUESTED:
+            del fields["status"]
+        return self.model_copy(update=fields)
@@ -15,11 +15,61 @@
 #
 """Contains a class establishing the data repository port."""
 from abc import ABC, abstractmethod
+from typing import Optional
+
+from pci.models import StagingRecord, StagingStatus
 
 
 class DataRepositoryPort(ABC):
     """Basic port"""
 
+    class StagingRateLimitError(RuntimeError):
+        """Raised when a client requests non-staged files faster than allowed."""
+
+        def __init__(self, *, client_id: str, retry_after: float):
+            super().__init__(
+                f"Client '{client_id}' exceeded the staging rate limit, retry after"
+                + f" {retry_after:.1f} seconds."
+            )
+            self.retry_after = retry_after
+
+    @abstractmethod
+    async def handle_request(
+        self, file_id: str, client_id: Optional[str] = None
+    ) -> str:
+        """Handle a request
+
+        Raises:
+            StagingRateLimitError: If the file needs to be staged but the client has
+                exceeded the staging rate limit.
+        """
+
+    @abstractmethod
+    async def is_storage_available(self) -> bool:
+        """Check whether staged files can be read and written."""
+
+    @abstractmethod
+    async def get_download_url(self, file_id: str) -> Optional[str]:
+        """Get a URL to download a staged file directly, if supported."""
+
+    @abstractmethod
+    async def stage_file(self, file_id: str) -> int:
+        """Stage a requested file and return the number of bytes written."""
+
+    @abstractmethod
+    async def mark_staged(self, file_id: str) -> None:
+        """Record that a request is satisfied by a file staged for an earlier one."""
+
+    @abstractmethod
+    async def mark_failed(self, file_id: str) -> None:
+        """Record that staging a requested file has failed for good."""
+
     @abstractmethod
-    async def handle_request(self, file_id: str) -> str:
-        """Handle a request"""
+    async def find_staging_records(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Find the recorded staging requests for a file or a correlation ID."""
@@ -0,0 +1,104 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Interface for storing and retrieving staged files."""
+
+from abc import ABC, abstractmethod
+from typing import NamedTuple, Optional
+
+
+class StagedFile(NamedTuple):
+    """The size and modification time of a staged file."""
+
+    size: int
+    mtime: float
+
+
+class DownloadURL(NamedTuple):
+    """A URL to download a staged file directly along with its validity in seconds."""
+
+    url: str
+    expires_after: int
+
+
+class FileStoragePort(ABC):
+    """A port through which staged files are stored and retrieved."""
+
+    class FileNotStagedError(RuntimeError):
+        """Raised when a file is requested that is not in the staging storage."""
+
+        def __init__(self, *, file_id: str):
+            message = f"The file with ID '{file_id}' has not been staged."
+            super().__init__(message)
+
+    class ChecksumMismatchError(RuntimeError):
+        """Raised when the content of a file does not match its expected checksum."""
+
+        def __init__(self, *, file_id: str, expected: str, actual: str):
+            message = (
+                f"The SHA-256 checksum of the file with ID '{file_id}' is {actual},"
+                + f" expected {expected}."
+            )
+            super().__init__(message)
+
+    @abstractmethod
+    async def is_available(self) -> bool:
+        """Check whether the staging storage can be reached and written to."""
+
+    @abstractmethod
+    async def exists(self, file_id: str) -> bool:
+        """Check whether the file with the given ID has been staged."""
+
+    @abstractmethod
+    async def get_file(self, file_id: str) -> Optional[StagedFile]:
+        """Get the size and modification time of a staged file, or None if the file
+        has not been staged.
+        """
+
+    @abstractmethod
+    async def list_files(self) -> dict[str, StagedFile]:
+        """List all staged files by ID along with their sizes and modification times."""
+
+    @abstractmethod
+    async def read(self, file_id: str) -> bytes:
+        """Read the content of a staged file.
+
+        Raises:
+            FileNotStagedError: If the file has not been staged.
+        """
+
+    @abstractmethod
+    async def write(self, file_id: str, content: bytes, *, sha256: str = "") -> None:
+        """Store the content of a file in the staging storage.
+
+        If a SHA-256 checksum is given, the content is verified while it is written
+        and the file is not stored if it does not match.
+
+        Raises:
+            ChecksumMismatchError: If the content does not match the checksum.
+        """
+
+    @abstractmethod
+    async def delete(self, file_id: str) -> None:
+        """Remove a file from the staging storage, if it has been staged."""
+
+    @abstractmethod
+    async def get_download_url(self, file_id: str) -> Optional[DownloadURL]:
+        """Get a URL from which a staged file can be downloaded directly.
+
+        Returns None if the storage does not support direct downloads. Whether the
+        file has been staged is not checked, so the URL might not work otherwise.
+        """
@@ -0,0 +1,54 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Interface for recording and looking up staging requests."""
+
+from abc import ABC, abstractmethod
+from collections.abc import Sequence
+from typing import Optional
+
+from pci.models import StagingRecord, StagingStatus
+
+
+class StagingLedgerPort(ABC):
+    """A port through which staging requests are recorded and looked up."""
+
+    class MissingLookupKeyError(ValueError):
+        """Raised when looking up records without a file ID or correlation ID."""
+
+        def __init__(self):
+            super().__init__("Either a file ID or a correlation ID must be specified.")
+
+    @abstractmethod
+    async def upsert_many(self, records: Sequence[StagingRecord]) -> None:
+        """Insert new records or update existing ones with the same ID.
+
+        Timestamps that are None do not overwrite stored values.
+        """
+
+    @abstractmethod
+    async def find(
+        self,
+        *,
+        file_id: Optional[str] = None,
+        correlation_id: Optional[str] = None,
+        status: Optional[StagingStatus] = None,
+    ) -> list[StagingRecord]:
+        """Find all records matching all of the given criteria.
+
+        Raises:
+            MissingLookupKeyError: If neither a file ID nor a correlation ID is given.
+        """
@@ -0,0 +1,37 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Interface for rate limiting with token buckets."""
+
+from abc import ABC, abstractmethod
+
+
+class TokenBucketPort(ABC):
+    """A port to a store of token buckets identified by keys."""
+
+    @abstractmethod
+    async def take(
+        self, key: str, *, rate: float, burst: int, cost: float = 1.0
+    ) -> float:
+        """Take tokens from the bucket with the given key.
+
+        A bucket holds up to `burst` tokens and is refilled with `rate` tokens per
+        second. Unknown buckets start out full.
+
+        Returns:
+            Zero if the tokens were taken, otherwise the number of seconds until
+            enough tokens are available. No tokens are taken in that case.
+        """
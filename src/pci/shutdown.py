@@ -0,0 +1,163 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Coordination of graceful shutdowns.
+
+On a termination signal, a process stops taking on new work and drains the work in
+flight: open requests or the event being processed. Then it tears down, publishing
+pending events and flushing buffered writes. Both phases have a budget of their own,
+after which the remaining work is cancelled.
+"""
+
+import asyncio
+import logging
+import signal
+from time import monotonic
+from typing import Optional
+
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+from pci.metrics import gauge
+
+log = logging.getLogger(__name__)
+
+shutdown_duration = gauge(
+    "pci_shutdown_duration_seconds",
+    "The time the last graceful shutdown of the process took.",
+    labels=("process",),
+)
+
+TERMINATION_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class ShutdownConfig(BaseSettings):
+    """Config for graceful shutdowns."""
+
+    shutdown_timeout: int = Field(
+        default=30,
+        description=(
+            "The number of seconds in-flight work is given to complete on shutdown"
+            + " before it is cancelled."
+        ),
+    )
+    shutdown_teardown_timeout: int = Field(
+        default=10,
+        description=(
+            "The number of seconds given on shutdown, once in-flight work has"
+            + " completed, to drain the outbox and flush the publishers and the"
+            + " staging ledger before they are cancelled."
+        ),
+    )
+
+
+class GracefulShutdown:
+    """A context manager turning termination signals into a stop event.
+
+    Once `begin` has been called, either by a signal handler or by a server that
+    handles signals itself, the task that entered the context is cancelled when the
+    budgets of both the drain and the teardown have passed. Calling `begin_teardown`
+    once the drain has completed gives the teardown its full budget from then on, so
+    a server that enforces the drain timeout itself can use all of it. On exit, the
+    duration of the shutdown is reported.
+    """
+
+    def __init__(
+        self,
+        *,
+        config: ShutdownConfig,
+        process: str,
+        handle_signals: bool = True,
+    ):
+        self._timeout = config.shutdown_timeout
+        self._teardown_timeout = config.shutdown_teardown_timeout
+        self._process = process
+        self._handle_signals = handle_signals
+        self.stopping = asyncio.Event()
+        self._started: Optional[float] = None
+        self._deadline: Optional[asyncio.TimerHandle] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __enter__(self) -> "GracefulShutdown":
+        """Install the signal handlers."""
+        self._task = asyncio.current_task()
+        self._loop = asyncio.get_running_loop()
+        if self._handle_signals:
+            for signal_number in TERMINATION_SIGNALS:
+                self._loop.add_signal_handler(signal_number, self.begin)
+        return self
+
+    def __exit__(self, *_):
+        """Remove the signal handlers and report the shutdown duration."""
+        if self._handle_signals and self._loop is not None:
+            for signal_number in TERMINATION_SIGNALS:
+                self._loop.remove_signal_handler(signal_number)
+        if self._deadline is not None:
+            self._deadline.cancel()
+        if self._started is not None:
+            duration = monotonic() - self._started
+            shutdown_duration.set(duration, process=self._process)
+            log.info("Shut down %s in %.3f seconds", self._process, duration)
+
+    def begin(self) -> None:
+        """Begin to shut down, or cancel the work right away if already shutting down."""
+        if self.stopping.is_set():
+            log.warning("Shutdown of %s forced", self._process)
+            self._cancel()
+            return
+        log.info(
+            "Shutting down %s, draining work for up to %s seconds",
+            self._process,
+            self._timeout,
+        )
+        self._started = monotonic()
+        self.stopping.set()
+        self._deadline = asyncio.get_running_loop().call_later(
+            self._timeout + self._teardown_timeout, self._time_out
+        )
+
+    def begin_threadsafe(self) -> None:
+        """Begin to shut down from a signal handler that is not run by the event loop,
+        or from another thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.begin)
+
+    def begin_teardown(self) -> None:
+        """Give the teardown its own budget, now that the work in flight is drained."""
+        if not self.stopping.is_set():
+            return
+        if self._deadline is not None:
+            self._deadline.cancel()
+        log.info(
+            "Tearing down %s for up to %s seconds",
+            self._process,
+            self._teardown_timeout,
+        )
+        self._deadline = asyncio.get_running_loop().call_later(
+            self._teardown_timeout, self._time_out
+        )
+
+    def _time_out(self):
+        """Cancel the remaining work once the deadline has passed."""
+        log.error("Shutdown of %s timed out, cancelling remaining work", self._process)
+        self._cancel()
+
+    def _cancel(self):
+        """Cancel the task that is draining the work."""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
@@ -0,0 +1,35 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Stand-ins for events received by a Kafka consumer."""
+
+from dataclasses import dataclass, field
+
+from hexkit.custom_types import JsonObject
+
+
+@dataclass
+class FakeConsumerEvent:
+    """An event as received from the consumer."""
+
+    topic: str
+    partition: int
+    offset: int
+    key: str = ""
+    value: JsonObject = field(default_factory=dict)
+    headers: list[tuple[str, bytes]] = field(
+        default_factory=lambda: [("type", b"test_type")]
+    )
@@ -26,6 +26,7 @@ from pci.config import Config
 from pci.inject import (
     prepare_core,
     prepare_event_subscriber,
+    prepare_kafka_producer,
     prepare_rest_app,
 )
 from pci.ports.inbound.data_repository import DataRepositoryPort
@@ -50,13 +51,20 @@ async def joint_fixture(
     """Fixture function to produce the JointFixture."""
     config = get_config(sources=[kafka_fixture.config])
 
-    async with prepare_core(config=config) as data_repository:
+    async with (
+        prepare_kafka_producer(config=config) as kafka_producer,
+        prepare_core(config=config, kafka_producer=kafka_producer) as data_repository,
+    ):
         async with (
             prepare_rest_app(
-                config=config, data_respository_override=data_repository
+                config=config,
+                data_respository_override=data_repository,
+                kafka_producer=kafka_producer,
             ) as app,
             prepare_event_subscriber(
-                config=config, core_override=data_repository
+                config=config,
+                core_override=data_repository,
+                kafka_producer=kafka_producer,
             ) as event_subscriber,
         ):
             async with AsyncTestClient(app=app) as rest_client:
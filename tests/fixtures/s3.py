@@ -0,0 +1,121 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""An in-memory stand-in for an S3 client."""
+
+import hashlib
+from datetime import datetime, timezone
+from io import BytesIO
+from typing import Any
+
+from botocore.exceptions import ClientError
+
+# the modification time of objects added directly rather than by put_object
+EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+
+class FakeS3Client:
+    """An in-memory stand-in for a boto3 S3 client supporting the calls used by the
+    S3FileStorage. All range requests are recorded. The ETag of an object is the
+    MD5 checksum of its content, as with objects uploaded in a single part.
+    """
+
+    def __init__(self):
+        self.objects: dict[tuple[str, str], bytes] = {}
+        self.modified: dict[tuple[str, str], datetime] = {}
+        self.range_requests: list[str] = []
+        self.presigned_url_count = 0
+        self.buckets = {"staging"}
+
+    def _get_content(self, params: dict[str, Any], operation: str) -> bytes:
+        try:
+            return self.objects[(params["Bucket"], params["Key"])]
+        except KeyError:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, operation) from None
+
+    def head_bucket(self, **params) -> dict[str, Any]:
+        """Fail for buckets that don't exist."""
+        if params["Bucket"] not in self.buckets:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadBucket")
+        return {}
+
+    def head_object(self, **params) -> dict[str, Any]:
+        """Return the object size and modification time."""
+        content = self._get_content(params, "HeadObject")
+        return {
+            "ContentLength": len(content),
+            "LastModified": self.modified.get((params["Bucket"], params["Key"]), EPOCH),
+        }
+
+    def get_object(self, **params) -> dict[str, Any]:
+        """Return the requested range of an object if the ETag matches."""
+        content = self._get_content(params, "GetObject")
+        self.range_requests.append(params["Range"])
+        etag = f'"{hashlib.md5(content).hexdigest()}"'
+        if params.get("IfMatch", etag) != etag:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "GetObject")
+        start, end = (int(pos) for pos in params["Range"][6:].split("-"))
+        if start >= len(content):
+            raise ClientError({"Error": {"Code": "InvalidRange"}}, "GetObject")
+        end = min(end, len(content) - 1)
+        return {
+            "Body": BytesIO(content[start : end + 1]),
+            "ContentRange": f"bytes {start}-{end}/{len(content)}",
+            "ETag": etag,
+        }
+
+    def put_object(self, **params) -> None:
+        """Store an object."""
+        key = (params["Bucket"], params["Key"])
+        self.objects[key] = bytes(params["Body"])
+        self.modified[key] = datetime.now(timezone.utc)
+
+    def delete_object(self, **params) -> None:
+        """Delete an object if it exists."""
+        key = (params["Bucket"], params["Key"])
+        self.objects.pop(key, None)
+        self.modified.pop(key, None)
+
+    def list_objects_v2(self, **params) -> dict[str, Any]:
+        """List the objects of a bucket, two per page."""
+        keys = sorted(key for bucket, key in self.objects if bucket == params["Bucket"])
+        start = int(params.get("ContinuationToken", 0))
+        contents = [
+            {
+                "Key": key,
+                "Size": len(self.objects[(params["Bucket"], key)]),
+                "LastModified": self.modified.get((params["Bucket"], key), EPOCH),
+            }
+            for key in keys[start : start + 2]
+        ]
+        truncated = start + 2 < len(keys)
+        return {
+            "Contents": contents,
+            "IsTruncated": truncated,
+            **({"NextContinuationToken": str(start + 2)} if truncated else {}),
+        }
+
+    def generate_presigned_url(self, client_method: str, **kwargs) -> str:
+        """Return a fake presigned URL."""
+        self.presigned_url_count += 1
+        params = kwargs["Params"]
+        return (
+            f"https://s3.example.org/{params['Bucket']}/{params['Key']}"
+            + f"?X-Amz-Expires={kwargs['ExpiresIn']}"
+        )
+
+    def close(self) -> None:
+        """Nothing to close."""
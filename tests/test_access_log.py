@@ -0,0 +1,151 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the structured access log."""
+
+import json
+import logging
+import threading
+
+import pytest
+from fastapi import Request, Response
+
+from pci.access_log import (
+    AccessLogConfig,
+    access_log_listener,
+    dropped_records,
+    log_access,
+)
+from pci.adapters.inbound.fastapi_.utils import (
+    CORRELATION_ID_HEADER_NAME,
+    InvalidCorrelationIdError,
+    correlation_id_middleware,
+)
+from pci.context_vars import set_correlation_id
+
+
+class ListHandler(logging.Handler):
+    """Collects the formatted log lines, optionally blocking until released."""
+
+    def __init__(self, released: threading.Event):
+        super().__init__()
+        self.lines: list[str] = []
+        self.released = released
+
+    def emit(self, record: logging.LogRecord):
+        """Store the formatted record."""
+        self.released.wait(timeout=10)
+        self.lines.append(self.format(record))
+
+
+def get_handler() -> ListHandler:
+    """Get a non-blocking ListHandler."""
+    released = threading.Event()
+    released.set()
+    return ListHandler(released)
+
+
+@pytest.mark.asyncio
+async def test_request_access_log():
+    """Verify that the middleware writes one JSON line with the expected fields."""
+    config = AccessLogConfig()
+    handler = get_handler()
+    correlation_id = "a8c1c33a-54e0-4a6f-91c6-8d93ab1f2c52"
+    request = Request(
+        scope={
+            "type": "http",
+            "method": "GET",
+            "path": "/test.txt",
+            "headers": [
+                (CORRELATION_ID_HEADER_NAME.lower().encode(), correlation_id.encode())
+            ],
+        }
+    )
+
+    async def call_next(_: Request) -> Response:
+        return Response(content=b"12345", status_code=200)
+
+    with access_log_listener(config=config, handler=handler) as queue_handler:
+        await correlation_id_middleware(request, call_next)
+
+    assert queue_handler is not None
+    assert len(handler.lines) == 1
+    entry = json.loads(handler.lines[0])
+    assert entry["kind"] == "request"
+    assert entry["correlation_id"] == correlation_id
+    assert entry["route"] == "/test.txt"
+    assert entry["status"] == 200
+    assert entry["bytes"] == 5
+    assert entry["latency_ms"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_invalid_request_access_log():
+    """Verify that requests rejected for an invalid correlation ID are logged."""
+    handler = get_handler()
+    request = Request(
+        scope={
+            "type": "http",
+            "method": "GET",
+            "path": "/test.txt",
+            "headers": [(CORRELATION_ID_HEADER_NAME.lower().encode(), b"BAD_ID")],
+        }
+    )
+
+    async def call_next(_: Request) -> Response:
+        return Response(status_code=200)
+
+    with access_log_listener(config=AccessLogConfig(), handler=handler):
+        with pytest.raises(InvalidCorrelationIdError):
+            await correlation_id_middleware(request, call_next)
+
+    entry = json.loads(handler.lines[0])
+    assert entry["status"] == "invalid"
+    assert entry["correlation_id"] == "BAD_ID"
+
+
+def test_access_log_overflow():
+    """Verify that records are dropped and counted instead of blocking when the queue
+    is full.
+    """
+    config = AccessLogConfig(access_log_queue_size=1)
+    released = threading.Event()
+    handler = ListHandler(released)
+
+    dropped_before = dropped_records.value()
+    with access_log_listener(config=config, handler=handler) as queue_handler:
+        assert queue_handler is not None
+        with set_correlation_id("id123"):
+            for _ in range(20):
+                log_access(kind="event", route="topic/type", status="ok", started=0)
+        dropped = queue_handler.dropped_records
+        released.set()
+    assert dropped_records.value() == dropped_before + dropped
+
+    # the listener holds at most one record and the queue another one
+    assert dropped >= 18
+    assert len(handler.lines) == 20 - dropped
+    assert json.loads(handler.lines[0])["correlation_id"] == "id123"
+
+
+def test_access_log_disabled():
+    """Verify that nothing is logged when the access log is disabled."""
+    handler = get_handler()
+    config = AccessLogConfig(access_log_enabled=False)
+    with access_log_listener(config=config, handler=handler) as queue_handler:
+        log_access(kind="event", route="topic/type", status="ok", started=0)
+    assert queue_handler is None
+    assert not handler.lines
@@ -0,0 +1,142 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the admission control of the REST API."""
+
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from ghga_service_commons.api.testing import AsyncTestClient
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from pci.adapters.inbound.fastapi_.admission import (
+    AdmissionConfig,
+    AdmissionController,
+    admission_decisions,
+)
+from pci.adapters.inbound.fastapi_.utils import correlation_id_middleware
+from pci.context_vars import CORRELATION_ID_HEADER_NAME
+
+CORRELATION_ID = "0c6a7d1e-58b4-4a43-9d5e-3f2b1c8e9a77"
+
+
+def get_controller(**kwargs) -> AdmissionController:
+    """Get an admission controller with a limit of one concurrent request."""
+    config = AdmissionConfig(admission_initial_limit=1, admission_min_limit=1, **kwargs)
+    return AdmissionController(config=config)
+
+
+@pytest.mark.asyncio
+async def test_queue_by_priority():
+    """Test that waiting requests are admitted by priority, then by arrival."""
+    controller = get_controller()
+    assert await controller.acquire() is None
+
+    admitted: list[str] = []
+
+    async def wait(name: str, priority: int):
+        assert await controller.acquire(priority) is None
+        admitted.append(name)
+
+    waiters = [
+        asyncio.create_task(wait(name, priority))
+        for name, priority in (("low", -1), ("first", 0), ("high", 5), ("second", 0))
+    ]
+    await asyncio.sleep(0)
+    for _ in waiters:
+        controller.release(latency=0.0, overloaded=False)
+        await asyncio.sleep(0)
+    await asyncio.gather(*waiters)
+    assert admitted == ["high", "first", "second", "low"]
+
+
+@pytest.mark.asyncio
+async def test_shed_on_timeout_and_full_queue():
+    """Test that requests are shed when they can't be admitted in time."""
+    controller = get_controller(admission_queue_timeout=0.01, admission_max_queue=1)
+    assert await controller.acquire() is None
+    waiter = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    assert await controller.acquire() == "queue_full"
+    assert await waiter == "queue_timeout"
+
+    # the slot of the timed out request is not leaked
+    controller.release(latency=0.0, overloaded=False)
+    assert await controller.acquire() is None
+
+
+def test_adaptive_limit():
+    """Test that the limit grows while requests are fast and shrinks otherwise."""
+    controller = get_controller(
+        admission_latency_target=0.1, admission_backoff_ratio=0.5
+    )
+    controller._limit = 4.0
+    for _ in range(8):
+        controller._take_slot()
+        controller.release(latency=0.01, overloaded=False)
+    assert controller.limit == 4, "grew while mostly idle"
+
+    controller._take_slot()
+    controller._take_slot()
+    for _ in range(8):
+        controller._take_slot()
+        controller.release(latency=0.01, overloaded=False)
+    assert controller.limit == 5
+
+    controller._take_slot()
+    controller.release(latency=1.0, overloaded=False)
+    assert controller.limit == 2
+
+    controller._take_slot()
+    controller.release(latency=0.01, overloaded=True)
+    assert controller.limit == 2, "decreased twice within the latency target"
+
+
+@pytest.mark.asyncio
+async def test_shed_response():
+    """Test that shed requests get a 503 response with the correlation ID."""
+    controller = get_controller(admission_queue_timeout=0.01)
+    release = asyncio.Event()
+
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow():
+        await release.wait()
+        return {}
+
+    app.add_middleware(BaseHTTPMiddleware, dispatch=controller.dispatch)
+    app.add_middleware(BaseHTTPMiddleware, dispatch=correlation_id_middleware)
+
+    shed_before = admission_decisions.value(outcome="shed", reason="queue_timeout")
+    async with AsyncTestClient(app) as client:
+        slow_request = asyncio.create_task(client.get("/slow"))
+        while controller._in_flight == 0:
+            await asyncio.sleep(0.001)
+        response = await client.get(
+            "/slow", headers={CORRELATION_ID_HEADER_NAME: CORRELATION_ID}
+        )
+        release.set()
+        assert (await slow_request).status_code == 200
+
+    assert response.status_code == 503
+    assert response.headers[CORRELATION_ID_HEADER_NAME] == CORRELATION_ID
+    assert response.json()["correlation_id"] == CORRELATION_ID
+    assert (
+        admission_decisions.value(outcome="shed", reason="queue_timeout")
+        == shed_before + 1
+    )
@@ -0,0 +1,222 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for committing the offsets of handled events and pausing the consumer."""
+
+import asyncio
+from typing import Optional
+from unittest.mock import AsyncMock
+
+import pytest
+from aiokafka import TopicPartition
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventsub import EventSubscriberProtocol
+
+from pci.adapters.inbound import kafka_subscriber
+from pci.adapters.inbound.event_acks import Ack, acknowledge_when_done, defer_ack
+from pci.adapters.inbound.event_sub import EventSubTranslator, EventSubTranslatorConfig
+from pci.adapters.inbound.kafka_subscriber import (
+    InstrumentedKafkaEventSubscriber,
+    consumer_paused,
+)
+from pci.models import NonStagedFileRequested
+from tests.fixtures.consumer import FakeConsumerEvent
+
+PARTITION = TopicPartition("test-topic", 0)
+
+
+class FakeConsumer:
+    """A consumer handing out events of one partition and recording commits."""
+
+    def __init__(self, offsets: list[int]):
+        self._events = iter(
+            FakeConsumerEvent(topic="test-topic", partition=0, offset=offset)
+            for offset in offsets
+        )
+        self.assigned = {PARTITION}
+        self.paused: set[TopicPartition] = set()
+        self.polls = 0
+        self.commits: list[dict[TopicPartition, int]] = []
+
+    async def __anext__(self) -> FakeConsumerEvent:
+        """Get the next event."""
+        return next(self._events)
+
+    def assignment(self) -> set[TopicPartition]:
+        """Get the assigned partitions."""
+        return set(self.assigned)
+
+    def pause(self, *partitions: TopicPartition):
+        """Pause fetching from the partitions."""
+        self.paused.update(partitions)
+
+    def resume(self, *partitions: TopicPartition):
+        """Resume fetching from the partitions."""
+        self.paused.difference_update(partitions)
+
+    async def getmany(self, timeout_ms: int = 0) -> dict:
+        """Poll while all partitions are paused."""
+        assert self.paused >= self.assigned
+        self.polls += 1
+        return {}
+
+    async def commit(self, offsets: dict[TopicPartition, int]):
+        """Record the committed offsets."""
+        self.commits.append(offsets)
+
+
+class BackgroundTranslator(EventSubscriberProtocol):
+    """A translator handling events in the background, with capacity for a limited
+    number of them.
+    """
+
+    topics_of_interest = ["test-topic"]
+    types_of_interest = ["test_type"]
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.acks: list[Ack] = []
+        self._capacity_freed = asyncio.Event()
+
+    async def _consume_validated(
+        self, *, payload: JsonObject, type_: Ascii, topic: Ascii
+    ) -> None:
+        self.acks.append(defer_ack())
+
+    def has_capacity(self) -> bool:
+        """Whether a further event can be consumed."""
+        return len(self.acks) < self.capacity
+
+    async def wait_for_capacity(self) -> None:
+        """Wait until an event has been handled."""
+        await self._capacity_freed.wait()
+
+    def finish(self, index: int):
+        """Finish handling the event with the given index."""
+        self.acks[index]()
+        self.capacity += 1
+        self._capacity_freed.set()
+
+
+async def consume(subscriber: InstrumentedKafkaEventSubscriber, count: int):
+    """Consume a number of events."""
+    for _ in range(count):
+        await subscriber.run(forever=False)
+
+
+def get_committed(consumer: FakeConsumer) -> Optional[int]:
+    """Get the last committed offset."""
+    return consumer.commits[-1][PARTITION] if consumer.commits else None
+
+
+@pytest.mark.asyncio
+async def test_commit_handled_offsets():
+    """Test that offsets are only committed up to the first unhandled event."""
+    consumer = FakeConsumer(offsets=[10, 11, 12])
+    translator = BackgroundTranslator(capacity=4)
+    subscriber = InstrumentedKafkaEventSubscriber(
+        consumer=consumer, translator=translator
+    )
+    await consume(subscriber, 3)
+    await subscriber.commit()
+    assert get_committed(consumer) is None
+
+    translator.finish(1)
+    await subscriber.commit()
+    assert get_committed(consumer) is None
+
+    translator.finish(0)
+    await subscriber.commit()
+    assert get_committed(consumer) == 12
+
+    # nothing new to commit
+    await subscriber.commit()
+    assert len(consumer.commits) == 1
+
+    # offsets of revoked partitions are not committed
+    translator.finish(2)
+    consumer.assigned.clear()
+    await subscriber.commit()
+    assert len(consumer.commits) == 1
+
+
+@pytest.mark.asyncio
+async def test_pause_at_capacity(monkeypatch: pytest.MonkeyPatch):
+    """Test that fetching is paused while the translator is at capacity, polling
+    meanwhile.
+    """
+    monkeypatch.setattr(kafka_subscriber, "PAUSED_POLL_INTERVAL", 0.001)
+    consumer = FakeConsumer(offsets=[0, 1])
+    translator = BackgroundTranslator(capacity=1)
+    subscriber = InstrumentedKafkaEventSubscriber(
+        consumer=consumer, translator=translator
+    )
+    run = asyncio.create_task(consume(subscriber, 1))
+    await asyncio.sleep(0.01)
+    assert not run.done()
+    assert consumer.paused == {PARTITION}
+    assert consumer_paused.value() == 1
+    assert consumer.polls
+
+    translator.finish(0)
+    await asyncio.wait_for(run, timeout=5)
+    assert not consumer.paused
+    assert consumer_paused.value() == 0
+    await subscriber.commit()
+    assert get_committed(consumer) == 1
+
+
+@pytest.mark.asyncio
+async def test_acknowledge_after_staging():
+    """Test that the translator acknowledges an event once the queued staging is
+    done.
+    """
+    config = EventSubTranslatorConfig(
+        file_events_topic="file-events",
+        nonstaged_file_requested_type="non_staged_file_requested",
+    )
+    staging = asyncio.Event()
+
+    async def stage_file(file_id: str) -> int:
+        await staging.wait()
+        return 0
+
+    data_repository = AsyncMock()
+    data_repository.stage_file.side_effect = stage_file
+    event = NonStagedFileRequested(
+        correlation_id="7a0c5c38-2f7e-4c55-9d7c-6b1e0f3a9d21",
+        file_id="test.txt",
+        target_object_id="test.txt",
+        target_bucket_id="test",
+        s3_endpoint_alias="test",
+        decrypted_sha256="",
+    )
+    acknowledged: list[bool] = []
+
+    async with EventSubTranslator.construct(
+        config=config, data_repository=data_repository
+    ) as translator:
+        with acknowledge_when_done(lambda: acknowledged.append(True)):
+            await translator.consume(
+                payload=event.model_dump(),
+                type_=config.nonstaged_file_requested_type,
+                topic=config.file_events_topic,
+            )
+        await asyncio.sleep(0.01)
+        assert not acknowledged
+        staging.set()
+        await translator.wait_until_idle()
+        assert acknowledged == [True]
@@ -0,0 +1,191 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for evicting staged files to stay below the capacity."""
+
+import asyncio
+import os
+from pathlib import Path
+from time import time
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+from pydantic import ValidationError
+
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import LocalFileStorage, LocalFileStorageConfig
+from pci.adapters.outbound.s3_storage import S3FileStorage
+from pci.core.capacity import (
+    CapacityConfig,
+    StagingCapacityManager,
+    evicted_bytes,
+    evicted_files,
+    staged_bytes,
+)
+from pci.core.data_repository import DataRepository, DataRepositoryConfig
+from pci.inject import prepare_capacity_manager
+from tests.fixtures.config import get_config
+from tests.fixtures.s3 import FakeS3Client
+
+
+async def stage_old_files(storage: LocalFileStorage, *file_ids: str):
+    """Stage files of ten bytes each, staged an hour ago in the given order."""
+    for age, file_id in enumerate(reversed(file_ids), start=3600):
+        await storage.write(file_id, b"0123456789")
+        path = storage._layout.get_path(file_id)
+        os.utime(path, (time() - age, time() - age))
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction(tmp_path: Path):
+    """Test that the least recently requested files are evicted down to the low-water
+    mark once the high-water mark is exceeded.
+    """
+    storage = LocalFileStorage(
+        config=LocalFileStorageConfig(
+            staging_directory=tmp_path, staging_index_enabled=False
+        )
+    )
+    config = CapacityConfig(staging_high_water_mark=30, staging_low_water_mark=20)
+    manager = StagingCapacityManager(config=config, file_storage=storage, min_age=60)
+    await stage_old_files(storage, "a.txt", "b.txt", "c.txt")
+    await manager.sync()
+    assert manager.total_bytes == 30
+    assert staged_bytes.value() == 30
+
+    evictions: list[str] = []
+    manager.add_eviction_listener(evictions.append)
+    ok_before = evicted_files.value(outcome="ok")
+    bytes_before = evicted_bytes.value()
+
+    # nothing is evicted at the high-water mark
+    await manager.evict()
+    assert evictions == []
+
+    manager.record_access("a.txt")
+    await stage_old_files(storage, "d.txt")
+    await manager.sync()
+    assert manager.total_bytes == 40
+
+    await manager.evict()
+    assert evictions == ["b.txt", "c.txt"]
+    assert sorted(await storage.list_files()) == ["a.txt", "d.txt"]
+    assert manager.total_bytes == 20
+    assert len(manager) == 2
+    assert evicted_files.value(outcome="ok") == ok_before + 2
+    assert evicted_bytes.value() == bytes_before + 20
+
+
+@pytest.mark.asyncio
+async def test_recent_files_are_kept(tmp_path: Path):
+    """Test that files younger than the minimum age are not evicted, even if that
+    keeps the staged files above the high-water mark.
+    """
+    storage = LocalFileStorage(
+        config=LocalFileStorageConfig(
+            staging_directory=tmp_path, staging_index_enabled=False
+        )
+    )
+    manager = StagingCapacityManager(
+        config=CapacityConfig(staging_high_water_mark=15),
+        file_storage=storage,
+        min_age=60,
+    )
+    await stage_old_files(storage, "old.txt")
+    await storage.write("new.txt", b"0123456789")
+    manager.record_access("new.txt", 10)
+    await manager.sync()
+
+    await manager.evict()
+    assert sorted(await storage.list_files()) == ["new.txt"]
+    assert manager.total_bytes == 10
+
+
+@pytest.mark.asyncio
+async def test_background_eviction(tmp_path: Path):
+    """Test that requests exceeding the high-water mark trigger an eviction in the
+    background, which also drops cached download URLs of evicted files.
+    """
+    client = FakeS3Client()
+    config = get_config(
+        sources=[
+            DataRepositoryConfig(download_redirect_enabled=True),
+            CapacityConfig(staging_high_water_mark=25),
+        ]
+    )
+    storage = S3FileStorage(config=config, client=client)
+    for file_id in ("a.txt", "b.txt", "c.txt"):
+        await storage.write(file_id, b"0123456789")
+
+    async with StagingCapacityManager.construct(
+        config=config, file_storage=storage, min_age=0
+    ) as manager:
+        data_repository = DataRepository(
+            config=config,
+            event_publisher=EventPubTranslator(
+                config=config, provider=InMemEventPublisher()
+            ),
+            file_storage=storage,
+            capacity_manager=manager,
+        )
+        assert await data_repository.get_download_url("a.txt") is not None
+        await data_repository.handle_request("b.txt")
+        await data_repository.handle_request("c.txt")
+
+        async def evicted():
+            while ("staging", "a.txt") in client.objects:
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(evicted(), timeout=5)
+
+    assert sorted(key for _, key in client.objects) == ["b.txt", "c.txt"]
+    presigned_url_count = client.presigned_url_count
+    assert await data_repository.get_download_url("a.txt") is None
+    assert client.presigned_url_count == presigned_url_count
+
+
+@pytest.mark.parametrize("enabled", [False, True])
+@pytest.mark.asyncio
+async def test_eviction_enabled(tmp_path: Path, enabled: bool):
+    """Test that a capacity manager is only constructed if eviction is enabled."""
+    config = get_config(
+        sources=[
+            LocalFileStorageConfig(staging_directory=tmp_path),
+            CapacityConfig(
+                staging_eviction_enabled=enabled, staging_high_water_mark=100
+            ),
+        ]
+    )
+    async with prepare_capacity_manager(
+        config=config,
+        file_storage=LocalFileStorage(config=config),
+        manage_capacity=True,
+    ) as capacity_manager:
+        assert (capacity_manager is not None) == enabled
+
+
+@pytest.mark.parametrize("staging_directory", [".", ".."])
+def test_eviction_requires_dedicated_directory(staging_directory: str):
+    """Test that eviction cannot be enabled for a staging directory that contains
+    the working directory.
+    """
+    with pytest.raises(ValidationError):
+        get_config(
+            sources=[
+                LocalFileStorageConfig(staging_directory=Path(staging_directory)),
+                CapacityConfig(staging_eviction_enabled=True),
+            ]
+        )
@@ -0,0 +1,162 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the compression of file responses."""
+
+import zlib
+from pathlib import Path
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.fastapi_ import dummies
+from pci.adapters.inbound.fastapi_.compression import (
+    CompressionConfig,
+    ResponseCompressor,
+    crc32_combine,
+    precompressed_lookups,
+)
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+)
+from pci.context_vars import CORRELATION_ID_HEADER_NAME
+from pci.core.data_repository import DataRepository
+from tests.fixtures.config import get_config
+
+CORRELATION_ID = "e4b1d7a2-6c3f-4e8d-9a05-2b7c1f3e6d48"
+
+
+def test_crc32_combine():
+    """Test that combined checksums match the checksum of the joined data."""
+    for first, second in ((b"", b"abc"), (b"abc", b""), (b"x" * 1000, b"y" * 12345)):
+        assert crc32_combine(
+            zlib.crc32(first), zlib.crc32(second), len(second)
+        ) == zlib.crc32(first + second)
+
+
+def test_negotiate():
+    """Test that the encoding preferred by the client is chosen."""
+    compressor = ResponseCompressor(config=CompressionConfig())
+    compressor.encodings = ["zstd", "gzip"]
+    assert compressor.negotiate("gzip, deflate") == "gzip"
+    assert compressor.negotiate("gzip, zstd") == "zstd"
+    assert compressor.negotiate("gzip;q=1.0, zstd;q=0.5") == "gzip"
+    assert compressor.negotiate("*") == "zstd"
+    assert compressor.negotiate("*, zstd;q=0") == "gzip"
+    assert compressor.negotiate("gzip;q=0, br") is None
+    assert compressor.negotiate("") is None
+
+
+@pytest.mark.asyncio
+async def test_precompressed_gzip():
+    """Test that the content is compressed once and joined with per-request prefixes
+    into a single valid gzip member.
+    """
+    compressor = ResponseCompressor(config=CompressionConfig())
+    content = b"lorem ipsum dolor sit amet " * 1000
+    misses = precompressed_lookups.value(encoding="gzip", outcome="miss")
+
+    for prefix in (b"first prefix ", b"second prefix "):
+        body = await compressor.compress(
+            file_id="test.txt", prefix=prefix, content=content, encoding="gzip"
+        )
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        assert decompressor.decompress(body) == prefix + content
+        assert decompressor.eof
+        assert not decompressor.unused_data
+    assert precompressed_lookups.value(encoding="gzip", outcome="miss") == misses + 1
+
+    # changed content is compressed again
+    await compressor.compress(
+        file_id="test.txt", prefix=b"", content=content[1:], encoding="gzip"
+    )
+    assert precompressed_lookups.value(encoding="gzip", outcome="miss") == misses + 2
+
+    compressor.invalidate("test.txt")
+    await compressor.compress(
+        file_id="test.txt", prefix=b"", content=content[1:], encoding="gzip"
+    )
+    assert precompressed_lookups.value(encoding="gzip", outcome="miss") == misses + 3
+
+
+@pytest.mark.asyncio
+async def test_precompressed_zstd():
+    """Test that zstd responses consist of a prefix frame and the cached content."""
+    zstandard = pytest.importorskip("zstandard")
+    compressor = ResponseCompressor(config=CompressionConfig())
+    body = await compressor.compress(
+        file_id="test.txt", prefix=b"prefix ", content=b"content", encoding="zstd"
+    )
+    reader = zstandard.ZstdDecompressor().stream_reader(body, read_across_frames=True)
+    assert reader.read() == b"prefix content"
+
+
+@pytest.mark.asyncio
+async def test_compressed_brotli():
+    """Test that brotli responses are compressed as a whole."""
+    brotli = pytest.importorskip("brotli")
+    compressor = ResponseCompressor(config=CompressionConfig())
+    body = await compressor.compress(
+        file_id="test.txt", prefix=b"prefix ", content=b"content", encoding="br"
+    )
+    assert brotli.decompress(body) == b"prefix content"
+
+
+@pytest.mark.asyncio
+async def test_compressed_file_response(tmp_path: Path):
+    """Test that large file responses are compressed if the client accepts it."""
+    config = get_config(
+        sources=[
+            LocalFileStorageConfig(staging_directory=tmp_path),
+            CompressionConfig(compression_min_size=100),
+        ]
+    )
+    file_storage = LocalFileStorage(config=config)
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=file_storage,
+    )
+    app = get_configured_app(config=config)
+    app.state.response_compressor.encodings = ["gzip"]
+    app.dependency_overrides[dummies.data_repository_port] = lambda: data_repository
+    await file_storage.write("large.txt", ("äöü – text " * 500).encode())
+    await file_storage.write("small.txt", b"text")
+    headers = {CORRELATION_ID_HEADER_NAME: CORRELATION_ID, "Accept-Encoding": "gzip"}
+
+    async with AsyncTestClient(app=app) as rest_client:
+        response = await rest_client.get("/large.txt", headers=headers)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert int(response.headers["Content-Length"]) < 1000
+        assert response.json() == {
+            "correlation_id": CORRELATION_ID,
+            "file_content": "äöü – text " * 500,
+        }
+
+        response = await rest_client.get("/small.txt", headers=headers)
+        assert "Content-Encoding" not in response.headers
+        assert response.json()["file_content"] == "text"
+
+        headers["Accept-Encoding"] = "identity"
+        response = await rest_client.get("/large.txt", headers=headers)
+        assert "Content-Encoding" not in response.headers
+        assert response.json()["correlation_id"] == CORRELATION_ID
@@ -0,0 +1,147 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the consumer instrumentation and the metrics endpoint."""
+
+import asyncio
+
+import pytest
+from aiokafka import TopicPartition
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventsub import EventSubscriberProtocol
+
+from pci.adapters.inbound.kafka_subscriber import (
+    InstrumentedKafkaEventSubscriber,
+    consumed_events,
+    consumer_lag,
+    consumer_throughput,
+    event_processing_seconds,
+)
+from pci.adapters.inbound.metrics_server import MetricsServerConfig, serve_metrics
+from tests.fixtures.consumer import FakeConsumerEvent
+
+
+class FakeConsumer:
+    """A consumer handing out predefined events."""
+
+    def __init__(self, events: list[FakeConsumerEvent], highwater: int):
+        self._events = iter(events)
+        self._highwater = highwater
+        self.assigned = {TopicPartition("test-topic", 3)}
+
+    async def __anext__(self) -> FakeConsumerEvent:
+        """Get the next event."""
+        return next(self._events)
+
+    def highwater(self, partition: TopicPartition) -> int:
+        """Get the highwater mark of the partition."""
+        assert partition == TopicPartition("test-topic", 3)
+        return self._highwater
+
+    def assignment(self) -> set[TopicPartition]:
+        """Get the assigned partitions."""
+        return self.assigned
+
+
+class FailingTranslator(EventSubscriberProtocol):
+    """A translator failing to process the second event."""
+
+    topics_of_interest = ["test-topic"]
+    types_of_interest = ["test_type"]
+
+    def __init__(self):
+        self.consumed = 0
+
+    async def _consume_validated(
+        self, *, payload: JsonObject, type_: Ascii, topic: Ascii
+    ) -> None:
+        self.consumed += 1
+        if self.consumed == 2:
+            raise RuntimeError("processing failed")
+
+
+@pytest.mark.asyncio
+async def test_consumer_metrics():
+    """Test that processed events, processing times and the lag are recorded."""
+    events = [
+        FakeConsumerEvent(topic="test-topic", partition=3, offset=offset)
+        for offset in (40, 41)
+    ]
+    subscriber = InstrumentedKafkaEventSubscriber(
+        consumer=FakeConsumer(events, highwater=50),
+        translator=FailingTranslator(),
+    )
+    labels = {"topic": "test-topic", "type": "test_type"}
+    ok_before = consumed_events.value(**labels, outcome="ok")
+    errors_before = consumed_events.value(**labels, outcome="error")
+    observed_before = event_processing_seconds.count(type="test_type")
+
+    await subscriber.run(forever=False)
+    assert consumer_lag.value(topic="test-topic", partition="3") == 9
+    with pytest.raises(RuntimeError):
+        await subscriber.run(forever=False)
+    assert consumer_lag.value(topic="test-topic", partition="3") == 8
+
+    assert consumed_events.value(**labels, outcome="ok") == ok_before + 1
+    assert consumed_events.value(**labels, outcome="error") == errors_before + 1
+    assert event_processing_seconds.count(type="test_type") == observed_before + 2
+
+
+@pytest.mark.asyncio
+async def test_idle_consumer_metrics():
+    """Test that the lag and the throughput are also updated without new events."""
+    consumer = FakeConsumer(
+        [FakeConsumerEvent(topic="test-topic", partition=3, offset=40)], highwater=50
+    )
+    subscriber = InstrumentedKafkaEventSubscriber(
+        consumer=consumer, translator=FailingTranslator()
+    )
+    await subscriber.run(forever=False)
+
+    consumer._highwater = 60
+    subscriber._report_progress()
+    assert consumer_lag.value(topic="test-topic", partition="3") == 19
+    assert consumer_throughput.value() > 0
+
+    subscriber._report_progress()
+    assert consumer_throughput.value() == 0
+
+    consumer.assigned = set()
+    subscriber._report_progress()
+    assert consumer_lag.value(topic="test-topic", partition="3") == 0
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint():
+    """Test that the metrics are served via HTTP."""
+    config = MetricsServerConfig(metrics_port=0)
+    async with serve_metrics(config=config) as server:
+        assert server is not None
+        port = server.sockets[0].getsockname()[1]
+
+        for path, status in (("/metrics", b"200"), ("/other", b"404")):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            assert response.split(b" ", 2)[1] == status
+            if status == b"200":
+                assert b"# TYPE pci_consumer_lag gauge" in response
+
+    async with serve_metrics(
+        config=MetricsServerConfig(metrics_enabled=False)
+    ) as server:
+        assert server is None
@@ -0,0 +1,104 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for skipping redundant staging work in the event subscriber."""
+
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.dedup import DedupWindow
+from pci.adapters.inbound.event_sub import EventSubTranslator, skipped_events
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+    get_staging_layout,
+)
+from pci.adapters.outbound.staging_ledger import InMemStagingLedger
+from pci.core.data_repository import DataRepository
+from pci.models import NonStagedFileRequested, StagingStatus
+from tests.fixtures.config import get_config
+
+CORRELATION_IDS = (
+    "3e1f4c2a-7b1d-4f0e-9a7c-2d5b8e6f1a01",
+    "3e1f4c2a-7b1d-4f0e-9a7c-2d5b8e6f1a02",
+)
+
+
+def test_dedup_window():
+    """Test that keys expire after the window and the oldest keys are evicted."""
+    window: DedupWindow[str] = DedupWindow(max_size=2, window=10)
+    with patch("pci.adapters.inbound.dedup.monotonic", return_value=0):
+        window.add("a")
+    with patch("pci.adapters.inbound.dedup.monotonic", return_value=5):
+        window.add("b")
+        assert "a" in window
+        window.add("c")
+        assert "a" not in window
+        assert "b" in window
+    with patch("pci.adapters.inbound.dedup.monotonic", return_value=15):
+        assert "b" not in window
+        assert len(window) == 0
+
+
+@pytest.mark.asyncio
+async def test_skip_redundant_staging(tmp_path: Path):
+    """Test that redelivered events and requests for recently staged files do not
+    cause the file to be staged again, but are recorded in the ledger.
+    """
+    config = get_config(sources=[LocalFileStorageConfig(staging_directory=tmp_path)])
+    staging_ledger = InMemStagingLedger()
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=LocalFileStorage(config=config),
+        staging_ledger=staging_ledger,
+    )
+    translator = EventSubTranslator(config=config, data_repository=data_repository)
+    skipped_before = {
+        reason: skipped_events.value(reason=reason)
+        for reason in ("duplicate", "recently_staged")
+    }
+
+    for correlation_id in (CORRELATION_IDS[0], *CORRELATION_IDS):
+        event = NonStagedFileRequested(
+            correlation_id=correlation_id,
+            file_id="test.txt",
+            target_object_id="test.txt",
+            target_bucket_id="test",
+            s3_endpoint_alias="test",
+            decrypted_sha256="",
+        )
+        await translator.consume(
+            payload=event.model_dump(),
+            type_=config.nonstaged_file_requested_type,
+            topic=config.file_events_topic,
+        )
+
+    # the file still holds the correlation ID it was first staged for
+    content = get_staging_layout(config).get_path("test.txt").read_text()
+    assert content.endswith(CORRELATION_IDS[0])
+    for reason in skipped_before:
+        assert skipped_events.value(reason=reason) == skipped_before[reason] + 1
+
+    records = await staging_ledger.find(file_id="test.txt")
+    assert {record.correlation_id for record in records} == set(CORRELATION_IDS)
+    assert all(record.status == StagingStatus.STAGED for record in records)
@@ -0,0 +1,97 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for redirecting requests for staged files to presigned URLs."""
+
+from unittest.mock import patch
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.fastapi_ import dummies
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.s3_storage import S3FileStorage
+from pci.context_vars import CORRELATION_ID_HEADER_NAME
+from pci.core.data_repository import DataRepository, DataRepositoryConfig
+from tests.fixtures.config import get_config
+from tests.fixtures.s3 import FakeS3Client
+
+CORRELATION_ID = "5d5a5c8e-4a5c-4b0a-9b84-1a9f1e6a2f50"
+
+
+def get_data_repository(redirect_enabled: bool, client: FakeS3Client) -> DataRepository:
+    """Get a data repository using S3 storage with a fake client."""
+    config = get_config(
+        sources=[DataRepositoryConfig(download_redirect_enabled=redirect_enabled)]
+    )
+    return DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=S3FileStorage(config=config, client=client),
+    )
+
+
+@pytest.mark.asyncio
+async def test_download_url_caching():
+    """Test that download URLs are only handed out for staged files and are cached
+    until shortly before they expire.
+    """
+    client = FakeS3Client()
+    data_repository = get_data_repository(redirect_enabled=True, client=client)
+
+    assert await data_repository.get_download_url("test.txt") is None
+    client.objects[("staging", "test.txt")] = b"content"
+
+    url = await data_repository.get_download_url("test.txt")
+    assert url is not None
+    assert await data_repository.get_download_url("test.txt") == url
+    assert client.presigned_url_count == 1
+
+    # pretend the URL is about to expire
+    with patch("pci.core.download_urls.monotonic", return_value=1e12):
+        assert await data_repository.get_download_url("test.txt") == url
+    assert client.presigned_url_count == 2
+
+    disabled = get_data_repository(redirect_enabled=False, client=client)
+    assert await disabled.get_download_url("test.txt") is None
+
+
+@pytest.mark.asyncio
+async def test_redirect_response():
+    """Test that staged files are redirected to with the correlation ID header while
+    missing files are still requested.
+    """
+    client = FakeS3Client()
+    client.objects[("staging", "test.txt")] = b"content"
+    data_repository = get_data_repository(redirect_enabled=True, client=client)
+
+    app = get_configured_app(config=get_config())
+    app.dependency_overrides[dummies.data_repository_port] = lambda: data_repository
+    headers = {CORRELATION_ID_HEADER_NAME: CORRELATION_ID}
+
+    async with AsyncTestClient(app=app) as rest_client:
+        response = await rest_client.get("/test.txt", headers=headers)
+        assert response.status_code == 307
+        assert response.headers["location"].startswith("https://s3.example.org/")
+        assert response.headers[CORRELATION_ID_HEADER_NAME] == CORRELATION_ID
+
+        response = await rest_client.get("/missing.txt", headers=headers)
+        assert response.status_code == 200
+        assert response.json()["file_content"] == "file requested"
@@ -0,0 +1,207 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the file storage adapters and their use in the core."""
+
+import hashlib
+from pathlib import Path
+
+import pytest
+from botocore.exceptions import ClientError
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.outbound.checksums import CHUNK_SIZE, checksum_verifications
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import LocalFileStorage, LocalFileStorageConfig
+from pci.adapters.outbound.s3_storage import S3FileStorage, S3FileStorageConfig
+from pci.context_vars import set_correlation_id
+from pci.core.data_repository import DataRepository
+from pci.ports.outbound.file_storage import FileStoragePort
+from tests.fixtures.config import get_config
+from tests.fixtures.s3 import FakeS3Client
+
+CORRELATION_ID = "0b1e4a2c-7c36-4b71-9a56-0a4e7c4ee7a9"
+
+
+@pytest.mark.asyncio
+async def test_local_file_storage(tmp_path: Path):
+    """Test storing and reading files on the local filesystem."""
+    storage = LocalFileStorage(
+        config=LocalFileStorageConfig(staging_directory=tmp_path)
+    )
+
+    assert not await storage.exists("test.txt")
+    with pytest.raises(FileStoragePort.FileNotStagedError):
+        await storage.read("test.txt")
+
+    await storage.write("test.txt", b"content")
+    assert await storage.exists("test.txt")
+    assert await storage.read("test.txt") == b"content"
+    assert (tmp_path / "a6" / "ed" / "test.txt").read_bytes() == b"content"
+    assert await storage.get_download_url("test.txt") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("size", [0, 7, 10, 95])
+async def test_s3_file_storage(size: int):
+    """Test storing and reading files in S3, with files larger than the part size
+    being read in concurrent parts.
+    """
+    config = S3FileStorageConfig(s3_read_part_size=10, s3_max_concurrent_parts=3)
+    client = FakeS3Client()
+    storage = S3FileStorage(config=config, client=client)
+
+    assert not await storage.exists("test_1.txt")
+    with pytest.raises(FileStoragePort.FileNotStagedError):
+        await storage.read("test_1.txt")
+
+    content = bytes(range(size))
+    await storage.write("test_1.txt", content)
+    assert await storage.exists("test_1.txt")
+    client.range_requests.clear()
+    assert await storage.read("test_1.txt") == content
+    assert len(client.range_requests) == max(1, -(-size // 10))
+    assert client.range_requests[0] == "bytes=0-9"
+
+    download_url = await storage.get_download_url("test_1.txt")
+    assert download_url is not None
+    assert "/staging/test_1.txt" in download_url.url
+    assert download_url.expires_after == config.s3_download_url_expires_after
+
+
+class ReplacingS3Client(FakeS3Client):
+    """A fake S3 client replacing an object right after its first part was read."""
+
+    def __init__(self, replacements: int):
+        super().__init__()
+        self.replacements = replacements
+
+    def get_object(self, **params):
+        """Return the requested range, then replace the object if still due."""
+        response = super().get_object(**params)
+        if self.replacements and params["Range"].startswith("bytes=0-"):
+            self.replacements -= 1
+            content = self.objects[(params["Bucket"], params["Key"])]
+            self.put_object(**params, Body=bytes(byte ^ 1 for byte in content))
+        return response
+
+
+@pytest.mark.asyncio
+async def test_s3_read_replaced_file():
+    """Test that the parts of a file replaced while being read are not mixed, and
+    that the file is read again from the start.
+    """
+    config = S3FileStorageConfig(s3_read_part_size=10)
+    content = bytes(range(25))
+    client = ReplacingS3Client(replacements=1)
+    storage = S3FileStorage(config=config, client=client)
+    await storage.write("test.txt", content)
+    assert await storage.read("test.txt") == bytes(byte ^ 1 for byte in content)
+
+    # a file that keeps being replaced is not read at all
+    client.replacements = 3
+    with pytest.raises(ClientError):
+        await storage.read("test.txt")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["local", "s3"])
+async def test_checksum_verification(tmp_path: Path, backend: str):
+    """Test that content spanning several chunks is verified against its checksum
+    and not stored if it does not match.
+    """
+    storage: FileStoragePort
+    if backend == "local":
+        storage = LocalFileStorage(
+            config=LocalFileStorageConfig(staging_directory=tmp_path)
+        )
+    else:
+        storage = S3FileStorage(config=S3FileStorageConfig(), client=FakeS3Client())
+    content = bytes(range(256)) * (CHUNK_SIZE // 100)
+    sha256 = hashlib.sha256(content).hexdigest()
+    ok_before = checksum_verifications.value(outcome="ok")
+    mismatches_before = checksum_verifications.value(outcome="mismatch")
+
+    await storage.write("test.bin", content, sha256=sha256.upper())
+    assert await storage.read("test.bin") == content
+
+    with pytest.raises(FileStoragePort.ChecksumMismatchError):
+        await storage.write("other.bin", content + b"\0", sha256=sha256)
+    assert not await storage.exists("other.bin")
+    if backend == "local":
+        assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == [
+            "test.bin"
+        ]
+
+    assert checksum_verifications.value(outcome="ok") == ok_before + 1
+    assert checksum_verifications.value(outcome="mismatch") == mismatches_before + 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["local", "s3"])
+async def test_list_and_delete(tmp_path: Path, backend: str):
+    """Test that staged files can be listed, looked up and deleted."""
+    storage: FileStoragePort
+    if backend == "local":
+        storage = LocalFileStorage(
+            config=LocalFileStorageConfig(staging_directory=tmp_path)
+        )
+    else:
+        storage = S3FileStorage(config=S3FileStorageConfig(), client=FakeS3Client())
+    for size, file_id in enumerate(["a.txt", "b.txt", "c.txt"], start=1):
+        await storage.write(file_id, b"x" * size)
+
+    files = await storage.list_files()
+    assert {file_id: staged.size for file_id, staged in files.items()} == {
+        "a.txt": 1,
+        "b.txt": 2,
+        "c.txt": 3,
+    }
+    assert await storage.get_file("b.txt") == files["b.txt"]
+    assert await storage.get_file("missing.txt") is None
+
+    await storage.delete("b.txt")
+    await storage.delete("missing.txt")
+    assert not await storage.exists("b.txt")
+    assert sorted(await storage.list_files()) == ["a.txt", "c.txt"]
+
+
+@pytest.mark.asyncio
+async def test_data_repository_with_file_storage(tmp_path: Path):
+    """Test that the data repository requests missing files and serves staged ones
+    through the file storage.
+    """
+    config = get_config(sources=[LocalFileStorageConfig(staging_directory=tmp_path)])
+    event_publisher = InMemEventPublisher()
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(config=config, provider=event_publisher),
+        file_storage=LocalFileStorage(config=config),
+    )
+
+    async with set_correlation_id(CORRELATION_ID) as context:
+        assert await data_repository.handle_request("test.txt") == "file requested"
+
+        event = event_publisher.event_store.get(config.file_events_topic)
+        assert event.type_ == config.nonstaged_file_requested_type
+        assert event.payload["file_id"] == "test.txt"
+        assert event.payload["correlation_id"] == CORRELATION_ID
+        assert event.payload["span_id"] == context.span_id
+
+        size = await data_repository.stage_file("test.txt")
+        content = await data_repository.handle_request("test.txt")
+        assert content == f"The name of this file is test.txt\n{CORRELATION_ID}"
+        assert size == len(content)
@@ -0,0 +1,124 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the health endpoints."""
+
+import asyncio
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.inbound.fastapi_.health import CachedHealthChecks, HealthConfig
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+)
+from pci.adapters.outbound.s3_storage import S3FileStorage
+from tests.fixtures.config import get_config
+from tests.fixtures.s3 import FakeS3Client
+
+
+class CountingCheck:
+    """A health check counting how often it ran."""
+
+    def __init__(self, result: bool = True, delay: float = 0.0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self) -> bool:
+        """Count the call and return the result after the delay."""
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.result
+
+
+@pytest.mark.asyncio
+async def test_cached_health_checks():
+    """Test that check results are shared by concurrent probes and cached, and that
+    errors and timeouts count as failures.
+    """
+
+    async def failing() -> bool:
+        raise ConnectionError()
+
+    passing = CountingCheck(delay=0.01)
+    slow = CountingCheck(delay=10)
+    health_checks = CachedHealthChecks(
+        config=HealthConfig(health_cache_ttl=60, health_check_timeout=0.05),
+        checks={"passing": passing, "failing": failing, "slow": slow},
+    )
+    results = await asyncio.gather(*(health_checks.run() for _ in range(5)))
+    assert results[0] == {"passing": True, "failing": False, "slow": False}
+    assert all(result == results[0] for result in results)
+    assert passing.calls == 1
+
+    await health_checks.run()
+    assert passing.calls == 1
+    with patch("pci.adapters.inbound.fastapi_.health.monotonic", return_value=1e12):
+        await health_checks.run()
+    assert passing.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_health_routes():
+    """Test the health routes and that they bypass the access log."""
+    app = get_configured_app(config=get_config())
+    storage = CountingCheck(result=False)
+    app.state.health_checks = CachedHealthChecks(
+        config=HealthConfig(), checks={"kafka": CountingCheck(), "storage": storage}
+    )
+
+    with patch("pci.adapters.inbound.fastapi_.utils.log_access") as log_access:
+        async with AsyncTestClient(app=app) as rest_client:
+            response = await rest_client.get("/health/live")
+            assert response.status_code == 200
+            assert response.json() == {"status": "alive"}
+
+            for _ in range(3):
+                response = await rest_client.get("/health/ready")
+                assert response.status_code == 503
+                assert response.json() == {
+                    "status": "not ready",
+                    "checks": {"kafka": True, "storage": False},
+                }
+            assert storage.calls == 1
+            assert not log_access.called
+
+            await rest_client.get("/not/found")
+            assert log_access.called
+
+
+@pytest.mark.asyncio
+async def test_storage_availability(tmp_path: Path):
+    """Test that storage adapters report whether they are available."""
+    available = LocalFileStorage(
+        config=LocalFileStorageConfig(staging_directory=tmp_path)
+    )
+    assert await available.is_available()
+    missing = LocalFileStorage(
+        config=LocalFileStorageConfig(staging_directory=tmp_path / "missing")
+    )
+    assert not await missing.is_available()
+
+    client = FakeS3Client()
+    s3_storage = S3FileStorage(config=get_config(), client=client)
+    assert await s3_storage.is_available()
+    client.buckets.clear()
+    assert not await s3_storage.is_available()
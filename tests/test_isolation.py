@@ -17,10 +17,40 @@
 
 import asyncio
 import random
+from typing import Optional
 
 import pytest
 
-from pci.context_vars import correlation_id_var, set_correlation_id
+from pci.context_vars import (
+    ContextProcessPoolExecutor,
+    ContextThreadPoolExecutor,
+    CorrelationContext,
+    UnbalancedContextError,
+    correlation_context_var,
+    correlation_id_var,
+    get_correlation_id,
+    is_context_debugging,
+    set_context_debugging,
+    set_correlation_id,
+)
+
+
+class SimulatedFailure(RuntimeError):
+    """Raised by test tasks to simulate a failing request."""
+
+
+@pytest.fixture
+def context_debugging():
+    """Enable the detection of leaked and unbalanced contexts for the test."""
+    enabled = is_context_debugging()
+    set_context_debugging(True)
+    yield
+    set_context_debugging(enabled)
+
+
+def get_context_in_worker(_: Optional[int] = None) -> CorrelationContext:
+    """Return the correlation context as seen by an executor worker."""
+    return correlation_context_var.get()
 
 
 async def set_id_sleep_resume(correlation_id: str, use_context_manager: bool):
@@ -52,3 +82,82 @@ async def test_correlation_id_isolation():
         for n in range(100)
     ]
     await asyncio.gather(*tasks)
+
+
+async def set_id_sleep_fail(correlation_id: str, rounds: int):
+    """An async task to repeatedly set the correlation ID ContextVar, yield control to
+    the event loop and randomly fail before leaving the context.
+    """
+    outer_context = correlation_context_var.get()
+    for n in range(rounds):
+        try:
+            async with set_correlation_id(f"{correlation_id}_{n}"):
+                await asyncio.sleep(random.random() * 0.01)
+                assert get_correlation_id() == f"{correlation_id}_{n}"
+                if random.random() < 0.5:
+                    raise SimulatedFailure()
+        except SimulatedFailure:
+            pass
+        # Check that neither succeeding nor failing contexts leak
+        assert correlation_context_var.get() is outer_context, "Correlation ID leaked"
+
+
+@pytest.mark.asyncio
+async def test_correlation_id_isolation_with_failures(context_debugging):
+    """Make sure correlation IDs are reset when leaving the context, no matter whether
+    the body succeeded or raised, and that this holds under heavy task switching.
+
+    Test with thousands of contexts, about half of which fail.
+    """
+    tasks = [set_id_sleep_fail(f"test_{n}", rounds=5) for n in range(1000)]
+    await asyncio.gather(*tasks)
+    assert not correlation_context_var.get().correlation_id
+
+
+@pytest.mark.asyncio
+async def test_unbalanced_context_detection(context_debugging):
+    """Make sure leaked and unbalanced contexts are detected in debug mode."""
+    with pytest.raises(UnbalancedContextError):
+        async with set_correlation_id("test_outer"):
+            correlation_context_var.set(CorrelationContext.new("test_leaked"))
+    assert not correlation_context_var.get().correlation_id
+
+    setter = set_correlation_id("test_twice")
+    async with setter:
+        with pytest.raises(UnbalancedContextError):
+            async with setter:
+                pass
+
+    with pytest.raises(UnbalancedContextError):
+        setter.__exit__()
+
+
+@pytest.mark.asyncio
+async def test_correlation_id_propagation_to_executors():
+    """Make sure the correlation context is available in thread and process pool
+    workers, including when running them from the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    with (
+        ContextThreadPoolExecutor(max_workers=2) as thread_pool,
+        ContextProcessPoolExecutor(max_workers=1) as process_pool,
+    ):
+        for correlation_id in ("test_1", "test_2"):
+            async with set_correlation_id(correlation_id) as context:
+                in_thread = await loop.run_in_executor(
+                    thread_pool, get_context_in_worker
+                )
+                assert in_thread == context
+
+                in_process = await loop.run_in_executor(
+                    process_pool, get_context_in_worker
+                )
+                assert in_process.correlation_id == correlation_id
+                assert in_process.parent_id == context.span_id
+
+                mapped = list(process_pool.map(get_context_in_worker, range(3)))
+                assert {worker.correlation_id for worker in mapped} == {correlation_id}
+
+        # nothing leaks into workers once the context is left
+        assert not thread_pool.submit(get_context_in_worker).result().correlation_id
+        assert not process_pool.submit(get_context_in_worker).result().correlation_id
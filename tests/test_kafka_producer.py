@@ -0,0 +1,106 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the shared, warmed-up Kafka producer."""
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.inbound.fastapi_.health import CachedHealthChecks, HealthConfig
+from pci.adapters.outbound.kafka_producer import SharedKafkaProducer, producer_ready
+from tests.fixtures.config import get_config
+
+
+class FakeClient:
+    """A Kafka client pretending to reach the cluster."""
+
+    async def fetch_all_metadata(self):
+        """Pretend to fetch the cluster metadata."""
+
+
+class FakeProducer:
+    """A Kafka producer failing to fetch topic metadata on the first attempt."""
+
+    def __init__(self, **kwargs):
+        self.client = FakeClient()
+        self.started = False
+        self.stopped = False
+        self.metadata_requests: list[str] = []
+        self.sent: list[tuple] = []
+
+    async def start(self):
+        """Pretend to connect."""
+        self.started = True
+
+    async def stop(self):
+        """Pretend to disconnect."""
+        self.stopped = True
+
+    async def partitions_for(self, topic: str) -> set[int]:
+        """Fail on the first request only."""
+        self.metadata_requests.append(topic)
+        if len(self.metadata_requests) == 1:
+            raise ConnectionError("metadata not available yet")
+        return {0}
+
+    async def send_and_wait(self, topic, key, value, headers):
+        """Record sent events."""
+        self.sent.append((topic, key, value))
+
+
+@pytest.mark.asyncio
+async def test_shared_producer_warm_up():
+    """Test that the producer connects on construction, is only ready once the
+    metadata of all topics has been fetched and is stopped on teardown.
+    """
+    config = get_config().model_copy(update={"kafka_warmup_retry_delay": 0.01})
+    app = get_configured_app(config=config)
+
+    async with SharedKafkaProducer.construct(
+        config=config, topics=["a", "b", "a"], kafka_producer_cls=FakeProducer
+    ) as shared_producer:
+        producer = shared_producer._producer
+        assert producer.started
+        assert not shared_producer.ready
+        app.state.health_checks = CachedHealthChecks(
+            config=HealthConfig(health_cache_ttl=0),
+            checks={"kafka": shared_producer.is_connected},
+        )
+
+        async with AsyncTestClient(app=app) as rest_client:
+            response = await rest_client.get("/health/ready")
+            assert response.status_code == 503
+            assert response.json() == {
+                "status": "not ready",
+                "checks": {"kafka": False},
+            }
+
+            await shared_producer.wait_until_ready()
+            assert producer.metadata_requests == ["a", "a", "b"]
+            assert producer_ready.value() == 1
+
+            response = await rest_client.get("/health/ready")
+            assert response.status_code == 200
+            assert response.json()["status"] == "ready"
+
+        await shared_producer.event_publisher.publish(
+            payload={"x": 1}, type_="test", key="key", topic="a"
+        )
+        assert producer.sent == [("a", "key", {"x": 1})]
+
+    assert producer.stopped
+    assert producer_ready.value() == 0
@@ -0,0 +1,67 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the metrics module."""
+
+import pytest
+
+from pci.metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_render_metrics():
+    """Test that metrics are rendered in the Prometheus text format."""
+    registry = MetricsRegistry()
+    requests = registry.register(
+        Counter("test_requests_total", "Requests.", labels=("status",))
+    )
+    in_flight = registry.register(Gauge("test_in_flight", "In flight."))
+    latency = registry.register(
+        Histogram("test_latency_seconds", "Latency.", buckets=(0.1, 1))
+    )
+    assert registry.register(Counter("test_requests_total", "", ("status",))) is (
+        requests
+    )
+
+    requests.inc(status="ok")
+    requests.inc(2, status='"bad"')
+    in_flight.inc()
+    in_flight.dec(0.5)
+    latency.observe(0.05)
+    latency.observe(0.5)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_requests_total Requests.",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{status="ok"} 1',
+        'test_requests_total{status="\\"bad\\""} 2',
+        "# HELP test_in_flight In flight.",
+        "# TYPE test_in_flight gauge",
+        "test_in_flight 0.5",
+        "# HELP test_latency_seconds Latency.",
+        "# TYPE test_latency_seconds histogram",
+        'test_latency_seconds_bucket{le="0.1"} 1',
+        'test_latency_seconds_bucket{le="1"} 2',
+        'test_latency_seconds_bucket{le="+Inf"} 2',
+        "test_latency_seconds_sum 0.55",
+        "test_latency_seconds_count 2",
+    ]
+
+    with pytest.raises(ValueError):
+        requests.inc(-1, status="ok")
+    with pytest.raises(ValueError):
+        requests.inc()
+    with pytest.raises(ValueError):
+        registry.register(Gauge("test_requests_total", ""))
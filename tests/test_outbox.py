@@ -0,0 +1,230 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the outbox."""
+
+import asyncio
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.outbox import (
+    DEAD_LETTER_DIRECTORY,
+    OutboxConfig,
+    OutboxEventPublisher,
+    OutboxLockedError,
+    OutboxLog,
+    dead_lettered_events,
+)
+from pci.models import NonStagedFileRequested
+from pci.ports.outbound.event_pub import EventPublisherPort
+from tests.fixtures.config import get_config
+
+
+class FlakyEventPublisher(EventPublisherPort):
+    """Fails to publish a number of times before forwarding events."""
+
+    def __init__(self, *, event_publisher: EventPublisherPort, failures: int):
+        self._event_publisher = event_publisher
+        self.failures = failures
+
+    async def non_staged_file_requested(self, *, event: NonStagedFileRequested):
+        """Fail or forward the event."""
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("broker unavailable")
+        await self._event_publisher.non_staged_file_requested(event=event)
+
+
+def make_event(file_id: str) -> NonStagedFileRequested:
+    """Make an event requesting the given file."""
+    return NonStagedFileRequested(
+        correlation_id="id123",
+        file_id=file_id,
+        target_object_id=file_id,
+        target_bucket_id="test",
+        s3_endpoint_alias="test",
+        decrypted_sha256="",
+    )
+
+
+def test_outbox_log_recovery(tmp_path: Path):
+    """Test that consumed records are not read again after reopening the log, that
+    drained segments are deleted and that torn records are overwritten.
+    """
+    outbox_log = OutboxLog(directory=tmp_path, segment_size=64)
+    for index in range(5):
+        outbox_log.append(f"record {index}".encode())
+    assert len(list(tmp_path.glob("*.segment"))) == 2
+
+    with pytest.raises(OutboxLockedError):
+        OutboxLog(directory=tmp_path, segment_size=64)
+
+    assert outbox_log.read(2) == [b"record 0", b"record 1"]
+    outbox_log.consume(1)
+    outbox_log.close()
+
+    outbox_log = OutboxLog(directory=tmp_path, segment_size=64)
+    assert outbox_log.read(10) == [b"record 1", b"record 2"]
+    outbox_log.consume(2)
+    assert outbox_log.read(10) == [b"record 3", b"record 4"]
+    assert len(list(tmp_path.glob("*.segment"))) == 1
+    outbox_log.close()
+
+    # corrupt the last record as if the process crashed while writing it
+    segment_path = next(tmp_path.glob("*.segment"))
+    content = segment_path.read_bytes()
+    position = content.index(b"record 4")
+    segment_path.write_bytes(content[:position] + b"x" + content[position + 1 :])
+
+    outbox_log = OutboxLog(directory=tmp_path, segment_size=64)
+    outbox_log.append(b"record 5")
+    assert outbox_log.read(10) == [b"record 3", b"record 5"]
+    outbox_log.consume(2)
+    assert outbox_log.empty
+    outbox_log.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_relay(tmp_path: Path):
+    """Test that events are relayed in order and retried until they succeed."""
+    config = get_config(
+        sources=[
+            OutboxConfig(
+                outbox_directory=tmp_path, outbox_batch_size=2, outbox_retry_delay=0
+            )
+        ]
+    )
+    in_mem_publisher = InMemEventPublisher()
+    flaky_publisher = FlakyEventPublisher(
+        event_publisher=EventPubTranslator(config=config, provider=in_mem_publisher),
+        failures=2,
+    )
+
+    async with OutboxEventPublisher.construct(
+        config=config, event_publisher=flaky_publisher
+    ) as outbox:
+        for index in range(5):
+            await outbox.non_staged_file_requested(event=make_event(f"{index}.txt"))
+
+    assert flaky_publisher.failures == 0
+    # the whole first batch fails twice, so no event is relayed twice
+    events = in_mem_publisher.event_store.topics[config.file_events_topic]
+    file_ids = [event.payload["file_id"] for event in events]
+    assert file_ids == [f"{index}.txt" for index in range(5)]
+    assert OutboxLog(directory=tmp_path, segment_size=1024).empty
+
+
+class PoisonedEventPublisher(EventPublisherPort):
+    """Always fails to publish the events for one file."""
+
+    def __init__(self, *, event_publisher: EventPublisherPort, poisoned_file_id: str):
+        self._event_publisher = event_publisher
+        self._poisoned_file_id = poisoned_file_id
+
+    async def non_staged_file_requested(self, *, event: NonStagedFileRequested):
+        """Fail or forward the event."""
+        if event.file_id == self._poisoned_file_id:
+            raise ConnectionError("event rejected")
+        await self._event_publisher.non_staged_file_requested(event=event)
+
+
+@pytest.mark.asyncio
+async def test_outbox_dead_letters(tmp_path: Path):
+    """Test that events that cannot be parsed or keep failing are moved to the dead
+    letter log instead of blocking the events behind them.
+    """
+    config = get_config(
+        sources=[
+            OutboxConfig(
+                outbox_directory=tmp_path,
+                outbox_batch_size=2,
+                outbox_retry_delay=0,
+                outbox_max_attempts=3,
+            )
+        ]
+    )
+    in_mem_publisher = InMemEventPublisher()
+    poisoned_publisher = PoisonedEventPublisher(
+        event_publisher=EventPubTranslator(config=config, provider=in_mem_publisher),
+        poisoned_file_id="1.txt",
+    )
+    invalid_before = dead_lettered_events.value(reason="invalid")
+    failed_before = dead_lettered_events.value(reason="failed")
+
+    async with OutboxEventPublisher.construct(
+        config=config, event_publisher=poisoned_publisher
+    ) as outbox:
+        await outbox.non_staged_file_requested(event=make_event("0.txt"))
+        outbox._log.append(b"not an event")
+        for index in range(1, 4):
+            await outbox.non_staged_file_requested(event=make_event(f"{index}.txt"))
+
+    # events relayed along with the failing one are relayed again with every attempt
+    events = in_mem_publisher.event_store.topics[config.file_events_topic]
+    file_ids = dict.fromkeys(event.payload["file_id"] for event in events)
+    assert list(file_ids) == ["0.txt", "2.txt", "3.txt"]
+    assert dead_lettered_events.value(reason="invalid") == invalid_before + 1
+    assert dead_lettered_events.value(reason="failed") == failed_before + 1
+    assert OutboxLog(directory=tmp_path, segment_size=1024).empty
+
+    dead_letters = OutboxLog(
+        directory=tmp_path / DEAD_LETTER_DIRECTORY,
+        segment_size=config.outbox_segment_size,
+    )
+    payloads = dead_letters.read(10)
+    assert payloads[0] == b"not an event"
+    assert NonStagedFileRequested.model_validate_json(payloads[1]).file_id == "1.txt"
+
+
+@pytest.mark.asyncio
+async def test_outbox_group_flush(tmp_path: Path):
+    """Test that concurrently appended events are flushed together and that events
+    are flushed before being returned from.
+    """
+    config = get_config(
+        sources=[OutboxConfig(outbox_directory=tmp_path, outbox_fsync=True)]
+    )
+    flushed_ends: list[int] = []
+    original_flush = OutboxLog.flush
+
+    def flush(outbox_log: OutboxLog):
+        original_flush(outbox_log)
+        flushed_ends.append(outbox_log._segments[-1].flushed)
+
+    with patch.object(OutboxLog, "flush", flush):
+        async with OutboxEventPublisher.construct(
+            config=config,
+            event_publisher=EventPubTranslator(
+                config=config, provider=InMemEventPublisher()
+            ),
+        ) as outbox:
+            segment = outbox._log._segments[-1]
+            await asyncio.gather(
+                *(
+                    outbox.non_staged_file_requested(event=make_event(f"{index}.txt"))
+                    for index in range(20)
+                )
+            )
+            assert segment.flushed == segment.end
+            await outbox.non_staged_file_requested(event=make_event("last.txt"))
+            assert segment.flushed == segment.end
+
+    # all events appended before the first flush started are flushed together
+    assert len(flushed_ends) == 2
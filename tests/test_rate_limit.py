@@ -0,0 +1,126 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the per-client rate limits."""
+
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.fastapi_ import dummies
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.inbound.fastapi_.rate_limit import (
+    RateLimitConfig,
+    rate_limited_requests,
+)
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+)
+from pci.adapters.outbound.token_buckets import InMemTokenBuckets
+from pci.context_vars import CORRELATION_ID_HEADER_NAME
+from pci.core.data_repository import DataRepository, DataRepositoryConfig
+from tests.fixtures.config import get_config
+
+CORRELATION_ID = "7a2e9c14-3d6b-4f8a-b1c5-0e4d2f6a8b93"
+
+
+@pytest.mark.asyncio
+async def test_token_buckets():
+    """Test that buckets are drained, refilled over time and swept once full."""
+    token_buckets = InMemTokenBuckets()
+    with patch("pci.adapters.outbound.token_buckets.monotonic", return_value=0):
+        assert await token_buckets.take("a", rate=2, burst=2) == 0
+        assert await token_buckets.take("a", rate=2, burst=2) == 0
+        assert await token_buckets.take("a", rate=2, burst=2) == 0.5
+        assert await token_buckets.take("b", rate=2, burst=2) == 0
+        assert len(token_buckets) == 2
+    with patch("pci.adapters.outbound.token_buckets.monotonic", return_value=0.5):
+        assert await token_buckets.take("a", rate=2, burst=2) == 0
+        assert await token_buckets.take("a", rate=2, burst=2, cost=2) == 1
+        assert token_buckets.sweep() == 1, "bucket b is full again"
+    with patch("pci.adapters.outbound.token_buckets.monotonic", return_value=10):
+        assert token_buckets.sweep() == 1
+        assert len(token_buckets) == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_routes(tmp_path: Path):
+    """Test that clients exceeding the request or staging rate limit get a 429
+    response carrying the correlation ID, independently of other clients.
+    """
+    config = get_config(
+        sources=[
+            LocalFileStorageConfig(staging_directory=tmp_path),
+            RateLimitConfig(
+                rate_limit_enabled=True,
+                rate_limit_client_header="X-Forwarded-For",
+                request_rate_limit=0.001,
+                request_burst_limit=3,
+            ),
+            DataRepositoryConfig(staging_rate_limit=0.001, staging_burst_limit=1),
+        ]
+    )
+    token_buckets = InMemTokenBuckets()
+    file_storage = LocalFileStorage(config=config)
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=file_storage,
+        token_buckets=token_buckets,
+    )
+    app = get_configured_app(config=config, token_buckets=token_buckets)
+    app.dependency_overrides[dummies.data_repository_port] = lambda: data_repository
+    headers = {
+        CORRELATION_ID_HEADER_NAME: CORRELATION_ID,
+        "X-Forwarded-For": "10.0.0.1, 10.0.0.254",
+    }
+    staging_limited = rate_limited_requests.value(limit="staging")
+
+    async with AsyncTestClient(app=app) as rest_client:
+        assert (await rest_client.get("/a.txt", headers=headers)).status_code == 200
+        response = await rest_client.get("/b.txt", headers=headers)
+        assert response.status_code == 429
+        assert response.headers[CORRELATION_ID_HEADER_NAME] == CORRELATION_ID
+        assert response.json()["correlation_id"] == CORRELATION_ID
+        assert int(response.headers["Retry-After"]) > 0
+        assert rate_limited_requests.value(limit="staging") == staging_limited + 1
+
+        # staged files can still be requested
+        await file_storage.write("b.txt", b"content")
+        assert (await rest_client.get("/b.txt", headers=headers)).status_code == 200
+
+        response = await rest_client.get("/b.txt", headers=headers)
+        assert response.status_code == 429
+        assert "request rate limit" in response.json()["detail"]
+
+        # the values before the one of the trusted proxy are ignored
+        spoofed = {
+            **headers,
+            "X-Forwarded-For": "10.0.0.3, " + headers["X-Forwarded-For"],
+        }
+        response = await rest_client.get("/c.txt", headers=spoofed)
+        assert response.status_code == 429
+
+        other_client = {"X-Forwarded-For": "10.0.0.1, 10.0.0.2"}
+        response = await rest_client.get("/c.txt", headers=other_client)
+        assert response.status_code == 200
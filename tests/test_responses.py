@@ -0,0 +1,49 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for rendering JSON responses."""
+
+import json
+
+from pci.adapters.inbound.fastapi_.responses import (
+    FastJSONResponse,
+    dumps_json,
+    render_file_response,
+)
+
+
+def test_dumps_json():
+    """Test that content is rendered like the stdlib renders it, including content
+    orjson rejects.
+    """
+    content = {"text": 'quote " backslash \\ newline \n umlaut ä', "number": 1.5}
+    expected = json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+    assert dumps_json(content) == expected.encode()
+    assert FastJSONResponse(content=content).body == expected.encode()
+    assert dumps_json(2**70) == b"1180591620717411303424"
+
+
+def test_render_file_response():
+    """Test that the hand-assembled file response is valid JSON."""
+    for correlation_id in ("0aa5ba9a-8ce7-4e1c-ac33-3c37b79e2c5c", 'not "safe"'):
+        file_content = 'The "name" of this file is\ntest.txt – ä'
+        prefix, content = render_file_response(
+            correlation_id=correlation_id, file_content=file_content
+        )
+        assert json.loads(prefix + content) == {
+            "correlation_id": correlation_id,
+            "file_content": file_content,
+        }
@@ -0,0 +1,290 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for retrying failed stagings and dead-lettering events."""
+
+import asyncio
+from pathlib import Path
+from typing import Callable
+
+import pytest
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.event_acks import acknowledge_when_done
+from pci.adapters.inbound.event_sub import EventSubTranslator, EventSubTranslatorConfig
+from pci.adapters.inbound.timer_wheel import TimerWheel
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+    get_staging_layout,
+)
+from pci.adapters.outbound.staging_ledger import InMemStagingLedger
+from pci.config import Config
+from pci.core.data_repository import DataRepository
+from pci.models import NonStagedFileRequested, StagingStatus
+from tests.fixtures.config import get_config
+
+CORRELATION_ID = "7a0c5c38-2f7e-4c55-9d7c-6b1e0f3a9d21"
+
+
+class FlakyFileStorage(LocalFileStorage):
+    """A local file storage failing a number of writes."""
+
+    failures = 0
+
+    async def write(self, file_id: str, content: bytes, *, sha256: str = "") -> None:
+        """Fail or write the file."""
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk unavailable")
+        await super().write(file_id, content, sha256=sha256)
+
+
+async def wait_for(condition: Callable[[], bool]):
+    """Wait until the condition is met."""
+
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout=5)
+
+
+def get_translator_config(tmp_path: Path) -> Config:
+    """Get a config with short retry delays."""
+    return get_config(
+        sources=[
+            LocalFileStorageConfig(staging_directory=tmp_path),
+            EventSubTranslatorConfig(
+                file_events_topic="file-events",
+                nonstaged_file_requested_type="non_staged_file_requested",
+                staging_max_retries=2,
+                staging_retry_delay=0.02,
+                retry_timer_resolution=0.01,
+            ),
+        ]
+    )
+
+
+@pytest.mark.asyncio
+async def test_timer_wheel():
+    """Test that callbacks run in the order of their deadlines, including ones more
+    than a turn of the wheel ahead.
+    """
+    fired: list[int] = []
+
+    def record(number: int):
+        async def callback():
+            fired.append(number)
+
+        return callback
+
+    async with TimerWheel.construct(tick=0.01, slots=4) as wheel:
+        for number, delay in enumerate((0.09, 0.01, 0.05, 0.03)):
+            wheel.schedule(delay, record(number))
+        assert wheel.pending == 4
+        await wait_for(lambda: len(fired) == 4)
+        assert wheel.pending == 0
+    assert fired == [1, 3, 2, 0]
+
+
+@pytest.mark.parametrize("failures, staged", [(2, True), (3, False)])
+@pytest.mark.asyncio
+async def test_retry_and_dead_letter(tmp_path: Path, failures: int, staged: bool):
+    """Test that failed stagings are retried in the background and dead-lettered once
+    all retries failed.
+    """
+    config = get_translator_config(tmp_path)
+    dead_letters = InMemEventPublisher()
+    file_storage = FlakyFileStorage(config=config)
+    file_storage.failures = failures
+    staging_ledger = InMemStagingLedger()
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=file_storage,
+        staging_ledger=staging_ledger,
+    )
+    event = NonStagedFileRequested(
+        correlation_id=CORRELATION_ID,
+        file_id="test.txt",
+        target_object_id="test.txt",
+        target_bucket_id="test",
+        s3_endpoint_alias="test",
+        decrypted_sha256="",
+    )
+    dead_letter_events = dead_letters.event_store.topics[config.dead_letter_topic]
+
+    async with EventSubTranslator.construct(
+        config=config,
+        data_repository=data_repository,
+        dead_letter_publisher=dead_letters,
+    ) as translator:
+        await translator.consume(
+            payload=event.model_dump(),
+            type_=config.nonstaged_file_requested_type,
+            topic=config.file_events_topic,
+        )
+        # the consumer is not blocked by the staging and its retries
+        assert file_storage.failures == failures
+        await wait_for(
+            lambda: get_staging_layout(config).get_path("test.txt").exists()
+            or bool(dead_letter_events)
+        )
+
+    [record] = await staging_ledger.find(file_id="test.txt")
+    if staged:
+        assert record.status == StagingStatus.STAGED
+        assert not dead_letter_events
+        return
+    assert record.status == StagingStatus.FAILED
+    [dead_letter] = dead_letter_events
+    assert dead_letter.key == "test.txt"
+    assert dead_letter.type_ == config.nonstaged_file_requested_type
+    assert dead_letter.payload["payload"] == event.model_dump()
+    assert dead_letter.payload["correlation_id"] == CORRELATION_ID
+    assert dead_letter.payload["error"] == {
+        "type": "OSError",
+        "message": "disk unavailable",
+    }
+    assert dead_letter.payload["attempts"] == 3
+
+
+@pytest.mark.asyncio
+async def test_pending_retries_on_shutdown(tmp_path: Path):
+    """Test that stagings with a pending retry are marked as failed on shutdown and
+    their events dead-lettered and acknowledged.
+    """
+    config = get_translator_config(tmp_path).model_copy(
+        update={"staging_retry_delay": 60}
+    )
+    dead_letters = InMemEventPublisher()
+    file_storage = FlakyFileStorage(config=config)
+    file_storage.failures = 1
+    staging_ledger = InMemStagingLedger()
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=file_storage,
+        staging_ledger=staging_ledger,
+    )
+    event = NonStagedFileRequested(
+        correlation_id=CORRELATION_ID,
+        file_id="test.txt",
+        target_object_id="test.txt",
+        target_bucket_id="test",
+        s3_endpoint_alias="test",
+        decrypted_sha256="",
+    )
+    acknowledged: list[bool] = []
+
+    async with EventSubTranslator.construct(
+        config=config,
+        data_repository=data_repository,
+        dead_letter_publisher=dead_letters,
+    ) as translator:
+        with acknowledge_when_done(lambda: acknowledged.append(True)):
+            await translator.consume(
+                payload=event.model_dump(),
+                type_=config.nonstaged_file_requested_type,
+                topic=config.file_events_topic,
+            )
+        await wait_for(lambda: not file_storage.failures)
+        await translator.wait_until_idle()
+        assert not acknowledged
+
+    assert acknowledged == [True]
+    [record] = await staging_ledger.find(file_id="test.txt")
+    assert record.status == StagingStatus.FAILED
+    dead_letter = dead_letters.event_store.get(config.dead_letter_topic)
+    assert dead_letter.payload["correlation_id"] == CORRELATION_ID
+    assert dead_letter.payload["error"]["type"] == "RetryCancelledError"
+
+
+@pytest.mark.asyncio
+async def test_dead_letter_invalid_event(tmp_path: Path):
+    """Test that invalid events are dead-lettered without retries."""
+    config = get_translator_config(tmp_path)
+    dead_letters = InMemEventPublisher()
+    translator = EventSubTranslator(
+        config=config,
+        data_repository=DataRepository(
+            config=config,
+            event_publisher=EventPubTranslator(
+                config=config, provider=InMemEventPublisher()
+            ),
+            file_storage=LocalFileStorage(config=config),
+        ),
+        dead_letter_publisher=dead_letters,
+    )
+    payload = {"file_id": "test.txt", "correlation_id": CORRELATION_ID}
+    await translator.consume(
+        payload=payload,
+        type_=config.nonstaged_file_requested_type,
+        topic=config.file_events_topic,
+    )
+
+    dead_letter = dead_letters.event_store.get(config.dead_letter_topic)
+    assert dead_letter.payload["payload"] == payload
+    assert dead_letter.payload["correlation_id"] == CORRELATION_ID
+    assert dead_letter.payload["error"]["type"] == "EventSchemaValidationError"
+    assert dead_letter.payload["attempts"] == 1
+
+
+@pytest.mark.asyncio
+async def test_dead_letter_invalid_correlation_id(tmp_path: Path):
+    """Test that events with an invalid correlation ID are dead-lettered and
+    acknowledged without being staged.
+    """
+    config = get_translator_config(tmp_path)
+    dead_letters = InMemEventPublisher()
+    translator = EventSubTranslator(
+        config=config,
+        data_repository=DataRepository(
+            config=config,
+            event_publisher=EventPubTranslator(
+                config=config, provider=InMemEventPublisher()
+            ),
+            file_storage=LocalFileStorage(config=config),
+        ),
+        dead_letter_publisher=dead_letters,
+    )
+    event = NonStagedFileRequested(
+        correlation_id="BAD_ID",
+        file_id="test.txt",
+        target_object_id="test.txt",
+        target_bucket_id="test",
+        s3_endpoint_alias="test",
+        decrypted_sha256="",
+    )
+    acknowledged: list[bool] = []
+
+    with acknowledge_when_done(lambda: acknowledged.append(True)):
+        await translator.consume(
+            payload=event.model_dump(),
+            type_=config.nonstaged_file_requested_type,
+            topic=config.file_events_topic,
+        )
+
+    assert acknowledged == [True]
+    dead_letter = dead_letters.event_store.get(config.dead_letter_topic)
+    assert dead_letter.payload["correlation_id"] == "BAD_ID"
+    assert dead_letter.payload["error"]["type"] == "InvalidCorrelationIdError"
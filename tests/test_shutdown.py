@@ -0,0 +1,177 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for graceful shutdowns."""
+
+import asyncio
+import os
+import signal
+import socket
+from contextlib import asynccontextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from hexkit.custom_types import Ascii, JsonObject
+from hexkit.protocols.eventsub import EventSubscriberProtocol
+
+from pci.adapters.inbound.kafka_subscriber import InstrumentedKafkaEventSubscriber
+from pci.adapters.inbound.metrics_server import MetricsServerConfig
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+)
+from pci.main import run_rest_app
+from pci.shutdown import GracefulShutdown, ShutdownConfig, shutdown_duration
+from tests.fixtures.config import get_config
+from tests.fixtures.consumer import FakeConsumerEvent
+
+
+class BlockingConsumer:
+    """A consumer handing out one event and then waiting for more forever."""
+
+    def __init__(self):
+        self.events = [FakeConsumerEvent(topic="test-topic", partition=0, offset=0)]
+
+    async def __anext__(self) -> FakeConsumerEvent:
+        """Get the next event."""
+        if self.events:
+            return self.events.pop()
+        await asyncio.Event().wait()
+        raise AssertionError("unreachable")
+
+
+class SlowTranslator(EventSubscriberProtocol):
+    """A translator that takes a while and triggers the shutdown while processing."""
+
+    topics_of_interest = ["test-topic"]
+    types_of_interest = ["test_type"]
+
+    def __init__(self, shutdown: GracefulShutdown):
+        self._shutdown = shutdown
+        self.processed = False
+
+    async def _consume_validated(
+        self, *, payload: JsonObject, type_: Ascii, topic: Ascii
+    ) -> None:
+        self._shutdown.begin()
+        await asyncio.sleep(0.05)
+        self.processed = True
+
+
+@pytest.mark.asyncio
+async def test_consumer_drain():
+    """Test that the consumer finishes the event in flight and then stops on SIGTERM,
+    and that the shutdown duration is reported.
+    """
+    with GracefulShutdown(config=ShutdownConfig(), process="test") as shutdown:
+        translator = SlowTranslator(shutdown)
+        subscriber = InstrumentedKafkaEventSubscriber(
+            consumer=BlockingConsumer(),
+            translator=translator,
+        )
+        await asyncio.wait_for(subscriber.run_until(shutdown.stopping), timeout=5)
+        assert translator.processed
+
+        # a signal stops a consumer that is waiting for events
+        shutdown.stopping.clear()
+        run = asyncio.create_task(subscriber.run_until(shutdown.stopping))
+        await asyncio.sleep(0.01)
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.wait_for(run, timeout=5)
+
+    assert shutdown_duration.value(process="test") > 0
+
+
+@pytest.mark.asyncio
+async def test_shutdown_deadline():
+    """Test that work exceeding the deadline is cancelled."""
+
+    async def drain():
+        with GracefulShutdown(
+            config=ShutdownConfig(shutdown_timeout=0, shutdown_teardown_timeout=0),
+            process="test",
+            handle_signals=False,
+        ) as shutdown:
+            shutdown.begin()
+            await asyncio.sleep(5)
+
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(asyncio.create_task(drain()), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_teardown_budget():
+    """Test that the teardown gets its own budget once the drain has completed, and
+    that a shutdown can be begun from outside the event loop.
+    """
+    with GracefulShutdown(
+        config=ShutdownConfig(shutdown_timeout=0, shutdown_teardown_timeout=1),
+        process="test",
+        handle_signals=False,
+    ) as shutdown:
+        await asyncio.to_thread(shutdown.begin_threadsafe)
+        await asyncio.wait_for(shutdown.stopping.wait(), timeout=0.5)
+        await asyncio.sleep(0.8)
+        shutdown.begin_teardown()
+        # past the deadline counted from the signal
+        await asyncio.sleep(0.4)
+
+
+@pytest.mark.asyncio
+async def test_atomic_staging(tmp_path: Path):
+    """Test that a failed write leaves neither a partial file nor a temporary file."""
+    storage = LocalFileStorage(
+        config=LocalFileStorageConfig(staging_directory=tmp_path)
+    )
+    await storage.write("test.txt", b"first")
+
+    with patch("os.replace", side_effect=OSError("disk full")), pytest.raises(OSError):
+        await storage.write("test.txt", b"second")
+
+    assert [path.name for path in tmp_path.rglob("*") if path.is_file()] == ["test.txt"]
+    assert await storage.read("test.txt") == b"first"
+
+
+@pytest.mark.asyncio
+async def test_rest_metrics(monkeypatch: pytest.MonkeyPatch):
+    """Test that the REST API process serves its metrics, including the duration of
+    its shutdown.
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    config = get_config(
+        sources=[MetricsServerConfig(metrics_port=port, metrics_linger=0)]
+    )
+    monkeypatch.setattr("pci.main.Config", lambda: config)
+
+    @asynccontextmanager
+    async def prepare_rest_app(config):
+        yield None
+
+    async def run_server(*, app, config, shutdown: GracefulShutdown):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        assert response.startswith(b"HTTP/1.1 200 OK")
+        shutdown.begin()
+
+    monkeypatch.setattr("pci.main.prepare_rest_app", prepare_rest_app)
+    monkeypatch.setattr("pci.main._run_server", run_server)
+    await run_rest_app()
+    assert shutdown_duration.value(process="rest") > 0
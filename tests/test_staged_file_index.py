@@ -0,0 +1,183 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the in-memory index of staged files."""
+
+import asyncio
+import sys
+from pathlib import Path
+from typing import Callable
+from unittest.mock import patch
+
+import pytest
+
+from pci.adapters.outbound.local_storage import LocalFileStorage, LocalFileStorageConfig
+from pci.adapters.outbound.staged_file_index import StagedFileIndex
+from pci.adapters.outbound.staging_layout import StagingLayout
+from pci.ports.outbound.file_storage import FileStoragePort
+
+
+async def wait_for(condition: Callable[[], bool]):
+    """Wait until the condition is met."""
+
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(poll(), timeout=5)
+
+
+@pytest.mark.asyncio
+async def test_index_lookups(tmp_path: Path):
+    """Test that the index is populated by a scan and by writes, and that files not
+    in the index are still looked up in the filesystem without inotify.
+    """
+    config = LocalFileStorageConfig(
+        staging_directory=tmp_path,
+        staging_index_inotify=False,
+        staging_index_rescan_interval=0,
+    )
+    layout = StagingLayout(root=tmp_path, shard_levels=2)
+    existing_path = layout.get_path("existing.txt")
+    existing_path.parent.mkdir(parents=True)
+    existing_path.write_bytes(b"existing")
+    existing_path.with_name(".existing.txt.1234.tmp").write_bytes(b"partial")
+    # files outside of the layout are ignored
+    (tmp_path / "flat.txt").write_bytes(b"flat")
+    async with LocalFileStorage.construct(config=config) as storage:
+        assert await storage.exists("existing.txt")
+        assert not await storage.exists(".existing.txt.1234.tmp")
+        assert not await storage.exists("flat.txt")
+
+        with pytest.raises(FileStoragePort.FileNotStagedError):
+            await storage.read("missing.txt")
+
+        # files staged by other processes are found and indexed
+        other_path = layout.get_path("other.txt")
+        other_path.parent.mkdir(parents=True, exist_ok=True)
+        other_path.write_bytes(b"other")
+        assert await storage.exists("other.txt")
+        assert await storage.read("other.txt") == b"other"
+
+        await storage.write("new.txt", b"content")
+        assert await storage.exists("new.txt")
+        assert await storage.read("new.txt") == b"content"
+
+        # files removed behind the index's back are dropped once a read fails
+        existing_path.unlink()
+        with pytest.raises(FileStoragePort.FileNotStagedError):
+            await storage.read("existing.txt")
+        assert not await storage.exists("existing.txt")
+
+
+@pytest.mark.asyncio
+async def test_rescan(tmp_path: Path):
+    """Test that files staged by other processes are picked up by rescans."""
+    async with StagedFileIndex.construct(
+        layout=StagingLayout(root=tmp_path, shard_levels=0),
+        rescan_interval=0.01,
+        use_inotify=False,
+        max_watches=1,
+    ) as index:
+        assert not len(index)
+        (tmp_path / "other.txt").write_bytes(b"content")
+        await wait_for(lambda: "other.txt" in index)
+        staged_file = index.get("other.txt")
+        assert staged_file is not None
+        assert staged_file.size == len(b"content")
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires inotify")
+@pytest.mark.asyncio
+async def test_inotify(tmp_path: Path):
+    """Test that files staged and removed by other processes are picked up via
+    inotify, including files in shard directories created after the start.
+    """
+    layout = StagingLayout(root=tmp_path, shard_levels=2)
+    await LocalFileStorage(
+        config=LocalFileStorageConfig(staging_directory=tmp_path)
+    ).write("existing.txt", b"content")
+    async with StagedFileIndex.construct(
+        layout=layout, rescan_interval=0, use_inotify=True, max_watches=1024
+    ) as index:
+        assert "existing.txt" in index
+        other_storage = LocalFileStorage(
+            config=LocalFileStorageConfig(staging_directory=tmp_path)
+        )
+        for file_id in ("other.txt", "existing_2.txt"):
+            await other_storage.write(file_id, b"content")
+            await wait_for(lambda: file_id in index)  # noqa: B023
+        assert len(index) == 3
+
+        layout.get_path("other.txt").unlink()
+        await wait_for(lambda: "other.txt" not in index)
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires inotify")
+@pytest.mark.asyncio
+async def test_complete_index_lookups(tmp_path: Path):
+    """Test that files not in the index are not looked up in the filesystem while
+    the index is kept current via inotify.
+    """
+    config = LocalFileStorageConfig(
+        staging_directory=tmp_path, staging_index_rescan_interval=0
+    )
+    async with LocalFileStorage.construct(config=config) as storage:
+        with patch("pathlib.Path.stat") as stat, patch(
+            "pathlib.Path.read_bytes"
+        ) as read_bytes:
+            assert not await storage.exists("missing.txt")
+            with pytest.raises(FileStoragePort.FileNotStagedError):
+                await storage.read("missing.txt")
+        stat.assert_not_called()
+        read_bytes.assert_not_called()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires inotify")
+@pytest.mark.asyncio
+async def test_inotify_watch_limit(tmp_path: Path, caplog: pytest.LogCaptureFixture):
+    """Test that no more than the maximum number of directories are watched, and
+    that the index falls back to rescans with a warning beyond that.
+    """
+    layout = StagingLayout(root=tmp_path, shard_levels=1)
+    storage = LocalFileStorage(
+        config=LocalFileStorageConfig(
+            staging_directory=tmp_path, staging_shard_levels=1
+        )
+    )
+    shard = layout.get_path("test_0.txt").parent
+    other_file_id = next(
+        file_id
+        for file_id in (f"test_{number}.txt" for number in range(1, 100))
+        if layout.get_path(file_id).parent != shard
+    )
+    await storage.write("test_0.txt", b"content")
+
+    # the root and one shard directory
+    async with StagedFileIndex.construct(
+        layout=layout, rescan_interval=0, use_inotify=True, max_watches=2
+    ) as index:
+        assert index.complete
+        await storage.write(other_file_id, b"content")
+        await wait_for(lambda: not index.complete)
+    assert "Stopped watching" in caplog.text
+
+    async with StagedFileIndex.construct(
+        layout=layout, rescan_interval=0, use_inotify=True, max_watches=2
+    ) as index:
+        assert not index.complete
+        assert len(index) == 2
+    assert "Not watching" in caplog.text
@@ -0,0 +1,142 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the layout of the staging directory."""
+
+from pathlib import Path
+
+import pytest
+
+from pci.adapters.outbound.local_storage import LocalFileStorageConfig
+from pci.adapters.outbound.outbox import OutboxConfig
+from pci.adapters.outbound.staging_layout import StagingLayout
+from pci.main import migrate_staging_layout
+from tests.fixtures.config import get_config
+
+
+@pytest.mark.parametrize(
+    "file_id, name",
+    [
+        ("GHGAF1234", "GHGAF1234"),
+        ("../etc/passwd", "%2E.%2Fetc%2Fpasswd"),
+        ("..", "%2E."),
+        (".hidden", "%2Ehidden"),
+        ("a b/c%d", "a%20b%2Fc%25d"),
+    ],
+)
+def test_sanitization(tmp_path: Path, file_id: str, name: str):
+    """Test that file IDs map to a single, non-hidden file name below the root."""
+    layout = StagingLayout(root=tmp_path, shard_levels=2)
+    path = layout.get_path(file_id)
+    assert path.name == name
+    assert path.parent.parent.parent == tmp_path
+    assert all(layout.is_shard_name(shard) for shard in layout.get_shards(file_id))
+    assert layout.decode_name(name) == file_id
+
+
+def test_empty_file_id(tmp_path: Path):
+    """Test that empty file IDs are rejected."""
+    with pytest.raises(ValueError):
+        StagingLayout(root=tmp_path, shard_levels=2).get_path("")
+
+
+def test_migrate(tmp_path: Path):
+    """Test that files of a layout with fewer levels are moved into shard directories
+    and that directories left empty are removed.
+    """
+    flat = StagingLayout(root=tmp_path, shard_levels=0)
+    one_level = StagingLayout(root=tmp_path, shard_levels=1)
+    sharded = StagingLayout(root=tmp_path, shard_levels=2)
+    flat.get_path("a.txt").write_text("a")
+    path = one_level.get_path("b.txt")
+    path.parent.mkdir()
+    path.write_text("b")
+    (tmp_path / ".c.txt.1234.tmp").write_text("partial")
+
+    assert sharded.migrate(previous_levels=0, dry_run=True) == 1
+    assert flat.get_path("a.txt").exists()
+
+    assert sharded.migrate(previous_levels=0) == 1
+    assert sharded.migrate(previous_levels=1) == 1
+    assert sharded.get_path("a.txt").read_text() == "a"
+    assert sharded.get_path("b.txt").read_text() == "b"
+    assert dict(sharded.scan()).keys() == {"a.txt", "b.txt"}
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [".c.txt.1234.tmp", *{sharded.get_shards(id_)[0] for id_ in ("a.txt", "b.txt")}]
+    )
+    assert sharded.migrate(previous_levels=1) == 0
+
+
+def test_migrate_other_content(tmp_path: Path):
+    """Test that only files at the depth of the previous layout are moved, leaving
+    other directories and symlinks alone.
+    """
+    (tmp_path / ".git").mkdir()
+    (tmp_path / ".git" / "HEAD").write_text("ref")
+    (tmp_path / "outbox").mkdir()
+    (tmp_path / "outbox" / "0000000000.log").write_bytes(b"segment")
+    (tmp_path / "ab").mkdir()
+    (tmp_path / "ab" / "cd").mkdir()
+    (tmp_path / "ab" / "cd" / "deep.txt").write_text("deep")
+    (tmp_path / "link.txt").symlink_to(tmp_path / ".git" / "HEAD")
+    flat = StagingLayout(root=tmp_path, shard_levels=0)
+    flat.get_path("a.txt").write_text("a")
+
+    sharded = StagingLayout(root=tmp_path, shard_levels=1)
+    assert sharded.migrate(previous_levels=0) == 1
+    assert sharded.get_path("a.txt").read_text() == "a"
+    assert (tmp_path / ".git" / "HEAD").read_text() == "ref"
+    assert (tmp_path / "outbox" / "0000000000.log").read_bytes() == b"segment"
+    assert (tmp_path / "ab" / "cd" / "deep.txt").read_text() == "deep"
+    assert (tmp_path / "link.txt").is_symlink()
+
+
+@pytest.mark.parametrize("outbox_enabled", [False, True])
+def test_migrate_outbox(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, outbox_enabled: bool
+):
+    """Test that no files are moved if the staging directory contains the directory
+    of an enabled outbox.
+    """
+    config = get_config(
+        sources=[
+            LocalFileStorageConfig(staging_directory=tmp_path, staging_shard_levels=1),
+            OutboxConfig(
+                outbox_enabled=outbox_enabled, outbox_directory=tmp_path / "outbox"
+            ),
+        ]
+    )
+    monkeypatch.setattr("pci.main.Config", lambda: config)
+    (tmp_path / "a.txt").write_text("a")
+    if outbox_enabled:
+        with pytest.raises(ValueError):
+            migrate_staging_layout(previous_levels=0)
+        assert (tmp_path / "a.txt").exists()
+    else:
+        assert migrate_staging_layout(previous_levels=0) == 1
+
+
+def test_migrate_working_directory(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Test that no files are moved if the staging directory is the working
+    directory.
+    """
+    config = get_config(sources=[LocalFileStorageConfig(staging_directory=Path("."))])
+    monkeypatch.setattr("pci.main.Config", lambda: config)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Dockerfile").write_text("FROM python")
+    with pytest.raises(ValueError):
+        migrate_staging_layout(previous_levels=0)
+    assert (tmp_path / "Dockerfile").exists()
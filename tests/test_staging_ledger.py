@@ -0,0 +1,170 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the staging ledger."""
+
+from pathlib import Path
+
+import pytest
+from ghga_service_commons.api.testing import AsyncTestClient
+from hexkit.providers.testing.eventpub import InMemEventPublisher
+
+from pci.adapters.inbound.fastapi_ import dummies
+from pci.adapters.inbound.fastapi_.configure import get_configured_app
+from pci.adapters.outbound.event_pub import EventPubTranslator
+from pci.adapters.outbound.local_storage import (
+    LocalFileStorage,
+    LocalFileStorageConfig,
+)
+from pci.adapters.outbound.staging_ledger import (
+    BufferedStagingLedger,
+    InMemStagingLedger,
+    MongoStagingLedger,
+    StagingLedgerConfig,
+)
+from pci.context_vars import CORRELATION_ID_HEADER_NAME, set_correlation_id
+from pci.core.data_repository import DataRepository
+from pci.models import StagingRecord, StagingStatus
+from pci.ports.outbound.staging_ledger import StagingLedgerPort
+from tests.fixtures.config import get_config
+
+CORRELATION_ID = "0f1c7c4e-9b5d-4a51-8a5e-3c2f6d9b7e10"
+
+
+class FakeCollection:
+    """Records the bulk writes sent to a MongoDB collection."""
+
+    def __init__(self):
+        self.bulk_writes: list[list] = []
+
+    async def bulk_write(self, operations: list, ordered: bool):
+        """Record the operations of a bulk write."""
+        assert not ordered
+        self.bulk_writes.append(operations)
+
+
+@pytest.mark.asyncio
+async def test_in_mem_ledger():
+    """Test that records are merged on update and can be found by any index."""
+    ledger = InMemStagingLedger()
+    requested = StagingRecord(
+        file_id="test.txt", correlation_id="id1", status=StagingStatus.REQUESTED
+    )
+    other = StagingRecord(
+        file_id="other.txt", correlation_id="id1", status=StagingStatus.REQUESTED
+    )
+    await ledger.upsert_many([requested, other])
+    staged = requested.model_copy(update={"status": StagingStatus.STAGED})
+    await ledger.upsert_many([staged])
+
+    assert await ledger.find(file_id="test.txt") == [staged]
+    assert await ledger.find(correlation_id="id1") == [other, staged]
+    assert await ledger.find(correlation_id="id1", status=StagingStatus.REQUESTED) == [
+        other
+    ]
+    assert await ledger.find(file_id="test.txt", correlation_id="id2") == []
+
+    # late updates of other processes do not set a staging back to requested
+    await ledger.upsert_many([requested])
+    assert await ledger.find(file_id="test.txt") == [staged]
+
+    with pytest.raises(StagingLedgerPort.MissingLookupKeyError):
+        await ledger.find(status=StagingStatus.STAGED)
+
+
+@pytest.mark.asyncio
+async def test_buffered_ledger():
+    """Test that updates are merged while buffered and written in batches."""
+    collection = FakeCollection()
+    config = StagingLedgerConfig(
+        staging_ledger_batch_size=2, staging_ledger_flush_interval=3600
+    )
+    records = [
+        StagingRecord(
+            file_id=f"test_{index}.txt",
+            correlation_id="id1",
+            status=StagingStatus.REQUESTED,
+        )
+        for index in range(3)
+    ]
+    async with BufferedStagingLedger.construct(
+        config=config, ledger=MongoStagingLedger(collection=collection)
+    ) as ledger:
+        await ledger.upsert_many(records[:1])
+        await ledger.upsert_many(
+            [records[0].model_copy(update={"status": StagingStatus.STAGED})]
+        )
+        assert not collection.bulk_writes
+        await ledger.upsert_many(records[1:])
+        await ledger.flush()
+    assert len(collection.bulk_writes) == 1
+
+    operations = collection.bulk_writes[0]
+    assert len(operations) == 3
+    assert operations[0]._filter == {"_id": records[0].id}
+    assert operations[0]._doc["$set"] == {
+        "file_id": "test_0.txt",
+        "correlation_id": "id1",
+        "status": "staged",
+    }
+    # the requested status never overwrites the status of an existing record
+    assert operations[1]._doc["$set"] == {
+        "file_id": "test_1.txt",
+        "correlation_id": "id1",
+    }
+    assert operations[1]._doc["$setOnInsert"] == {"status": "requested"}
+
+
+@pytest.mark.asyncio
+async def test_staging_requests_route(tmp_path: Path):
+    """Test that the data repository records requests and staging under the
+    correlation ID and that they can be looked up through the API.
+    """
+    config = get_config(sources=[LocalFileStorageConfig(staging_directory=tmp_path)])
+    data_repository = DataRepository(
+        config=config,
+        event_publisher=EventPubTranslator(
+            config=config, provider=InMemEventPublisher()
+        ),
+        file_storage=LocalFileStorage(config=config),
+        staging_ledger=InMemStagingLedger(),
+    )
+    async with set_correlation_id(CORRELATION_ID):
+        await data_repository.handle_request("test.txt")
+        await data_repository.stage_file("test.txt")
+
+    app = get_configured_app(config=config)
+    app.dependency_overrides[dummies.data_repository_port] = lambda: data_repository
+    headers = {CORRELATION_ID_HEADER_NAME: CORRELATION_ID}
+
+    async with AsyncTestClient(app=app) as rest_client:
+        response = await rest_client.get(
+            "/staging/requests", params={"correlation_id": CORRELATION_ID}
+        )
+        assert response.status_code == 200
+        [record] = response.json()
+        assert record["file_id"] == "test.txt"
+        assert record["status"] == "staged"
+        assert record["requested_at"] <= record["staged_at"]
+
+        response = await rest_client.get(
+            "/staging/requests",
+            params={"file_id": "test.txt", "staging_status": "requested"},
+        )
+        assert response.json() == []
+
+        response = await rest_client.get("/staging/requests", headers=headers)
+        assert response.status_code == 422
@@ -0,0 +1,157 @@
+# Copyright 2021 - 2023 Universität Tübingen, DKFZ, EMBL, and Universität zu Köln
+# for the German Human Genome-Phenome Archive (GHGA)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the priority scheduler of stagings."""
+
+import asyncio
+from unittest.mock import Mock
+
+import pytest
+from pydantic import ValidationError
+
+from pci.adapters.inbound.event_sub import EventSubTranslator, EventSubTranslatorConfig
+from pci.adapters.inbound.staging_scheduler import (
+    SchedulerClosedError,
+    StagingScheduler,
+    staging_queue_seconds,
+)
+
+PRIORITIES = ["interactive", "bulk"]
+
+
+@pytest.mark.asyncio
+async def test_priority_and_fairness():
+    """Test that higher priorities go first and groups take turns within a class."""
+    started: list[str] = []
+    gate = asyncio.Event()
+
+    def record(name: str):
+        async def job():
+            started.append(name)
+            if name == "blocker":
+                await gate.wait()
+
+        return job
+
+    async with StagingScheduler.construct(
+        priorities=PRIORITIES, concurrency=1, max_size=100
+    ) as scheduler:
+        # keep the only worker busy until everything is queued
+        await scheduler.put(record("blocker"), priority="bulk", group="x")
+        await asyncio.sleep(0)
+        for number in range(3):
+            await scheduler.put(record(f"a{number}"), priority="bulk", group="a")
+        await scheduler.put(record("b0"), priority="bulk", group="b")
+        await scheduler.put(record("c0"), priority="interactive", group="c")
+        await scheduler.put(record("c1"), priority="interactive", group="c")
+        assert len(scheduler) == 6
+        gate.set()
+        await scheduler.wait_until_idle()
+        assert not len(scheduler)
+
+    assert started == ["blocker", "c0", "c1", "a0", "b0", "a1", "a2"]
+
+
+@pytest.mark.asyncio
+async def test_queue_wait_and_failures():
+    """Test that queue waits are recorded per priority and failing jobs do not stop
+    the workers.
+    """
+    done: list[int] = []
+
+    async def fail():
+        raise OSError("disk unavailable")
+
+    async def succeed():
+        done.append(1)
+
+    count_before = staging_queue_seconds.count(priority="bulk")
+    async with StagingScheduler.construct(
+        priorities=PRIORITIES, concurrency=2, max_size=1
+    ) as scheduler:
+        await scheduler.put(fail, priority="bulk", group="a")
+        await scheduler.put(succeed, priority="bulk", group="a")
+        with pytest.raises(KeyError):
+            await scheduler.put(succeed, priority="urgent", group="a")
+    # the teardown completes all queued jobs
+    assert done == [1]
+    assert staging_queue_seconds.count(priority="bulk") == count_before + 2
+    with pytest.raises(SchedulerClosedError):
+        await scheduler.put(succeed, priority="bulk", group="a")
+
+
+@pytest.mark.asyncio
+async def test_max_size():
+    """Test that of the submitters waiting for space, only as many as fit proceed."""
+    releases: list[asyncio.Event] = []
+
+    def blocking():
+        release = asyncio.Event()
+        releases.append(release)
+        return release.wait
+
+    async with StagingScheduler.construct(
+        priorities=PRIORITIES, concurrency=1, max_size=1
+    ) as scheduler:
+        await scheduler.put(blocking(), priority="bulk", group="a")
+        await asyncio.sleep(0)
+        await scheduler.put(blocking(), priority="bulk", group="a")
+        waiting = [
+            asyncio.create_task(scheduler.put(blocking(), priority="bulk", group="a"))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        assert not any(submitter.done() for submitter in waiting)
+
+        # the worker takes the queued job once the running one is done
+        releases[0].set()
+        await asyncio.sleep(0.01)
+        assert len(scheduler) == 1
+        assert sum(submitter.done() for submitter in waiting) == 1
+
+        for release in releases:
+            release.set()
+        await asyncio.gather(*waiting)
+
+
+@pytest.mark.parametrize(
+    "payload, priority",
+    [
+        ({}, "interactive"),
+        ({"priority": "bulk"}, "bulk"),
+        ({"baggage": {"priority": "bulk"}}, "bulk"),
+        ({"priority": "interactive", "baggage": {"priority": "bulk"}}, "interactive"),
+        ({"priority": "urgent"}, "interactive"),
+    ],
+)
+def test_get_priority(payload: dict, priority: str):
+    """Test that the priority is taken from the event or else from its baggage."""
+    config = EventSubTranslatorConfig(
+        file_events_topic="file-events",
+        nonstaged_file_requested_type="non_staged_file_requested",
+    )
+    translator = EventSubTranslator(config=config, data_repository=Mock())
+    assert translator._get_priority(payload) == priority
+
+
+def test_unknown_default_priority():
+    """Test that the default priority must be one of the priority classes."""
+    with pytest.raises(ValidationError):
+        EventSubTranslatorConfig(
+            file_events_topic="file-events",
+            nonstaged_file_requested_type="non_staged_file_requested",
+            staging_default_priority="urgent",
+        )
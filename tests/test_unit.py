@@ -21,13 +21,22 @@ from fastapi import Request
 from pci.adapters.inbound.fastapi_.utils import (
     CORRELATION_ID_HEADER_NAME,
     InvalidCorrelationIdError,
+    correlation_id_middleware,
     set_header_correlation_id,
     validate_correlation_id,
 )
 from pci.context_vars import (
+    BAGGAGE_HEADER_NAME,
+    MAX_BAGGAGE_BYTES,
+    MAX_BAGGAGE_ITEMS,
+    SPAN_ID_HEADER_NAME,
+    CorrelationContext,
     MissingCorrelationIdError,
+    get_correlation_context,
     get_correlation_id,
+    set_correlation_context,
     set_correlation_id,
+    with_correlation_id,
 )
 
 
@@ -62,3 +71,134 @@ def test_header_update_function():
     request = dummy_request()
     set_header_correlation_id(request, "id123")
     assert request.headers.get(CORRELATION_ID_HEADER_NAME) == "id123"
+
+
+@pytest.mark.asyncio
+async def test_correlation_context_hops():
+    """Verify that child contexts keep the correlation ID and link to their parent."""
+    root = CorrelationContext.new("id123", baggage={"priority": "bulk"})
+    child = root.child(step="staging")
+
+    assert child.correlation_id == root.correlation_id
+    assert child.parent_id == root.span_id
+    assert child.span_id not in ("", root.span_id)
+    assert dict(child.baggage) == {"priority": "bulk", "step": "staging"}
+    assert dict(root.baggage) == {"priority": "bulk"}
+
+    with pytest.raises(AttributeError):
+        root.correlation_id = "other"
+
+    async with set_correlation_context(child):
+        assert get_correlation_context() is child
+        assert get_correlation_id() == "id123"
+
+
+def test_correlation_context_serialization():
+    """Verify that a context survives the round trip through headers and events as a
+    new hop that references the sender's span.
+    """
+    context = CorrelationContext.new("id123", baggage={"note": "a=b, c"})
+
+    headers = context.to_headers()
+    assert headers[CORRELATION_ID_HEADER_NAME] == "id123"
+    assert headers[SPAN_ID_HEADER_NAME] == context.span_id
+    assert "," not in headers[BAGGAGE_HEADER_NAME].replace("%2C", "")
+
+    for received in (
+        CorrelationContext.from_headers(headers),
+        CorrelationContext.from_event_fields(context.to_event_fields()),
+    ):
+        assert received.correlation_id == "id123"
+        assert received.parent_id == context.span_id
+        assert received.span_id != context.span_id
+        assert received.baggage == context.baggage
+
+    overridden = CorrelationContext.from_headers({}, correlation_id="id456")
+    assert overridden.correlation_id == "id456"
+    assert overridden.parent_id == ""
+
+
+def test_received_context_limits():
+    """Verify that invalid span IDs and excessive baggage from other hops are
+    dropped.
+    """
+    many_items = ",".join(f"key{n}=value" for n in range(MAX_BAGGAGE_ITEMS + 10))
+    context = CorrelationContext.from_headers(
+        {SPAN_ID_HEADER_NAME: "not a span", BAGGAGE_HEADER_NAME: many_items}
+    )
+    assert context.parent_id == ""
+    assert len(context.baggage) == MAX_BAGGAGE_ITEMS
+
+    large_value = "x" * (MAX_BAGGAGE_BYTES // 2)
+    context = CorrelationContext.from_headers(
+        {
+            SPAN_ID_HEADER_NAME: "0123456789abcdef",
+            BAGGAGE_HEADER_NAME: ",".join(f"{key}={large_value}" for key in "abc"),
+        }
+    )
+    assert context.parent_id == "0123456789abcdef"
+    assert list(context.baggage) == ["a"]
+
+    context = CorrelationContext.from_event_fields(
+        {"span_id": "0123", "baggage": {"a": large_value, "b": large_value}}
+    )
+    assert context.parent_id == ""
+    assert list(context.baggage) == ["a"]
+
+
+def test_sync_correlation_id_context_manager():
+    """Verify that the correlation ID can be set in sync code and is reset afterwards."""
+    with set_correlation_id("id123") as context:
+        assert get_correlation_context() is context
+        assert get_correlation_id() == "id123"
+
+        with set_correlation_id("id456"):
+            assert get_correlation_id() == "id456"
+        assert get_correlation_id() == "id123"
+
+    with pytest.raises(MissingCorrelationIdError):
+        get_correlation_id()
+
+
+@pytest.mark.asyncio
+async def test_with_correlation_id_decorator():
+    """Verify that decorated functions run in a child span of the caller's context or
+    in a new context if the caller has none.
+    """
+
+    @with_correlation_id
+    def sync_func() -> CorrelationContext:
+        return get_correlation_context()
+
+    @with_correlation_id
+    async def async_func() -> CorrelationContext:
+        return get_correlation_context()
+
+    assert sync_func.__name__ == "sync_func"
+
+    # without a context set, a new correlation ID is generated
+    new_context = sync_func()
+    validate_correlation_id(new_context.correlation_id)
+    assert not new_context.parent_id
+
+    async with set_correlation_id("id123") as context:
+        for child in (sync_func(), await async_func()):
+            assert child.correlation_id == "id123"
+            assert child.parent_id == context.span_id
+
+
+@pytest.mark.asyncio
+async def test_middleware_resets_correlation_id_on_failure():
+    """Ensure the correlation ID does not leak out of the middleware if the request
+    handling fails.
+    """
+
+    async def failing_call_next(request: Request):
+        assert get_correlation_id()
+        raise RuntimeError("request failed")
+
+    with pytest.raises(RuntimeError):
+        await correlation_id_middleware(dummy_request(), failing_call_next)
+
+    with pytest.raises(MissingCorrelationIdError):
+        get_correlation_id()